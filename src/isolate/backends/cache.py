@@ -0,0 +1,209 @@
+"""Eviction of the cached environments under the isolate cache directory.
+
+Environments are evicted in least recently used order (based on the last time
+they were returned from a `create()` call) until the cache fits into the given
+quotas. Environments that are in use (by an agent process of any isolate server
+on the same machine), or that were used very recently, are never evicted.
+
+$ python -m isolate.backends.cache --max-size 50G --max-entries 100
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import stat
+import threading
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator
+
+from isolate.backends.common import is_locked_in_use, prune_store
+from isolate.backends.settings import DEFAULT_SETTINGS, IsolateSettings
+
+# Backends whose environments live under 'cache_dir/<backend>/<key>' and
+# can be removed without any help from the backend itself. Pyenv installs
+# are left alone, since virtualenvs depend on them.
+EVICTABLE_BACKENDS = ("virtualenv", "conda")
+
+# Environments that were used in the last N seconds are never evicted, since
+# they might be about to be connected to.
+DEFAULT_GRACE_PERIOD = 60.0
+
+_SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(raw_size: str) -> int:
+    """Parse a size in bytes, with an optional K/M/G/T (binary) suffix."""
+    raw_size = raw_size.strip().upper()
+    if raw_size.endswith("B"):
+        raw_size = raw_size[:-1]
+    if raw_size and raw_size[-1] in _SIZE_UNITS:
+        return int(float(raw_size[:-1]) * _SIZE_UNITS[raw_size[-1]])
+    return int(raw_size)
+
+
+def _disk_usage(path: Path) -> int:
+    # Files that are hardlinked to other places (e.g. through the package
+    # store) are shared between them, so only a share of their size is
+    # accounted to each.
+    total_size = 0
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                file_stat = os.lstat(os.path.join(root, file_name))
+            except FileNotFoundError:
+                continue
+
+            if stat.S_ISREG(file_stat.st_mode):
+                total_size += file_stat.st_blocks * 512 // file_stat.st_nlink
+    return total_size
+
+
+def _never_in_use(path: Path) -> bool:
+    return False
+
+
+@dataclass
+class CacheEntry:
+    path: Path
+    size: int
+    last_used: float
+
+
+@dataclass
+class CacheManager:
+    settings: IsolateSettings = DEFAULT_SETTINGS
+    # Maximum total size (in bytes) and number of environments to keep.
+    max_size: int | None = None
+    max_entries: int | None = None
+    grace_period: float = DEFAULT_GRACE_PERIOD
+    # Returns True for the environment paths that must not be evicted, on top
+    # of the ones that have a live agent process.
+    is_in_use: Callable[[Path], bool] = _never_in_use
+
+    def entries(self) -> Iterator[CacheEntry]:
+        for backend_name in EVICTABLE_BACKENDS:
+            backend_dir = self.settings.cache_dir / backend_name
+            if not backend_dir.exists():
+                continue
+
+            for path in backend_dir.iterdir():
+                if not path.is_dir():
+                    continue
+
+                try:
+                    last_used = self.settings.last_used_marker_for(path).stat().st_mtime
+                except FileNotFoundError:
+                    # Environments created before the use tracking.
+                    last_used = path.stat().st_mtime
+
+                yield CacheEntry(path, _disk_usage(path), last_used)
+
+    def collect(self, *, dry_run: bool = False) -> list[CacheEntry]:
+        """Evict the least recently used environments until the cache fits
+        into the quotas, and return the evicted ones."""
+        entries = sorted(self.entries(), key=lambda entry: entry.last_used)
+        total_size = sum(entry.size for entry in entries)
+        total_count = len(entries)
+
+        def is_over_quota() -> bool:
+            return (self.max_size is not None and total_size > self.max_size) or (
+                self.max_entries is not None and total_count > self.max_entries
+            )
+
+        evicted = []
+        grace_deadline = time.time() - self.grace_period
+        for entry in entries:
+            if not is_over_quota():
+                break
+
+            if entry.last_used > grace_deadline or self._is_in_use(entry.path):
+                continue
+
+            if not dry_run and not self._evict(entry):
+                continue
+
+            evicted.append(entry)
+            total_size -= entry.size
+            total_count -= 1
+
+        if evicted and not dry_run and self.settings.package_store:
+            prune_store(self.settings.package_store_dir)
+        return evicted
+
+    def _is_in_use(self, path: Path) -> bool:
+        # The agent processes hold a lock on the in-use marker of each cached
+        # environment they are using (see PythonExecutionBase.start_process).
+        return self.is_in_use(path) or is_locked_in_use(
+            self.settings.in_use_marker_for(path)
+        )
+
+    def _evict(self, entry: CacheEntry) -> bool:
+        with self.settings.cache_lock_for(entry.path, cleanup_on_error=False):
+            # It might have been used (or removed) while we were waiting
+            # for the lock.
+            last_used_marker = self.settings.last_used_marker_for(entry.path)
+            if (
+                not entry.path.exists()
+                or (
+                    last_used_marker.exists()
+                    and last_used_marker.stat().st_mtime > entry.last_used
+                )
+                or self._is_in_use(entry.path)
+            ):
+                return False
+
+            shutil.rmtree(entry.path)
+            return True
+
+    def sweep_periodically(self, interval: float, stop_event: threading.Event) -> None:
+        """Run the collection every 'interval' seconds, until the 'stop_event'
+        is set."""
+        while not stop_event.wait(interval):
+            try:
+                evicted = self.collect()
+            except Exception as exc:
+                print(f"Failed to collect the environment cache: {exc!r}")
+                continue
+
+            if evicted:
+                freed_size = sum(entry.size for entry in evicted)
+                print(
+                    f"Evicted {len(evicted)} environment(s) from the cache "
+                    f"({freed_size / 1024 / 1024:.1f} MiB)"
+                )
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cache-dir", type=Path, default=DEFAULT_SETTINGS.cache_dir)
+    parser.add_argument("--max-size", type=parse_size)
+    parser.add_argument("--max-entries", type=int)
+    parser.add_argument(
+        "--grace-period",
+        type=float,
+        default=DEFAULT_GRACE_PERIOD,
+        help="Never evict the environments used in the last N seconds.",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    options = parser.parse_args(argv)
+
+    if options.max_size is None and options.max_entries is None:
+        parser.error("At least one of --max-size or --max-entries is required.")
+
+    manager = CacheManager(
+        settings=DEFAULT_SETTINGS.replace(cache_dir=options.cache_dir),
+        max_size=options.max_size,
+        max_entries=options.max_entries,
+        grace_period=options.grace_period,
+    )
+    for entry in manager.collect(dry_run=options.dry_run):
+        prefix = "Would evict" if options.dry_run else "Evicted"
+        print(f"{prefix} {entry.path} ({entry.size / 1024 / 1024:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
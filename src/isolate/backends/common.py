@@ -1,20 +1,52 @@
 from __future__ import annotations
 
+import codecs
 import errno
 import hashlib
 import os
-import select
+import re
+import selectors
 import shutil
+import stat
 import sysconfig
 import threading
 import time
 from contextlib import contextmanager, suppress
 from dataclasses import dataclass, field
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
 from types import ModuleType
 from typing import Callable, Iterator
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore[assignment]
+
+# Build locks are lock files whose existence is the lock itself. When the
+# platform and the filesystem support it, a kernel advisory lock (flock) is
+# taken on a separate file first, so the waiters block in the kernel and wake up
+# as soon as it is released (or its holder dies). The flock holders still create
+# the lock file, so that the processes which can't use flock see the lock too;
+# those check whether the flock behind such a lock file is still held (instead
+# of relying on its mtime), while keeping their own lock files alive through
+# their mtime, which are revoked once they get older than _REVOKE_LOCK_DELAY.
+_USE_FLOCK = fcntl is not None and os.getenv("ISOLATE_DISABLE_FLOCK") != "1"
+
+# Older versions of isolate don't know about the flock, and revoke all the lock
+# files by their mtime. When the cache is shared with them, the flock holders
+# have to keep their lock files alive as well (with a thread updating the mtime
+# of each lock, like the processes without flock do).
+_LEGACY_LOCK_COMPAT = os.getenv("ISOLATE_LEGACY_LOCK_COMPAT") == "1"
+
+# The content of the lock files that are created by the flock holders.
+_FLOCK_MARKER = b"flock"
+
+# Errors raised by flock() on filesystems that don't support it.
+_FLOCK_UNSUPPORTED_ERRNOS = frozenset(
+    {errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL}
+)
+
 # For ensuring that the lock is created and not forgotten
 # (e.g. the process which acquires it crashes, so it is never
 # released), we are going to check the lock file's mtime every
@@ -28,12 +60,117 @@ def lock_build_path(path: Path, lock_dir: Path) -> Iterator[None]:
     """Try to acquire a lock for all operations on the given 'path'. This guarantees
     that the path will not be modified by any other process while the lock is held."""
     lock_file = (lock_dir / path.name).with_suffix(".lock")
-    while not _try_acquire(lock_file):
-        time.sleep(0.05)
-        continue
+    lock_fd = None
+    if _USE_FLOCK and _supports_flock(lock_dir):
+        lock_fd = _acquire_flock(lock_file.with_suffix(".flock"))
 
-    with _keep_lock_alive(lock_file):
-        yield
+    try:
+        # Once the flock is acquired, the lock file can only be held by a
+        # process that doesn't use flock, so this never waits unless there is
+        # one of those around.
+        while not _try_acquire(lock_file, with_flock=lock_fd is not None):
+            time.sleep(0.05)
+            continue
+
+        if lock_fd is None or _LEGACY_LOCK_COMPAT:
+            with _keep_lock_alive(lock_file):
+                yield
+        else:
+            try:
+                yield
+            finally:
+                lock_file.unlink()
+    finally:
+        if lock_fd is not None:
+            _release_flock(lock_fd)
+
+
+@lru_cache(maxsize=None)
+def _supports_flock(lock_dir: Path) -> bool:
+    """Check whether the filesystem of the given directory supports flock()."""
+    probe_fd = os.open(lock_dir / ".flock-probe", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(probe_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except OSError as exc:
+        if exc.errno in _FLOCK_UNSUPPORTED_ERRNOS:
+            return False
+        # Anything else (e.g. someone holding an exclusive lock on the
+        # probe file) means that flock() itself works.
+        return True
+    else:
+        fcntl.flock(probe_fd, fcntl.LOCK_UN)
+        return True
+    finally:
+        os.close(probe_fd)
+
+
+def _acquire_flock(lock_file: Path) -> int:
+    """Block until an exclusive advisory lock is acquired on the given lock file
+    and return the file descriptor that holds it."""
+    # The lock file itself is never removed, since another process might be
+    # already waiting on it (and removing it would let a third process lock a
+    # new file under the same name at the same time).
+    lock_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(lock_fd)
+        raise
+
+    return lock_fd
+
+
+def _release_flock(lock_fd: int) -> None:
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    finally:
+        os.close(lock_fd)
+
+
+def lock_in_use(in_use_marker: Path) -> int | None:
+    """Take a shared advisory lock on the given in-use marker of an environment,
+    and return the file descriptor that holds it (the lock is held until all the
+    duplicates of it, e.g. the ones inherited by the agent processes, are
+    closed). Returns None if flock() is not available."""
+    if fcntl is None:
+        return None
+
+    try:
+        lock_fd = os.open(in_use_marker, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return None
+
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+    except OSError:
+        os.close(lock_fd)
+        return None
+
+    return lock_fd
+
+
+def is_locked_in_use(in_use_marker: Path) -> bool:
+    """Check whether any process (in the whole system) is holding the lock
+    taken by lock_in_use() on the given in-use marker."""
+    if fcntl is None:
+        return False
+
+    try:
+        probe_fd = os.open(in_use_marker, os.O_RDWR)
+    except OSError:
+        return False
+
+    try:
+        fcntl.flock(probe_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    else:
+        fcntl.flock(probe_fd, fcntl.LOCK_UN)
+        return False
+    finally:
+        os.close(probe_fd)
 
 
 @contextmanager
@@ -56,20 +193,56 @@ def _keep_lock_alive(lock_file: Path) -> Iterator[None]:
         thread.join()
 
 
-def _try_acquire(lock_file: Path) -> bool:
+def _try_acquire(lock_file: Path, with_flock: bool = False) -> bool:
     with suppress(FileNotFoundError):
-        mtime = lock_file.stat().st_mtime
-        if time.time() - mtime > _REVOKE_LOCK_DELAY:
+        if lock_file.read_bytes() == _FLOCK_MARKER and fcntl is not None:
+            # Only the flock holders create these, and they hold the flock for
+            # as long as the lock file exists.
+            if with_flock:
+                # We are holding the flock now, so its owner has died.
+                lock_file.unlink()
+            else:
+                _revoke_flock_lock(lock_file)
+        elif time.time() - lock_file.stat().st_mtime > _REVOKE_LOCK_DELAY:
             # The lock file exists, but it may be stale. Check the
             # mtime and if it is too old, revoke it.
             lock_file.unlink()
 
     try:
-        lock_file.touch(exist_ok=False)
+        lock_fd = os.open(lock_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
     except FileExistsError:
         return False
-    else:
-        return True
+
+    try:
+        if with_flock:
+            os.write(lock_fd, _FLOCK_MARKER)
+    finally:
+        os.close(lock_fd)
+    return True
+
+
+def _revoke_flock_lock(lock_file: Path) -> None:
+    """Remove the given lock file (created by a flock holder) if its flock is not
+    held anymore, i.e. its owner has died before removing it."""
+    try:
+        probe_fd = os.open(lock_file.with_suffix(".flock"), os.O_RDWR)
+    except FileNotFoundError:
+        lock_file.unlink()
+        return None
+
+    try:
+        fcntl.flock(probe_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # Still held (or we can't tell), leave it as is.
+        os.close(probe_fd)
+        return None
+
+    try:
+        # Holding the flock while removing it, so that no one else can
+        # acquire it (and create a new lock file) in the meantime.
+        lock_file.unlink()
+    finally:
+        _release_flock(probe_fd)
 
 
 def get_executable_path(search_path: Path, executable_name: str) -> Path:
@@ -87,75 +260,258 @@ def get_executable_path(search_path: Path, executable_name: str) -> Path:
     return Path(executable_path)
 
 
-_CHECK_FOR_TERMINATION_DELAY = 0.05
 HookT = Callable[[str], None]
 
+_READ_CHUNK_SIZE = 64 * 1024
+
+# Lines longer than this (in bytes) are split into multiple lines, so that
+# a process which never prints a line break can't make us buffer its whole
+# output.
+_MAX_LINE_LENGTH = int(os.getenv("ISOLATE_MAX_LOG_LINE_LENGTH", str(1024 * 1024)))
+
+_LINE_BREAK = re.compile(rb"\r\n|\r|\n")
 
-def _io_observer(
-    hooks: dict[int, HookT],
-    termination_event: threading.Event,
-) -> threading.Thread:
-    """Starts a new thread that reads from the specified file descriptors
-    and calls the bound hook function for each line until the EOF is reached
-    or the termination event is set.
 
-    Caller is responsible for joining the thread.
-    """
+def _make_line_decoder() -> codecs.IncrementalDecoder:
+    return codecs.getincrementaldecoder("utf-8")(errors="backslashreplace")
 
-    followed_fds = list(hooks.keys())
-    for fd in followed_fds:
+
+@dataclass
+class _FollowedStream:
+    hook: HookT
+    max_line_length: int = _MAX_LINE_LENGTH
+    # Held while reading from the file descriptor and calling the hook, so
+    # the lines of a stream are always forwarded in order.
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Set (with the lock held) once the file descriptor is closed.
+    closed: bool = False
+    # Bytes of the line that is not complete yet.
+    _buffer: bytearray = field(default_factory=bytearray)
+    # Offset in the buffer that is already known to have no line breaks.
+    _scan_from: int = 0
+    # Only needed for the lines that are split because of their length, which
+    # might end up in the middle of a multi-byte character.
+    _decoder: codecs.IncrementalDecoder = field(default_factory=_make_line_decoder)
+
+    def forward_lines(self, fd: int, *, flush: bool = False) -> bool:
+        """Read everything that is available on the given (non-blocking) file
+        descriptor and call the hook for each complete line. Returns False
+        when the EOF is reached, in which case the incomplete line is also
+        forwarded (the same happens when 'flush' is set).
+
+        Errors raised by the hook are reported, but they don't stop the
+        rest of the lines from being forwarded."""
+        is_open = True
+        lines: list[str] = []
+        while True:
+            try:
+                chunk = os.read(fd, _READ_CHUNK_SIZE)
+            except BlockingIOError:
+                break
+
+            if not chunk:
+                is_open = False
+                break
+
+            self._buffer += chunk
+            self._split_complete_lines(lines)
+
+        if flush or not is_open:
+            self._split_complete_lines(lines, final=True)
+
+        for line in lines:
+            try:
+                self.hook(line)
+            except Exception as exc:
+                print(f"Failed to forward the output of fd {fd}: {exc!r}")
+        return is_open
+
+    def _split_complete_lines(self, lines: list[str], *, final: bool = False) -> None:
+        buffer = self._buffer
+        line_start = 0
+        for match in _LINE_BREAK.finditer(buffer, self._scan_from):
+            if match.end() == len(buffer) and match.group() == b"\r" and not final:
+                # Might be the first half of a '\r\n'.
+                break
+
+            self._split_line(lines, buffer, line_start, match.start(), final=True)
+            line_start = match.end()
+
+        if final and line_start < len(buffer):
+            self._split_line(lines, buffer, line_start, len(buffer), final=True)
+            line_start = len(buffer)
+
+        while len(buffer) - line_start >= self.max_line_length:
+            line_end = line_start + self.max_line_length
+            self._split_line(lines, buffer, line_start, line_end, final=False)
+            line_start = line_end
+
+        del buffer[:line_start]
+        # Re-check the last byte, in case it is a '\r' we held back.
+        self._scan_from = max(len(buffer) - 1, 0)
+
+    def _split_line(
+        self,
+        lines: list[str],
+        buffer: bytearray,
+        start: int,
+        end: int,
+        *,
+        final: bool,
+    ) -> None:
+        # TODO: parse the lines to include `extra={...}` added by the logger?
+        for line_start in range(start, end, self.max_line_length):
+            line_end = min(line_start + self.max_line_length, end)
+            lines.append(
+                self._decoder.decode(
+                    buffer[line_start:line_end],
+                    final=final and line_end == end,
+                )
+            )
+        if start == end:
+            # An empty line.
+            lines.append(self._decoder.decode(b"", final=final))
+
+
+class _IOObserver:
+    """A single thread that reads from all the followed file descriptors of
+    this process (through epoll/kqueue where available) and calls the bound
+    hook function for each line, until the EOF is reached or the file
+    descriptor is unfollowed.
+
+    The observer's lock only guards the set of followed streams; the hooks
+    are called with the lock of their own stream held, so they never block
+    the streams of the other processes from being (un)followed."""
+
+    def __init__(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        self._streams: dict[int, _FollowedStream] = {}
+        # The write ends of the pipes opened by logged_io(), mapped to the
+        # followed read ends (see drain_logged_io()).
+        self._readers: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+        # Wakes up the observer thread when a new file descriptor is followed,
+        # for the selectors that don't pick up registrations made while they
+        # are waiting.
+        self._wakeup_reader_fd, self._wakeup_writer_fd = _unblocked_pipe()
+        self._selector.register(self._wakeup_reader_fd, selectors.EVENT_READ)
+
+    def follow(self, fd: int, hook: HookT) -> None:
         if os.get_blocking(fd):
             raise NotImplementedError(
                 "All the hooked file descriptors must be non-blocking."
             )
 
-    def forward_lines(fd: int) -> None:
-        hook = hooks[fd]
-        with open(fd, closefd=False, errors="backslashreplace") as stream:
-            # TODO: we probably should pass the real line endings
-            raw_data = stream.read()
-            if not raw_data:
-                return  # Nothing to read
-
-            for line in raw_data.splitlines():
-                # TODO: parse the lines to include `extra={...}` added by the logger?
-                hook(line)
-
-    def _reader():
-        while not termination_event.is_set():
-            # The observed file descriptors may be closed by the
-            # underlying process at any given time. So before we
-            # make a select call, we need to check if the file
-            # descriptors are still valid and remove the ones
-            # that are not.
-            for fd in followed_fds.copy():
-                try:
-                    os.fstat(fd)
-                except OSError as exc:
-                    if exc.errno == errno.EBADF:
-                        followed_fds.remove(fd)
-
-            if not followed_fds:
-                # All the file descriptors are closed, so we can
-                # stop the thread.
-                return
-
-            ready, _, _ = select.select(
-                # rlist=
-                followed_fds,
-                # wlist=
-                [],
-                # xlist=
-                [],
-                # timeout=
-                _CHECK_FOR_TERMINATION_DELAY,
-            )
-            for fd in ready:
-                forward_lines(fd)
+        with self._lock:
+            self._streams[fd] = _FollowedStream(hook)
+            self._selector.register(fd, selectors.EVENT_READ)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._observe,
+                    name="isolate-io-observer",
+                    daemon=True,
+                )
+                self._thread.start()
+
+        with suppress(BlockingIOError):
+            os.write(self._wakeup_writer_fd, b"\0")
+
+    def unfollow(self, fd: int) -> None:
+        """Forward whatever is left on the given file descriptor, and then stop
+        following it. The file descriptor is closed."""
+        with self._lock:
+            stream = self._streams.get(fd)
+
+        if stream is None:
+            # Already reached the EOF (and closed).
+            return None
+
+        with stream.lock:
+            if not stream.closed:
+                stream.forward_lines(fd, flush=True)
+        self._close(fd, stream)
+
+    def link_writers(self, readers: dict[int, int]) -> None:
+        """Associate the write ends of the pipes with their followed read
+        ends, so they can be drained through the write ends."""
+        with self._lock:
+            self._readers.update(readers)
+
+    def unlink_writers(self, readers: dict[int, int]) -> None:
+        with self._lock:
+            for writer_fd in readers:
+                self._readers.pop(writer_fd, None)
+
+    def drain(self, writer_fd: int) -> None:
+        """Forward everything that is written to the pipe with the given write
+        end so far (including the incomplete line, if there is one), without
+        waiting for the observer thread to get to it."""
+        with self._lock:
+            fd = self._readers.get(writer_fd)
+            stream = self._streams.get(fd) if fd is not None else None
+
+        if fd is not None and stream is not None:
+            self._forward(fd, stream, flush=True)
+
+    def _close(self, fd: int, stream: _FollowedStream) -> None:
+        with self._lock:
+            if self._streams.get(fd) is not stream:
+                # Closed already (and the fd might be reused since then).
+                return None
+
+            del self._streams[fd]
+            self._selector.unregister(fd)
+
+        with stream.lock:
+            stream.closed = True
+            os.close(fd)
+
+    def _observe(self) -> None:
+        while True:
+            events = self._selector.select()
+            with self._lock:
+                # It might be unfollowed while we were waiting for the lock.
+                ready_streams = [
+                    (key.fd, self._streams.get(key.fd))
+                    for key, _ in events
+                    if key.fd != self._wakeup_reader_fd
+                ]
+
+            for key, _ in events:
+                if key.fd == self._wakeup_reader_fd:
+                    with suppress(BlockingIOError):
+                        os.read(self._wakeup_reader_fd, _READ_CHUNK_SIZE)
+
+            for fd, stream in ready_streams:
+                if stream is not None:
+                    self._forward(fd, stream)
+
+    def _forward(self, fd: int, stream: _FollowedStream, flush: bool = False) -> None:
+        with stream.lock:
+            if stream.closed:
+                return None
+
+            try:
+                is_open = stream.forward_lines(fd, flush=flush)
+            except Exception as exc:
+                print(f"Failed to forward the output of fd {fd}: {exc!r}")
+                is_open = True
+
+        if not is_open:
+            self._close(fd, stream)
+
+
+@lru_cache(maxsize=None)
+def _get_io_observer() -> _IOObserver:
+    return _IOObserver()
+
 
-    observer_thread = threading.Thread(target=_reader)
-    observer_thread.start()
-    return observer_thread
+if hasattr(os, "register_at_fork"):
+    # The observer thread doesn't survive a fork, so the child needs
+    # to start its own.
+    os.register_at_fork(after_in_child=_get_io_observer.cache_clear)
 
 
 def _unblocked_pipe() -> tuple[int, int]:
@@ -182,27 +538,44 @@ def logged_io(
     stderr_reader_fd, stderr_writer_fd = _unblocked_pipe()
     log_reader_fd, log_writer_fd = _unblocked_pipe()
 
-    termination_event = threading.Event()
-    io_observer = _io_observer(
-        hooks={
-            stdout_reader_fd: stdout_hook,
-            stderr_reader_fd: stderr_hook or stdout_hook,
-            log_reader_fd: log_hook or stdout_hook,
-        },
-        termination_event=termination_event,
-    )
+    io_observer = _get_io_observer()
+    hooks = {
+        stdout_reader_fd: stdout_hook,
+        stderr_reader_fd: stderr_hook or stdout_hook,
+        log_reader_fd: log_hook or stdout_hook,
+    }
+    readers = {
+        stdout_writer_fd: stdout_reader_fd,
+        stderr_writer_fd: stderr_reader_fd,
+        log_writer_fd: log_reader_fd,
+    }
+    for fd, hook in hooks.items():
+        io_observer.follow(fd, hook)
+
+    io_observer.link_writers(readers)
+
     try:
         yield stdout_writer_fd, stderr_writer_fd, log_writer_fd
     finally:
-        termination_event.set()
-        try:
-            # The observer thread checks the termination event in every
-            # _CHECK_FOR_TERMINATION_DELAY seconds. We need to wait at least
-            # more than that to make sure that it has a chance to terminate
-            # properly.
-            io_observer.join(timeout=_CHECK_FOR_TERMINATION_DELAY * 3)
-        except TimeoutError:
-            raise RuntimeError("Log observers did not terminate in time.")
+        io_observer.unlink_writers(readers)
+
+        # The processes we spawned have their own copies of the write ends,
+        # so closing ours doesn't interrupt them.
+        for fd in readers:
+            os.close(fd)
+
+        for fd in hooks:
+            io_observer.unfollow(fd)
+
+
+def drain_logged_io(*fds: int) -> None:
+    """Forward everything that is written to the given streams (opened by
+    logged_io(), and still in use) so far to their hooks. Unlike waiting for
+    the observer thread, this guarantees that none of the output written
+    before the call is still in transit once it returns."""
+    io_observer = _get_io_observer()
+    for fd in fds:
+        io_observer.drain(fd)
 
 
 @lru_cache(maxsize=None)
@@ -221,6 +594,103 @@ def sha256_digest_of(*unique_fields: str | bytes) -> str:
     return hashlib.sha256(inner_text).hexdigest()
 
 
+_STORE_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_digest(path: Path, mode: int) -> str:
+    digest = hashlib.sha256(b"%o\n" % mode)
+    with open(path, "rb") as stream:
+        for chunk in iter(partial(stream.read, _STORE_READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class StoreStats:
+    # Number of files (and their total size) that were linked from
+    # or removed from the store.
+    file_count: int = 0
+    total_size: int = 0
+
+
+def link_into_store(path: Path, store_dir: Path) -> StoreStats:
+    """Deduplicate the files under 'path' through the content addressed store at
+    'store_dir'. Files that are already in the store are replaced with hardlinks
+    to their stored copies, and the new ones are added to the store (so that the
+    next environments can link to them).
+
+    Both directories must be on the same filesystem, otherwise nothing is linked.
+    Linked files share their inode (and their page cache) across all environments
+    so they should be treated as read-only."""
+
+    stats = StoreStats()
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file = Path(root) / file_name
+            try:
+                file_stat = file.lstat()
+            except FileNotFoundError:
+                continue
+
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+                continue
+
+            # Files with the same contents but different permissions can't
+            # share an inode.
+            mode = stat.S_IMODE(file_stat.st_mode)
+            digest = _file_digest(file, mode)
+            stored_file = store_dir / digest[:2] / digest
+            try:
+                stored_stat = stored_file.stat()
+            except FileNotFoundError:
+                stored_file.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(file, stored_file)
+                except FileExistsError:
+                    # Someone else stored it just now, we'll link it next time.
+                    pass
+                except OSError as exc:
+                    if exc.errno == errno.EXDEV:
+                        return stats
+                    raise
+                continue
+
+            if os.path.samestat(file_stat, stored_stat):
+                continue
+
+            temp_file = file.with_name(f".{file_name}.isolate-link")
+            try:
+                os.link(stored_file, temp_file)
+            except FileNotFoundError:
+                # Pruned between the stat call and now.
+                continue
+            except OSError as exc:
+                if exc.errno in (errno.EMLINK, errno.EXDEV):
+                    continue
+                raise
+
+            os.replace(temp_file, file)
+            stats.file_count += 1
+            stats.total_size += file_stat.st_size
+
+    return stats
+
+
+def prune_store(store_dir: Path) -> StoreStats:
+    """Remove the files from the content addressed store at 'store_dir' that
+    are not linked to by any environment anymore."""
+
+    stats = StoreStats()
+    for stored_file in store_dir.glob("*/*"):
+        with suppress(FileNotFoundError):
+            stored_stat = stored_file.stat()
+            if stored_stat.st_nlink == 1:
+                stored_file.unlink()
+                stats.file_count += 1
+                stats.total_size += stored_stat.st_size
+    return stats
+
+
 @dataclass
 class Requirements:
     layers: list[list[str]] = field(default_factory=list)
@@ -131,6 +131,7 @@ class CondaEnvironment(BaseEnvironment[Path]):
         env_path = self.settings.cache_dir_for(self)
         with self.settings.cache_lock_for(env_path):
             if env_path.exists() and not force:
+                self.settings.record_use(env_path)
                 return env_path
 
             self.log(f"Creating the environment at '{env_path}'")
@@ -146,6 +147,7 @@ class CondaEnvironment(BaseEnvironment[Path]):
                         f"Failure during 'conda create': {exc}"
                     )
 
+            self.settings.record_use(env_path)
             self.log(f"New environment cached at '{env_path}'")
             return env_path
 
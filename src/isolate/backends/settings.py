@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import re
 import shutil
 import tempfile
 from contextlib import contextmanager
@@ -19,6 +20,35 @@ if TYPE_CHECKING:
 _SYSTEM_TEMP_DIR = Path(tempfile.gettempdir())
 _STRICT_CACHE = os.getenv("ISOLATE_STRICT_CACHE", "0") == "1"
 JSON_LOGS = os.getenv("ISOLATE_JSON_LOGS", "0") == "1"
+_PACKAGE_STORE = os.getenv("ISOLATE_PACKAGE_STORE", "0") == "1"
+_CACHE_LAYERS = os.getenv("ISOLATE_CACHE_LAYERS", "0") == "1"
+_AGENT_LOG_CAPTURE = os.getenv("ISOLATE_AGENT_LOG_CAPTURE", "0") == "1"
+_INFER_LOG_LEVEL = os.getenv("ISOLATE_INFER_LOG_LEVEL", "1") == "1"
+_AGENT_UNIX_SOCKETS = os.getenv("ISOLATE_AGENT_UNIX_SOCKETS", "0") == "1"
+_AGENT_CONCURRENCY = int(os.getenv("ISOLATE_AGENT_CONCURRENCY", "1"))
+
+# Only the first N characters of a line are checked for the level markers.
+_LEVEL_SCAN_LENGTH = 256
+# Either a line starting with a level name or a level name in brackets
+# anywhere (e.g. "2024-01-01 [ERROR] ..."), in any case.
+_LEVEL_MARKER = re.compile(
+    r"^(error|warn|info|debug|trace)|\[(error|warning|warn|info|debug|trace)\]",
+    re.IGNORECASE | re.ASCII,
+)
+# When there are multiple markers, the first one in this order wins.
+_MARKER_LEVELS = [
+    ("error", LogLevel.ERROR),
+    ("warning", LogLevel.WARNING),
+    ("warn", LogLevel.WARNING),
+    ("info", LogLevel.INFO),
+    ("debug", LogLevel.DEBUG),
+    ("trace", LogLevel.TRACE),
+]
+# Looking up enum members is relatively slow, and the inference runs for
+# every single line of output.
+_STDOUT, _STDERR = LogLevel.STDOUT, LogLevel.STDERR
+_INFO, _TRACE = LogLevel.INFO, LogLevel.TRACE
+_BUILDER, _BRIDGE = LogSource.BUILDER, LogSource.BRIDGE
 
 
 @dataclass(frozen=True)
@@ -28,36 +58,65 @@ class IsolateSettings:
     log_hook: Callable[[Log], None] = print
     strict_cache: bool = _STRICT_CACHE
     json_logs: bool = JSON_LOGS
+    # Share the installed packages across environments through hardlinks to
+    # a content addressed store (see 'package_store_dir').
+    package_store: bool = _PACKAGE_STORE
+    # Cache every prefix of the requirement layers as its own environment, so
+    # that environments sharing their first layers only install the rest.
+    cache_layers: bool = _CACHE_LAYERS
+    # Let the gRPC agents capture the output of the user code themselves and
+    # send it in batches through the Run stream, instead of the stdout/stderr
+    # pipes.
+    agent_log_capture: bool = _AGENT_LOG_CAPTURE
+    # Infer the level of the stdout/stderr logs from their contents. Can be
+    # disabled when the consumer of the logs classifies them on its own.
+    infer_log_level: bool = _INFER_LOG_LEVEL
+    # Talk to the agents through Unix domain sockets (in a private runtime
+    # directory) instead of TCP ports on the loopback interface.
+    agent_unix_sockets: bool = _AGENT_UNIX_SOCKETS
+    # Number of runs a gRPC agent can execute at the same time. The server only
+    # shares an agent between runs when agent_log_capture is enabled, since
+    # otherwise the logs of the runs can't be told apart.
+    agent_concurrency: int = _AGENT_CONCURRENCY
 
     def log(self, log: Log) -> None:
-        self.log_hook(self._infer_log_level(log))
+        if self.infer_log_level:
+            log = self._infer_log_level(log)
+        self.log_hook(log)
 
     def _infer_log_level(self, log: Log) -> Log:
-        """Infer the log level if it's correctly set."""
-        if log.level not in (LogLevel.STDOUT, LogLevel.STDERR):
+        """Infer the log level if it's correctly set. The level of the given log
+        is updated in place."""
+        level = log.level
+        if level is not _STDOUT and level is not _STDERR:
             # We should only infer the log level for stdout/stderr logs.
             return log
 
-        if log.source in (LogSource.BUILDER, LogSource.BRIDGE):
-            return replace(log, level=LogLevel.TRACE)
+        source = log.source
+        if source is _BUILDER or source is _BRIDGE:
+            log.level = _TRACE
+            return log
 
-        line = log.message_str().lower()
+        # Default all to INFO level, even STDERR
+        log.level = _INFO
 
-        if line.startswith("error") or "[error]" in line:
-            return replace(log, level=LogLevel.ERROR)
-        if line.startswith("warning") or "[warning]" in line:
-            return replace(log, level=LogLevel.WARNING)
-        if line.startswith("warn") or "[warn]" in line:
-            return replace(log, level=LogLevel.WARNING)
-        if line.startswith("info") or "[info]" in line:
-            return replace(log, level=LogLevel.INFO)
-        if line.startswith("debug") or "[debug]" in line:
-            return replace(log, level=LogLevel.DEBUG)
-        if line.startswith("trace") or "[trace]" in line:
-            return replace(log, level=LogLevel.TRACE)
+        line = log.message_str() if log.is_json else log.message
+        if len(line) > _LEVEL_SCAN_LENGTH:
+            line = line[:_LEVEL_SCAN_LENGTH]
+        if _LEVEL_MARKER.search(line) is None:
+            return log
 
-        # Default all to INFO level, even STDERR
-        return replace(log, level=LogLevel.INFO)
+        markers = {
+            marker.lower()
+            for match in _LEVEL_MARKER.finditer(line)
+            for marker in match.groups()
+            if marker
+        }
+        for marker, marker_level in _MARKER_LEVELS:
+            if marker in markers:
+                log.level = marker_level
+                break
+        return log
 
     def _get_temp_base(self) -> Path:
         """Return the base path for creating temporary files/directories.
@@ -90,10 +149,19 @@ class IsolateSettings:
         return lock_dir
 
     @contextmanager
-    def cache_lock_for(self, path: Path) -> Iterator[Path]:
+    def cache_lock_for(
+        self,
+        path: Path,
+        *,
+        cleanup_on_error: bool = True,
+    ) -> Iterator[Path]:
         """Create a lock for accessing (and operating on) the given path. This
         means whenever the context manager is entered, the path can be freely
-        modified and accessed without any other process interfering."""
+        modified and accessed without any other process interfering.
+
+        Unless 'cleanup_on_error' is disabled (e.g. when the path is only
+        read), the path is removed if anything goes wrong while the lock
+        is held."""
 
         with lock_build_path(path, self._get_lock_dir()):
             try:
@@ -101,7 +169,8 @@ class IsolateSettings:
             except BaseException:
                 # If anything goes wrong, we have to clean up the
                 # directory (we can't leave it as a corrupted build).
-                shutil.rmtree(path, ignore_errors=True)
+                if cleanup_on_error:
+                    shutil.rmtree(path, ignore_errors=True)
                 raise
 
     def cache_dir_for(self, backend: BaseEnvironment) -> Path:
@@ -117,6 +186,28 @@ class IsolateSettings:
     def completion_marker_for(self, path: Path) -> Path:
         return path / ".isolate.completed"
 
+    def last_used_marker_for(self, path: Path) -> Path:
+        return path / ".isolate.last_used"
+
+    def in_use_marker_for(self, path: Path) -> Path:
+        return path / ".isolate.in_use"
+
+    def record_use(self, path: Path) -> None:
+        """Record that the environment at the given path is being used right now,
+        which is what the cache eviction (see isolate.backends.cache) is based on."""
+        try:
+            self.last_used_marker_for(path).touch()
+        except OSError:
+            pass
+
+    @property
+    def package_store_dir(self) -> Path:
+        """Return the directory of the content addressed store which keeps
+        a single copy of every file installed into the environments."""
+        store_dir = self.cache_dir / "store"
+        store_dir.mkdir(exist_ok=True, parents=True)
+        return store_dir
+
     replace = replace
 
 
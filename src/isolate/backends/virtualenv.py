@@ -6,7 +6,7 @@ import os
 import shutil
 import subprocess
 import sys
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from functools import partial
 from pathlib import Path
 from typing import Any, Callable, ClassVar
@@ -17,6 +17,7 @@ from isolate.backends.common import (
     active_python,
     get_executable,
     get_executable_path,
+    link_into_store,
     logged_io,
     optional_import,
     sha256_digest_of,
@@ -116,6 +117,12 @@ class VirtualPythonEnvironment(BaseEnvironment[Path]):
                 get_executable(_UV_RESOLVER_EXECUTABLE, _UV_RESOLVER_HOME),
                 "pip",
             ]
+            if self.settings.package_store:
+                # uv's cache is already content addressed, so as long as it is on
+                # the same filesystem as the environments it can link the packages
+                # directly instead of copying them.
+                environ.setdefault("UV_CACHE_DIR", str(self.settings.cache_dir / "uv"))
+                environ.setdefault("UV_LINK_MODE", "hardlink")
         else:
             base_pip_cmd = [get_executable_path(path, "pip")]
 
@@ -141,6 +148,95 @@ class VirtualPythonEnvironment(BaseEnvironment[Path]):
             except subprocess.SubprocessError as exc:
                 raise EnvironmentCreationError(f"Failure during 'pip install': {exc}")
 
+    def _create_virtualenv(self, virtualenv: Any, venv_path: Path) -> None:
+        args = [str(venv_path)]
+        if self.python_version:
+            args.append(f"--python={self._decide_python()}")
+
+        # Grab a reference before redirect_stderr replaces sys.stderr,
+        # otherwise printing to sys.stderr inside the callback would recurse.
+        original_stderr = sys.stderr
+
+        def log_stderr(s: str) -> None:
+            self.log(s, level=LogLevel.ERROR)
+            print(s, file=original_stderr)
+
+        # Capture stderr so we can include it in error messages.
+        # It also logs lines in real time.
+        stderr_capture = _LoggedStringIO(log_stderr)
+        try:
+            with contextlib.redirect_stderr(stderr_capture):
+                # This is not an official API, so it can throw anything at us.
+                virtualenv.cli_run(args)
+        except (SystemExit, RuntimeError, OSError) as exc:
+            raise EnvironmentCreationError(
+                f"Failed to create the environment at '{venv_path}': {exc}"
+            )
+
+    def _create_base_layers(self) -> Path:
+        """Create the environment with all the layers of this environment except
+        the last one, and return its path."""
+        base = replace(
+            self,
+            requirements=Requirements(self.requirements.layers[:-1]),
+        )
+        base.apply_settings(self.settings)
+        return base.create()
+
+    def _clone_environment(self, source: Path, destination: Path) -> None:
+        """Copy the virtualenv at 'source' to 'destination', and update the paths
+        that point to the old location."""
+        try:
+            self._copy_environment(source, destination)
+        except OSError as exc:
+            raise EnvironmentCreationError(
+                f"Failed to create the environment at '{destination}' "
+                f"from '{source}': {exc}"
+            )
+
+    def _copy_environment(self, source: Path, destination: Path) -> None:
+        if destination.exists():
+            # E.g. it is re-created with force=True.
+            shutil.rmtree(destination)
+
+        copy_function = os.link if self.settings.package_store else shutil.copy2
+        shutil.copytree(
+            source,
+            destination,
+            symlinks=True,
+            copy_function=copy_function,
+        )
+        self.settings.completion_marker_for(destination).unlink(missing_ok=True)
+        self.settings.last_used_marker_for(destination).unlink(missing_ok=True)
+        self.settings.in_use_marker_for(destination).unlink(missing_ok=True)
+
+        # Virtualenvs are not relocatable, but the only places that refer to
+        # their own path are the config file and the scripts (shebangs,
+        # activation scripts). Compiled modules get their paths fixed up
+        # when they are loaded.
+        old_path, new_path = bytes(source), bytes(destination)
+        for file in [destination / "pyvenv.cfg", *(destination / "bin").iterdir()]:
+            if file.is_symlink() or not file.is_file():
+                continue
+
+            contents = file.read_bytes()
+            if old_path not in contents:
+                continue
+
+            # Write a new file instead of modifying the existing one in place,
+            # since it might be a hardlink to the source.
+            temp_file = file.with_name(f".{file.name}.isolate-clone")
+            temp_file.write_bytes(contents.replace(old_path, new_path))
+            shutil.copymode(file, temp_file)
+            os.replace(temp_file, file)
+
+    def _link_into_store(self, path: Path) -> None:
+        stats = link_into_store(path, self.settings.package_store_dir)
+        self.log(
+            f"Linked {stats.file_count} files "
+            f"({stats.total_size / 1024 / 1024:.1f} MiB) from the package store"
+        )
+
     def _install_python_through_pyenv(self) -> str:
         from isolate.backends.pyenv import PyenvEnvironment
 
@@ -187,37 +283,32 @@ class VirtualPythonEnvironment(BaseEnvironment[Path]):
                     is_cached &= completion_marker.exists()
 
                 if is_cached:
+                    self.settings.record_use(venv_path)
                     return venv_path
 
-            self.log(f"Creating the environment at '{venv_path}'")
-
-            args = [str(venv_path)]
-            if self.python_version:
-                args.append(f"--python={self._decide_python()}")
-
-            # Grab a reference before redirect_stderr replaces sys.stderr,
-            # otherwise printing to sys.stderr inside the callback would recurse.
-            original_stderr = sys.stderr
-
-            def log_stderr(s: str) -> None:
-                self.log(s, level=LogLevel.ERROR)
-                print(s, file=original_stderr)
-
-            # Capture stderr so we can include it in error messages.
-            # It also logs lines in real time.
-            stderr_capture = _LoggedStringIO(log_stderr)
-            try:
-                with contextlib.redirect_stderr(stderr_capture):
-                    # This is not an official API, so it can throw anything at us.
-                    virtualenv.cli_run(args)
-            except (SystemExit, RuntimeError, OSError) as exc:
-                raise EnvironmentCreationError(
-                    f"Failed to create the environment at '{venv_path}': {exc}"
+            layers = self.requirements.layers
+            if self.settings.cache_layers and len(layers) > 1:
+                # Start from the environment that has all the layers except
+                # the last one (which is cached on its own, the same way) and
+                # only install the last layer on top of it.
+                base_path = self._create_base_layers()
+                self.log(
+                    f"Creating the environment at '{venv_path}' from '{base_path}'"
                 )
-
-            for layer in self.requirements.layers:
+                with self.settings.cache_lock_for(base_path, cleanup_on_error=False):
+                    self._clone_environment(base_path, venv_path)
+                layers = layers[-1:]
+            else:
+                self.log(f"Creating the environment at '{venv_path}'")
+                self._create_virtualenv(virtualenv, venv_path)
+
+            for layer in layers:
                 self._install_packages(venv_path, layer)
+
+            if self.settings.package_store:
+                self._link_into_store(venv_path)
             completion_marker.touch()
+            self.settings.record_use(venv_path)
 
         self.log(f"New environment cached at '{venv_path}'")
         return venv_path
@@ -4,6 +4,8 @@ from datetime import datetime, timezone
 
 from google.protobuf.timestamp_pb2 import Timestamp
 
+_NANOS_PER_SECOND = 1_000_000_000
+
 
 def from_datetime(time: datetime) -> Timestamp:
     timestamp = Timestamp()
@@ -13,3 +15,19 @@ def from_datetime(time: datetime) -> Timestamp:
 
 def to_datetime(timestamp: Timestamp) -> datetime:
     return timestamp.ToDatetime(tzinfo=timezone.utc)
+
+
+def from_epoch_ns(epoch_ns: int) -> Timestamp:
+    timestamp = Timestamp()
+    set_epoch_ns(timestamp, epoch_ns)
+    return timestamp
+
+
+def set_epoch_ns(timestamp: Timestamp, epoch_ns: int) -> None:
+    """Set the given timestamp (e.g. the field of an existing message) to the
+    given number of nanoseconds since the epoch, in place."""
+    timestamp.seconds, timestamp.nanos = divmod(epoch_ns, _NANOS_PER_SECOND)
+
+
+def to_epoch_ns(timestamp: Timestamp) -> int:
+    return timestamp.seconds * _NANOS_PER_SECOND + timestamp.nanos
@@ -1,2 +1,5 @@
 from isolate.connections._local import agent_startup  # noqa: F401
-from isolate.connections._local._base import PythonExecutionBase  # noqa: F401
+from isolate.connections._local._base import (  # noqa: F401
+    PythonExecutionBase,
+    agent_socket_path,
+)
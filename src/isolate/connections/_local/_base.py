@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import os
 import re
+import shutil
 import subprocess
 import sysconfig
+import tempfile
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from functools import partial
@@ -17,7 +19,13 @@ from typing import (
 )
 
 from isolate import __version__ as isolate_version
-from isolate.backends.common import active_python, get_executable_path, logged_io
+from isolate.backends.common import (
+    active_python,
+    drain_logged_io,
+    get_executable_path,
+    lock_in_use,
+    logged_io,
+)
 from isolate.backends.settings import JSON_LOGS
 from isolate.connections.common import AGENT_SIGNATURE
 from isolate.logs import LogLevel, LogSource
@@ -82,6 +90,49 @@ def python_path_for(*search_paths: Path) -> str:
     return os.pathsep.join(lib_paths)
 
 
+@contextmanager
+def agent_socket_path() -> Iterator[Path]:
+    """Create a private runtime directory (only accessible by the current user)
+    and return a path for an agent's Unix domain socket inside it. The directory
+    is removed on exit."""
+    # Prefer the user's runtime directory (if there is one) over the
+    # temporary directory, which is usually on a persistent disk.
+    parent_dir = os.getenv("XDG_RUNTIME_DIR")
+    if parent_dir and not os.path.isdir(parent_dir):
+        parent_dir = None
+
+    runtime_dir = tempfile.mkdtemp(prefix="isolate-", dir=parent_dir)
+    try:
+        yield Path(runtime_dir) / "agent.sock"
+    finally:
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+def _render_trie(node: dict[str, dict]) -> str:
+    # An empty key marks the end of a secret. The rest of the branches are
+    # optional there, and since they are greedy the longest secret wins.
+    branches = []
+    for first_char, first_child in sorted(node.items()):
+        if not first_char:
+            continue
+
+        # Walk through the chains of single characters without recursing,
+        # so that long values don't hit the recursion limit.
+        chain, child = [first_char], first_child
+        while len(child) == 1 and "" not in child:
+            [(char, child)] = child.items()
+            chain.append(char)
+        branches.append(re.escape("".join(chain)) + _render_trie(child))
+
+    if not branches:
+        return ""
+
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        pattern = f"(?:{pattern})?"
+    return pattern
+
+
 @dataclass
 class PythonExecutionBase(Generic[ConnectionType]):
     """A generic Python execution implementation that can trigger a new process
@@ -104,6 +155,12 @@ class PythonExecutionBase(Generic[ConnectionType]):
     environment_path: Path
     extra_inheritance_paths: list[Path] = field(default_factory=list)
     json_logs: bool = True
+    _log_patterns: list[re.Pattern] = field(
+        default_factory=list, init=False, repr=False
+    )
+    _log_detector: re.Pattern | None = field(default=None, init=False, repr=False)
+    # The streams that the output of the agent process goes to.
+    _output_fds: tuple[int, ...] = field(default=(), init=False, repr=False)
 
     @contextmanager
     def start_process(
@@ -126,36 +183,81 @@ class PythonExecutionBase(Generic[ConnectionType]):
             python_executable = get_executable_path(self.environment_path, "python")
 
         env = self.get_env_vars()
-        patterns = self._mk_patterns(env)
+        patterns = self._log_patterns = self._mk_patterns(env)
+        detector = self._log_detector = self._mk_combined_pattern(env)
 
         with logged_io(
             partial(
                 self._mask_agent_log,
                 patterns=patterns,
+                detector=detector,
                 source=LogSource.USER,
                 level=LogLevel.STDOUT,
             ),
             partial(
                 self._mask_agent_log,
                 patterns=patterns,
+                detector=detector,
                 source=LogSource.USER,
                 level=LogLevel.STDERR,
             ),
             partial(
                 self._mask_agent_log,
                 patterns=patterns,
+                detector=detector,
                 source=LogSource.BRIDGE,
                 level=LogLevel.TRACE,
             ),
         ) as (stdout, stderr, log_fd):
-            yield subprocess.Popen(
-                self.get_python_cmd(python_executable, connection, log_fd, JSON_LOGS),
-                env=env,
-                stdout=stdout,
-                stderr=stderr,
-                pass_fds=(log_fd,),
-                text=True,
-            )
+            in_use_fds = self._lock_environments()
+            try:
+                process = subprocess.Popen(
+                    self.get_python_cmd(
+                        python_executable, connection, log_fd, JSON_LOGS
+                    ),
+                    env=env,
+                    stdout=stdout,
+                    stderr=stderr,
+                    pass_fds=(log_fd, *in_use_fds),
+                    text=True,
+                )
+            finally:
+                # The agent process holds on to its own copies of the locks,
+                # for as long as it is alive.
+                for in_use_fd in in_use_fds:
+                    os.close(in_use_fd)
+
+            self._output_fds = (stdout, stderr, log_fd)
+            try:
+                yield process
+            finally:
+                self._output_fds = ()
+
+    def drain_agent_output(self) -> None:
+        """Forward everything that the agent process has written to its
+        stdout/stderr (and its log stream) so far to the log hooks, so that
+        none of it is still in transit (e.g. when the result of a call that
+        was made afterwards is received)."""
+        drain_logged_io(*self._output_fds)
+
+    def _lock_environments(self) -> list[int]:
+        """Mark the cached environments that the agent process is going to use
+        as in use, so that they are never evicted from the cache (even by other
+        processes, see isolate.backends.cache) while it is alive. Returns the
+        file descriptors holding the locks, which should be passed to it."""
+        settings = self.environment.settings
+        in_use_fds = []
+        for path in [self.environment_path, *self.extra_inheritance_paths]:
+            try:
+                path.relative_to(settings.cache_dir)
+            except ValueError:
+                # Not a cached environment (e.g. the local one).
+                continue
+
+            in_use_fd = lock_in_use(settings.in_use_marker_for(path))
+            if in_use_fd is not None:
+                in_use_fds.append(in_use_fd)
+        return in_use_fds
 
     def get_env_vars(self) -> dict[str, str]:
         """Return the environment variables to run the agent process with. By default
@@ -206,13 +308,33 @@ class PythonExecutionBase(Generic[ConnectionType]):
         """Return the command to run the agent process with."""
         raise NotImplementedError
 
+    def _secret_values(self, env: dict[str, str]) -> list[str]:
+        # Every envvar except path that's longer than 8 chars (for masking)
+        return [val for key, val in env.items() if len(val) > 8 and key != "PATH"]
+
     # Make regex for each envvar except path that's longer than 8 chars (for masking)
     def _mk_patterns(self, env: dict[str, str]) -> list[re.Pattern]:
-        return [
-            re.compile(re.escape(val))
-            for key, val in env.items()
-            if len(val) > 8 and key != "PATH"
-        ]
+        return [re.compile(re.escape(val)) for val in self._secret_values(env)]
+
+    def _mk_combined_pattern(self, env: dict[str, str]) -> re.Pattern | None:
+        """A single regex that matches any of the secrets, so that the lines
+        without a secret in them (most of them) are only scanned once. The lines
+        that do have one are still masked with each of the _mk_patterns in turn,
+        since the secrets might overlap (and then the order matters).
+
+        The regex is shaped as a trie (secrets sharing a prefix share a branch),
+        rather than an alternation of all the secrets."""
+        secrets = set(self._secret_values(env))
+        if not secrets:
+            return None
+
+        trie: dict[str, dict] = {}
+        for secret in secrets:
+            node = trie
+            for char in secret:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        return re.compile(_render_trie(trie))
 
     def _mask_agent_log(
         self,
@@ -221,13 +343,31 @@ class PythonExecutionBase(Generic[ConnectionType]):
         patterns: list[re.Pattern],
         level: LogLevel,
         source: LogSource,
+        detector: re.Pattern | None = None,
     ) -> None:
-        # We don't mask less than 8 chars.
-        if len(line) > 8:
+        self.handle_agent_log(
+            self._mask(line, patterns, detector),
+            level=level,
+            source=source,
+        )
+
+    def _mask(
+        self,
+        line: str,
+        patterns: list[re.Pattern],
+        detector: re.Pattern | None = None,
+    ) -> str:
+        # We don't mask less than 8 chars. If there is a detector (see
+        # _mk_combined_pattern), the lines it doesn't match are left as is.
+        if len(line) > 8 and (detector is None or detector.search(line)):
             for expr in patterns:
                 line = expr.sub("********", line)
+        return line
 
-        self.handle_agent_log(line, level=level, source=source)
+    def mask_agent_log(self, line: str) -> str:
+        """Mask the secrets in a log line that the agent process sent through
+        some other way than its stdout/stderr (e.g. the gRPC stream)."""
+        return self._mask(line, self._log_patterns, self._log_detector)
 
     def handle_agent_log(
         self, line: str, *, level: LogLevel, source: LogSource
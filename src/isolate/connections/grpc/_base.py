@@ -1,7 +1,7 @@
 import os
 import socket
 import subprocess
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, ContextManager, Iterator, List, Tuple, Union, cast
@@ -13,7 +13,11 @@ from isolate.backends import (
     CallResultType,
     EnvironmentConnection,
 )
-from isolate.connections._local import PythonExecutionBase, agent_startup
+from isolate.connections._local import (
+    PythonExecutionBase,
+    agent_socket_path,
+    agent_startup,
+)
 from isolate.connections.common import serialize_object
 from isolate.connections.grpc import agent, definitions
 from isolate.connections.grpc.configuration import get_default_options
@@ -133,15 +137,25 @@ class LocalPythonGRPC(PythonExecutionBase[str], GRPCExecutionBase):
                 _temp_socket.bind(("", 0))
                 return _temp_socket.getsockname()
 
-        host, port = find_free_port()
-        address = f"{host}:{port}"
-        self._process = None
-        try:
-            with self.start_process(address) as process:
-                self._process = process
-                yield address, grpc.local_channel_credentials()
-        finally:
-            self.abort_agent()
+        with ExitStack() as stack:
+            if self.environment.settings.agent_unix_sockets:
+                socket_path = stack.enter_context(agent_socket_path())
+                address = f"unix:{socket_path}"
+                credentials = grpc.local_channel_credentials(
+                    grpc.LocalConnectionType.UDS
+                )
+            else:
+                host, port = find_free_port()
+                address = f"{host}:{port}"
+                credentials = grpc.local_channel_credentials()
+
+            self._process = None
+            try:
+                with self.start_process(address) as process:
+                    self._process = process
+                    yield address, credentials
+            finally:
+                self.abort_agent()
 
     def abort_agent(self) -> None:
         if self._process is not None:
@@ -181,6 +195,8 @@ class LocalPythonGRPC(PythonExecutionBase[str], GRPCExecutionBase):
         log_fd: int,
         json_logs: bool = False,
     ) -> List[Union[str, Path]]:
+        capture_logs = self.environment.settings.agent_log_capture
+        concurrency = self.environment.settings.agent_concurrency
         return [
             executable,
             agent_startup.__file__,
@@ -189,6 +205,8 @@ class LocalPythonGRPC(PythonExecutionBase[str], GRPCExecutionBase):
             "--log-fd",
             str(log_fd),
             *(["--json-logs"] if json_logs else []),
+            *(["--capture-logs"] if capture_logs else []),
+            *(["--concurrency", str(concurrency)] if concurrency > 1 else []),
         ]
 
     def handle_agent_log(
@@ -17,18 +17,21 @@ import os
 import signal
 import sys
 import threading
+import time
 import traceback
 from argparse import ArgumentParser
+from collections import OrderedDict
 from concurrent import futures
 from dataclasses import dataclass
 from typing import (
     Any,
     AsyncIterator,
     Iterable,
+    Iterator,
     TextIO,
 )
 
-from grpc import StatusCode, aio, local_server_credentials
+from grpc import LocalConnectionType, StatusCode, aio, local_server_credentials
 
 from isolate.connections.grpc.definitions import PartialRunResult
 
@@ -38,6 +41,7 @@ except ImportError:
     agent_version = "UNKNOWN"
 
 from isolate.backends.common import sha256_digest_of
+from isolate.common import timestamp
 from isolate.connections.common import SerializationError, serialize_object
 from isolate.connections.grpc import definitions
 from isolate.connections.grpc.configuration import get_default_options
@@ -45,6 +49,15 @@ from isolate.connections.grpc.interface import from_grpc
 
 IDLE_TIMEOUT_SECONDS = int(os.getenv("ISOLATE_AGENT_IDLE_TIMEOUT_SECONDS", "0"))
 
+# When the logs are captured by the agent (--capture-logs), how often they are
+# sent to the server and the maximum number of logs in a single message.
+AGENT_LOG_FLUSH_INTERVAL = float(os.getenv("ISOLATE_AGENT_LOG_FLUSH_INTERVAL", "0.05"))
+AGENT_LOG_BATCH_SIZE = int(os.getenv("ISOLATE_AGENT_LOG_BATCH_SIZE", "1000"))
+
+# The maximum number of setup function results to keep around (0 for no limit).
+# The least recently used ones are evicted first.
+SETUP_CACHE_MAX_ENTRIES = int(os.getenv("ISOLATE_AGENT_SETUP_CACHE_MAX_ENTRIES", "0"))
+
 isolate_log_context: contextvars.ContextVar[dict[str, Any]] = contextvars.ContextVar(
     "ISOLATE_CONTEXT_VAR_LOG", default={}
 )
@@ -100,8 +113,7 @@ class JsonStdoutProxy:
             for chunk in lines:
                 if chunk.endswith("\n") or chunk.endswith("\r\n"):
                     msg = chunk.rstrip("\r\n")
-                    payload = self._format_record(msg)
-                    out_count += self._u.write(payload + "\n")
+                    out_count += self._emit(msg)
                 else:
                     # Incomplete line: keep buffering
                     new_buf += chunk
@@ -119,14 +131,16 @@ class JsonStdoutProxy:
         buf = getattr(self._local, "buf", "")
         if buf:
             self._local.buf = ""
-            payload = self._format_record(buf)
-            self._u.write(payload + "\n")
+            self._emit(buf)
         self._u.flush()
 
     def writelines(self, lines: list[str]) -> None:
         for line in lines:
             self.write(line)
 
+    def _emit(self, message: str) -> int:
+        return self._u.write(self._format_record(message) + "\n")
+
     def _format_record(self, message: str) -> str:
         record = {
             "line": message,
@@ -151,19 +165,264 @@ class JsonStdoutProxy:
         return self._u.__exit__(exc_type, exc, tb)
 
 
+class LogCapture:
+    """Collects the output of the agent process in memory while a run is
+    active, so that it can be sent to the server in batches through the
+    Run stream instead of the stdout/stderr pipes.
+
+    Only the writes that go through the Python level streams are captured,
+    anything written directly to the file descriptors (e.g. by subprocesses
+    or native extensions) still goes through the pipes. So does everything
+    that is written while no run is active."""
+
+    def __init__(self, json_logs: bool = False):
+        self.json_logs = json_logs
+        # Logs that can't be attributed to a specific run (e.g. the ones written
+        # from threads started by the user code), sent with any active run.
+        self._logs: list[definitions.Log] = []
+        # Logs of the run that is active in the current context, so that the
+        # concurrent runs only send their own logs.
+        self._run_logs: contextvars.ContextVar[list[definitions.Log] | None] = (
+            contextvars.ContextVar("ISOLATE_CONTEXT_VAR_RUN_LOGS", default=None)
+        )
+        self._active_runs = 0
+        self._lock = threading.Lock()
+
+    def capture(
+        self,
+        underlying: Any,
+        *,
+        source: str,
+        level: str,
+    ) -> CapturedStream:
+        return CapturedStream(
+            underlying,
+            self,
+            source=definitions.LogSource.Value(source),
+            level=definitions.LogLevel.Value(level),
+        )
+
+    def add(
+        self,
+        message: str,
+        source: definitions.LogSource.ValueType,
+        level: definitions.LogLevel.ValueType,
+    ) -> bool:
+        """Add a new log, if there is an active run to send it with."""
+        log = definitions.Log(message=message, source=source, level=level)
+        timestamp.set_epoch_ns(log.timestamp, time.time_ns())
+        run_logs = self._run_logs.get()
+        with self._lock:
+            if not self._active_runs:
+                return False
+
+            if run_logs is None:
+                self._logs.append(log)
+            else:
+                run_logs.append(log)
+            return True
+
+    def drain(self, run_logs: list[definitions.Log]) -> Iterator[PartialRunResult]:
+        """Take all the captured logs of the given run (and the ones that don't
+        belong to any run), in batches."""
+        with self._lock:
+            logs, self._logs = self._logs, []
+            logs.extend(run_logs)
+            run_logs.clear()
+
+        for offset in range(0, len(logs), AGENT_LOG_BATCH_SIZE):
+            yield PartialRunResult(
+                is_complete=False,
+                logs=logs[offset : offset + AGENT_LOG_BATCH_SIZE],
+                result=None,
+            )
+
+    async def stream(
+        self,
+        results: AsyncIterator[PartialRunResult],
+    ) -> AsyncIterator[PartialRunResult]:
+        """Pass through the given results, and send the captured logs every
+        AGENT_LOG_FLUSH_INTERVAL seconds as well as before each result (so the
+        logs that were written before a result are always received first)."""
+        run_logs: list[definitions.Log] = []
+        self._run_logs.set(run_logs)
+        with self._lock:
+            self._active_runs += 1
+
+        iterator = results.__aiter__()
+        next_result: asyncio.Future | None = None
+        try:
+            while True:
+                if next_result is None:
+                    next_result = asyncio.ensure_future(iterator.__anext__())
+
+                done, _ = await asyncio.wait(
+                    [next_result], timeout=AGENT_LOG_FLUSH_INTERVAL
+                )
+                for batch in self.drain(run_logs):
+                    yield batch
+
+                if not done:
+                    continue
+
+                try:
+                    result = next_result.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_result = None
+
+                yield result
+        finally:
+            if next_result is not None:
+                next_result.cancel()
+
+            with self._lock:
+                self._active_runs -= 1
+
+
+class CapturedStream(JsonStdoutProxy):
+    """A stream whose lines are added to a LogCapture (when possible)."""
+
+    def __init__(
+        self,
+        underlying: Any,
+        log_capture: LogCapture,
+        *,
+        source: definitions.LogSource.ValueType,
+        level: definitions.LogLevel.ValueType,
+    ):
+        super().__init__(underlying)
+        self._log_capture = log_capture
+        self._source = source
+        self._level = level
+
+    def _emit(self, message: str) -> int:
+        if self._log_capture.json_logs:
+            record = self._format_record(message)
+        else:
+            record = message
+
+        if self._log_capture.add(record, self._source, self._level):
+            return len(message) + 1
+
+        # No active run, let it go through the pipe as usual.
+        return self._u.write(record + "\n")
+
+
+class SetupCache:
+    """Results of the setup functions, keyed by the digest of their definitions.
+
+    When there are more than max_entries results (if it is set), the least
+    recently used ones are evicted. The results that are still used by a
+    run are never evicted, so the cache might temporarily exceed the limit
+    until they are released."""
+
+    def __init__(self, max_entries: int = 0):
+        if max_entries < 0:
+            raise ValueError("max_entries can't be negative.")
+
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results: OrderedDict[str, Any] = OrderedDict()
+        self._users: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._results
+
+    def lookup(self, key: str) -> tuple[bool, Any]:
+        """Return whether there is a result for the given key and the result
+        itself. If there is, it must be released once the run is done with it."""
+        if key not in self._results:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        self._results.move_to_end(key)
+        self._users[key] += 1
+        return True, self._results[key]
+
+    def add(self, key: str, result: Any) -> tuple[Any, list[Any]]:
+        """Store the result for the given key and return the stored result along
+        with the evicted ones. The stored result must be released once the run
+        is done with it.
+
+        If there already is a result for the key (e.g. from a concurrent run),
+        it is kept and returned instead, and the given one should be torn down
+        by the caller."""
+        if key in self._results:
+            self._results.move_to_end(key)
+        else:
+            self._results[key] = result
+            self._users[key] = 0
+
+        self._users[key] += 1
+        return self._results[key], self._evict()
+
+    def release(self, key: str) -> list[Any]:
+        """Release a result that was returned by lookup() or add(), and
+        return the results that are evicted as a consequence."""
+        self._users[key] -= 1
+        return self._evict()
+
+    def _evict(self) -> list[Any]:
+        if not self.max_entries:
+            return []
+
+        evicted = []
+        for key in list(self._results):
+            if len(self._results) <= self.max_entries:
+                break
+
+            if self._users[key]:
+                continue
+
+            evicted.append(self._results.pop(key))
+            del self._users[key]
+            self.evictions += 1
+        return evicted
+
+    def describe(self) -> str:
+        limit = self.max_entries or "unlimited"
+        return (
+            f"{len(self)}/{limit} entries, {self.hits} hits, "
+            f"{self.misses} misses, {self.evictions} evictions"
+        )
+
+
 @dataclass
 class AbortException(Exception):
     message: str
 
 
 class AgentServicer(definitions.AgentServicer):
-    def __init__(self, log_file: TextIO | None = None):
+    def __init__(
+        self,
+        log_file: TextIO | None = None,
+        log_capture: LogCapture | None = None,
+        concurrency: int = 1,
+        setup_cache_max_entries: int = SETUP_CACHE_MAX_ENTRIES,
+    ):
         super().__init__()
 
-        self._run_cache: dict[str, Any] = {}
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+
+        self._run_cache = SetupCache(max_entries=setup_cache_max_entries)
+        self._log_capture = log_capture
         self._log = log_file if log_file is not None else sys.stdout
-        self._thread_pool = futures.ThreadPoolExecutor(max_workers=1)
+        # Number of runs that can be executed at the same time. The functions
+        # marked with _run_on_main_thread are interleaved on the event loop,
+        # the rest get a thread each.
+        self._concurrency = concurrency
+        self._thread_pool = futures.ThreadPoolExecutor(max_workers=concurrency)
         self._idle_timeout_seconds = IDLE_TIMEOUT_SECONDS
+        self._active_runs = 0
         self._is_running = asyncio.Event()
         self._is_idle = asyncio.Event()
         self._is_idle.set()
@@ -208,14 +467,21 @@ class AgentServicer(definitions.AgentServicer):
         request: definitions.FunctionCall,
         context: aio.ServicerContext,
     ) -> AsyncIterator[PartialRunResult]:
+        self._active_runs += 1
         self._is_idle.clear()
         self._is_running.set()
+        results = self._Run(request, context)
+        if self._log_capture is not None:
+            results = self._log_capture.stream(results)
+
         try:
-            async for result in self._Run(request, context):
+            async for result in results:
                 yield result
         finally:
-            self._is_running.clear()
-            self._is_idle.set()
+            self._active_runs -= 1
+            if not self._active_runs:
+                self._is_running.clear()
+                self._is_idle.set()
 
     async def _Run(
         self,
@@ -227,12 +493,22 @@ class AgentServicer(definitions.AgentServicer):
         self.log(f"Isolate info: server {server_version}, agent {agent_version}")
 
         extra_args = []
+        cache_key = None
         if request.HasField("setup_func"):
             cache_key = sha256_digest_of(
                 request.setup_func.definition,
                 request.setup_func.method,
             )
-            if cache_key not in self._run_cache:
+            is_cached, setup_result = self._run_cache.lookup(cache_key)
+            if is_cached:
+                self.log(
+                    f"Using the cached setup result ({self._run_cache.describe()})."
+                )
+            else:
+                self.log(
+                    "No cached setup result, running the setup function "
+                    f"({self._run_cache.describe()})."
+                )
                 try:
                     (
                         result,
@@ -259,9 +535,13 @@ class AgentServicer(definitions.AgentServicer):
                     return
                 else:
                     assert not was_it_raised
-                    self._run_cache[cache_key] = result
+                    setup_result, evicted = self._run_cache.add(cache_key, result)
+                    if setup_result is not result:
+                        # A concurrent run has stored its own result first.
+                        await self.teardown_setup_results([result], evicted=False)
+                    await self.teardown_setup_results(evicted)
 
-            extra_args.append(self._run_cache[cache_key])
+            extra_args.append(setup_result)
 
         try:
             result, was_it_raised, stringized_tb = await self.execute_function(
@@ -278,6 +558,52 @@ class AgentServicer(definitions.AgentServicer):
         except AbortException as exc:
             self.abort_with_msg(context, exc.message)
             return
+        finally:
+            if cache_key is not None:
+                # Don't hold on to the setup result while it's being torn down.
+                del extra_args[:]
+                await self.teardown_setup_results(self._run_cache.release(cache_key))
+
+    async def teardown_setup_results(
+        self, results: list[Any], evicted: bool = True
+    ) -> None:
+        """Call the teardown hooks (the _isolate_teardown methods, if there are
+        any) of the setup results that were evicted from the cache (or, when
+        'evicted' is not set, that were never stored in it because a concurrent
+        run has stored its own first). The errors are logged rather than failing
+        the run."""
+        kind = "an evicted" if evicted else "a duplicate"
+        if results and evicted:
+            self.log(
+                f"Evicted {len(results)} setup result(s) from the cache "
+                f"({self._run_cache.describe()})."
+            )
+        elif results:
+            self.log(
+                f"Discarded {len(results)} duplicate setup result(s), the cached "
+                "one is used instead."
+            )
+
+        while results:
+            teardown = getattr(results.pop(), "_isolate_teardown", None)
+            if not callable(teardown):
+                continue
+
+            try:
+                if getattr(teardown, "_run_on_main_thread", False):
+                    outcome = teardown()
+                else:
+                    outcome = await asyncio.wrap_future(
+                        self._thread_pool.submit(teardown)
+                    )
+
+                if asyncio.iscoroutine(outcome):
+                    await outcome
+            except Exception:
+                self.log(traceback.format_exc())
+                self.log(f"The teardown of {kind} setup result has failed.")
+            finally:
+                del teardown
 
     async def execute_function(
         self,
@@ -322,6 +648,20 @@ class AgentServicer(definitions.AgentServicer):
 
             if getattr(function, "_run_on_main_thread", False):
                 result = function(*extra_args)
+            elif self._concurrency > 1:
+                # Each run gets a copy of its own context (rather than the one
+                # left in the thread by a previous run), so that the contextvars
+                # like isolate_log_context don't leak between concurrent runs.
+                context = contextvars.copy_context()
+                result = await asyncio.wrap_future(
+                    self._thread_pool.submit(context.run, function, *extra_args)
+                )
+            elif self._log_capture is not None:
+                # Keep the event loop free, so that the captured logs can be
+                # sent while the function is running.
+                result = await asyncio.wrap_future(
+                    self._thread_pool.submit(function, *extra_args)
+                )
             else:
                 result = self._thread_pool.submit(function, *extra_args).result()
 
@@ -395,27 +735,34 @@ class AgentServicer(definitions.AgentServicer):
         return None
 
 
-def create_server(address: str) -> aio.Server:
+def create_server(address: str, concurrency: int = 1) -> aio.Server:
     """Create a new (temporary) gRPC server listening on the given
     address."""
     # Use asyncio server so requests can run in the main thread and intercept signals
     # There seems to be a weird bug with grpcio that makes subsequent requests fail with
-    # concurrent rpc limit exceeded if we set maximum_current_rpcs to 1. Setting it to 2
-    # fixes it, even though in practice, we only run one request at a time.
+    # concurrent rpc limit exceeded if we set maximum_current_rpcs to the number of
+    # requests we run at a time. Allowing one more than that fixes it.
     server = aio.server(
-        maximum_concurrent_rpcs=2,
+        maximum_concurrent_rpcs=concurrency + 1,
         options=get_default_options(),
     )
 
     # Local server credentials allow us to ensure that the
     # connection is established by a local process.
-    server_credentials = local_server_credentials()
+    if address.startswith("unix:"):
+        server_credentials = local_server_credentials(LocalConnectionType.UDS)
+    else:
+        server_credentials = local_server_credentials()
     server.add_secure_port(address, server_credentials)
     return server
 
 
 async def run_agent(
-    address: str, log_fd: int | None = None, json_logs: bool = False
+    address: str,
+    log_fd: int | None = None,
+    json_logs: bool = False,
+    capture_logs: bool = False,
+    concurrency: int = 1,
 ) -> int:
     """Run the agent servicer on the given address."""
     # Determine the base log file
@@ -424,14 +771,31 @@ async def run_agent(
     else:
         log_file = os.fdopen(log_fd, "w")
 
-    # Apply JSON wrapper if requested
-    if json_logs:
+    log_capture = None
+    if capture_logs:
+        # The captured streams take care of the JSON formatting themselves.
+        log_capture = LogCapture(json_logs=json_logs)
+        sys.stdout = log_capture.capture(  # type: ignore[assignment]
+            sys.__stdout__, source="USER", level="STDOUT"
+        )
+        sys.stderr = log_capture.capture(  # type: ignore[assignment]
+            sys.__stderr__, source="USER", level="STDERR"
+        )
+        log_file = log_capture.capture(  # type: ignore[assignment]
+            log_file, source="BRIDGE", level="TRACE"
+        )
+    elif json_logs:
+        # Apply JSON wrapper if requested
         sys.stdout = JsonStdoutProxy(sys.__stdout__)  # type: ignore[assignment]
         sys.stderr = JsonStdoutProxy(sys.__stderr__)  # type: ignore[assignment]
         log_file = JsonStdoutProxy(log_file)  # type: ignore[assignment]
 
-    server = create_server(address)
-    servicer = AgentServicer(log_file=log_file)
+    server = create_server(address, concurrency=concurrency)
+    servicer = AgentServicer(
+        log_file=log_file,
+        log_capture=log_capture,
+        concurrency=concurrency,
+    )
 
     # This function just calls some methods on the server
     # and register a generic handler for the bridge. It does
@@ -459,10 +823,16 @@ async def main() -> int:
     parser.add_argument("address", type=str)
     parser.add_argument("--log-fd", type=int)
     parser.add_argument("--json-logs", action="store_true", default=False)
+    parser.add_argument("--capture-logs", action="store_true", default=False)
+    parser.add_argument("--concurrency", type=int, default=1)
 
     options = parser.parse_args()
     return await run_agent(
-        options.address, log_fd=options.log_fd, json_logs=options.json_logs
+        options.address,
+        log_fd=options.log_fd,
+        json_logs=options.json_logs,
+        capture_logs=options.capture_logs,
+        concurrency=options.concurrency,
     )
 
 
@@ -2,13 +2,24 @@
 and the Isolate Server to share."""
 
 import functools
-from typing import Any, Optional
+from typing import Any, List, Optional
 
 from isolate.common import timestamp
 from isolate.connections.common import load_serialized_object, serialize_object
 from isolate.connections.grpc import definitions
 from isolate.logs import Log, LogLevel, LogSource
 
+# Resolving the enum values through their names (both on the Python and the
+# protobuf side) is surprisingly slow for something done for every log line.
+_LOG_SOURCE_TO_GRPC = {
+    source: definitions.LogSource.Value(source.name.upper()) for source in LogSource
+}
+_LOG_LEVEL_TO_GRPC = {
+    level: definitions.LogLevel.Value(level.name.upper()) for level in LogLevel
+}
+_LOG_SOURCE_FROM_GRPC = {value: source for source, value in _LOG_SOURCE_TO_GRPC.items()}
+_LOG_LEVEL_FROM_GRPC = {value: level for level, value in _LOG_LEVEL_TO_GRPC.items()}
+
 
 @functools.singledispatch
 def from_grpc(message: definitions.Message) -> Any:
@@ -36,24 +47,41 @@ def _(message: definitions.SerializedObject) -> Any:
 
 @from_grpc.register
 def _(message: definitions.Log) -> Log:
-    source = LogSource(definitions.LogSource.Name(message.source).lower())
-    level = LogLevel[definitions.LogLevel.Name(message.level).upper()]
     return Log(
         message=message.message,
-        source=source,
-        level=level,
-        timestamp=timestamp.to_datetime(message.timestamp),
+        source=_LOG_SOURCE_FROM_GRPC[message.source],
+        level=_LOG_LEVEL_FROM_GRPC[message.level],
+        timestamp_ns=timestamp.to_epoch_ns(message.timestamp),
     )
 
 
 @to_grpc.register
 def _(obj: Log) -> definitions.Log:
-    return definitions.Log(
+    grpc_log = definitions.Log(
         message=obj.message_str(),
-        source=definitions.LogSource.Value(obj.source.name.upper()),
-        level=definitions.LogLevel.Value(obj.level.name.upper()),
-        timestamp=timestamp.from_datetime(obj.timestamp),
+        source=_LOG_SOURCE_TO_GRPC[obj.source],
+        level=_LOG_LEVEL_TO_GRPC[obj.level],
     )
+    timestamp.set_epoch_ns(grpc_log.timestamp, obj.timestamp_ns)
+    return grpc_log
+
+
+def logs_to_grpc(logs: List[Log]) -> List[definitions.Log]:
+    """Convert the given logs into gRPC messages, in bulk (without going
+    through the dispatch of to_grpc for each of them)."""
+    make_log, set_epoch_ns = definitions.Log, timestamp.set_epoch_ns
+    sources, levels = _LOG_SOURCE_TO_GRPC, _LOG_LEVEL_TO_GRPC
+
+    grpc_logs = []
+    for log in logs:
+        grpc_log = make_log(
+            message=log.message_str() if log.is_json else log.message,
+            source=sources[log.source],
+            level=levels[log.level],
+        )
+        set_epoch_ns(grpc_log.timestamp, log.timestamp_ns)
+        grpc_logs.append(grpc_log)
+    return grpc_logs
 
 
 def to_serialized_object(
@@ -2,17 +2,20 @@ from __future__ import annotations
 
 import base64
 import importlib
+import os
 import subprocess
-import time
+import threading
 from contextlib import ExitStack, closing
-from dataclasses import dataclass
-from multiprocessing.connection import Connection, Listener
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection, Listener, wait
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     ContextManager,
+    Optional,
+    Tuple,
 )
 
 from isolate.backends import (
@@ -20,7 +23,11 @@ from isolate.backends import (
     CallResultType,
     EnvironmentConnection,
 )
-from isolate.connections._local import PythonExecutionBase, agent_startup
+from isolate.connections._local import (
+    PythonExecutionBase,
+    agent_socket_path,
+    agent_startup,
+)
 from isolate.connections.common import prepare_exc
 from isolate.connections.ipc import agent
 from isolate.logs import LogLevel, LogSource
@@ -68,9 +75,29 @@ def loadserialization_method(backend_name: str) -> Any:
     return importlib.import_module(backend_name)
 
 
-def encode_service_address(address: tuple[str, int]) -> str:
-    host, port = address
-    return base64.b64encode(f"{host}:{port}".encode()).decode("utf-8")
+def encode_service_address(address: tuple[str, int] | str) -> str:
+    if isinstance(address, str):
+        # The path of a Unix domain socket.
+        raw_address = f"unix:{address}"
+    else:
+        host, port = address
+        raw_address = f"{host}:{port}"
+    return base64.b64encode(raw_address.encode()).decode("utf-8")
+
+
+def _open_pidfd(process: subprocess.Popen) -> int | None:
+    """Return a file descriptor that becomes readable once the given process
+    exits, or None if it isn't supported by the platform (it requires Linux 5.3+
+    and Python 3.9+)."""
+    pidfd_open = getattr(os, "pidfd_open", None)
+    if pidfd_open is None or process.returncode is not None:
+        # If the process is already reaped, its PID might have been reused.
+        return None
+
+    try:
+        return pidfd_open(process.pid)
+    except OSError:
+        return None
 
 
 @dataclass
@@ -79,12 +106,52 @@ class IsolatedProcessConnection(EnvironmentConnection):
     in a separated process.
 
     Each implementation needs to define a start_process method to
-    spawn the agent."""
+    spawn the agent.
 
-    # The amount of seconds to wait before checking whether the
-    # isolated process has exited or not.
+    When used as a context manager, the agent process (and the bridge
+    to it) is kept alive between the run() calls and only shut down
+    when the context is exited (or close() is called). Otherwise each
+    run() call spawns its own agent."""
+
+    # The amount of seconds to wait for the result before checking whether the
+    # isolated process has exited or not (when the exit can't be awaited).
     _DEFER_THRESHOLD = 0.25
 
+    # The amount of seconds to wait for the agent to exit on its own
+    # after the bridge is closed, before terminating it.
+    _SHUTDOWN_TIMEOUT = 5
+
+    _keep_agent: bool = field(default=False, init=False, repr=False)
+    _agent: Optional[Tuple[ExitStack, subprocess.Popen, Connection]] = field(
+        default=None, init=False, repr=False
+    )
+    # Serializes the run() calls that share the kept-alive agent, since the
+    # bridge can only carry one executable at a time.
+    _agent_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __enter__(self) -> IsolatedProcessConnection:
+        self._keep_agent = True
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._keep_agent = False
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the agent process that is kept alive between the run()
+        calls (if there is one)."""
+        with self._agent_lock:
+            self._close_agent()
+
+    def _close_agent(self) -> None:
+        # Must be called with the _agent_lock held.
+        if self._agent is not None:
+            stack, _, _ = self._agent
+            self._agent = None
+            stack.close()
+
     def start_process(
         self,
         connection: AgentListener,
@@ -100,60 +167,122 @@ class IsolatedProcessConnection(EnvironmentConnection):
         *args: Any,
         **kwargs: Any,
     ) -> CallResultType:  # type: ignore[type-var]
-        """Spawn an agent process using the given environment, run the given
-        `executable` in that process, and return the result object back."""
-
-        with ExitStack() as stack:
-            # IPC flow is the following:
-            #  1. [controller]: Create the socket server
-            #  2. [controller]: Spawn the call agent with the socket address
-            #  3.      [agent]: Connect to the socket server
-            #  4. [controller]: Accept the incoming connection request
-            #  5. [controller]: Send the executable over the established bridge
-            #  6.      [agent]: Receive the executable from the bridge
-            #  7.      [agent]: Execute the executable and once done send the result
-            #                   back
-            #  8. [controller]: Loop until either the isolated process exits or sends
-            #                   any data (will be interpreted as a tuple of two
-            #                   mutually exclusive objects, either a result object or
-            #                   an exception to be raised).
-            #
-
-            self.log("Starting the controller bridge.")
-            controller_service = stack.enter_context(
-                AgentListener(
-                    self.environment.settings.serialization_method,
-                    family="AF_INET",
+        """Run the given `executable` in an agent process spawned with the
+        given environment, and return the result object back."""
+
+        # IPC flow is the following:
+        #  1. [controller]: Create the socket server
+        #  2. [controller]: Spawn the call agent with the socket address
+        #  3.      [agent]: Connect to the socket server
+        #  4. [controller]: Accept the incoming connection request
+        #  5. [controller]: Send the executable over the established bridge
+        #  6.      [agent]: Receive the executable from the bridge
+        #  7.      [agent]: Execute the executable and once done send the result
+        #                   back
+        #  8. [controller]: Loop until either the isolated process exits or sends
+        #                   any data (will be interpreted as a tuple of two
+        #                   mutually exclusive objects, either a result object or
+        #                   an exception to be raised).
+        #  9.      [agent]: Go back to step 6 until the bridge is closed.
+        #
+        # Steps 1-4 only happen once for all the run() calls that are made while
+        # the connection is used as a context manager.
+
+        assert not (args or kwargs), "run() should not receive any arguments."
+        if not self._keep_agent:
+            with ExitStack() as stack:
+                isolated_process, established_connection = self._start_agent(stack)
+                return self._unpack_result(
+                    *self._run_in_agent(
+                        isolated_process, established_connection, executable
+                    )
                 )
-            )
 
-            self.log(
-                f"Controller server is listening at {controller_service.address}."
-                " Attempting to start the agent process."
-            )
-            assert not (args or kwargs), "run() should not receive any arguments."
-            isolated_process = stack.enter_context(
-                self.start_process(controller_service, *args, **kwargs)
-            )
+        with self._agent_lock:
+            if self._agent is not None and self._agent[1].poll() is not None:
+                # The agent has exited (e.g. the previous executable has
+                # killed it), so we need to spawn a new one.
+                self._close_agent()
+
+            if self._agent is None:
+                stack = ExitStack()
+                try:
+                    self._agent = (stack, *self._start_agent(stack))
+                except BaseException:
+                    stack.close()
+                    raise
+
+            _, isolated_process, established_connection = self._agent
+            try:
+                outcome = self._run_in_agent(
+                    isolated_process, established_connection, executable
+                )
+            except BaseException:
+                # We can't tell what state the bridge is in (e.g. the result
+                # of this executable might still arrive), so start from
+                # scratch on the next call.
+                self._close_agent()
+                raise
+
+        return self._unpack_result(*outcome)
+
+    def _start_agent(self, stack: ExitStack) -> tuple[subprocess.Popen, Connection]:
+        """Start the agent process and establish the bridge to it. Both
+        of them are shut down when the given stack is closed."""
+
+        self.log("Starting the controller bridge.")
+        if self.environment.settings.agent_unix_sockets:
+            socket_path = stack.enter_context(agent_socket_path())
+            listener_options = {"family": "AF_UNIX", "address": str(socket_path)}
+        else:
+            listener_options = {"family": "AF_INET"}
 
-            # TODO(fix): this might hang if the agent process crashes before it can
-            # connect to the controller bridge.
-            self.log(
-                f"Awaiting agent process of {isolated_process.pid}"
-                " to establish a connection."
-            )
-            established_connection = stack.enter_context(
-                closing(controller_service.accept())
+        controller_service = stack.enter_context(
+            AgentListener(
+                self.environment.settings.serialization_method,
+                **listener_options,
             )
+        )
+
+        self.log(
+            f"Controller server is listening at {controller_service.address}."
+            " Attempting to start the agent process."
+        )
+        isolated_process = stack.enter_context(self.start_process(controller_service))
+        stack.callback(self._stop_agent, isolated_process)
+
+        # TODO(fix): this might hang if the agent process crashes before it can
+        # connect to the controller bridge.
+        self.log(
+            f"Awaiting agent process of {isolated_process.pid}"
+            " to establish a connection."
+        )
+        established_connection = stack.enter_context(
+            closing(controller_service.accept())
+        )
 
-            self.log("Bridge between controller and the agent has been established.")
-            established_connection.send(executable)
+        self.log("Bridge between controller and the agent has been established.")
+        return isolated_process, established_connection
 
-            self.log("Executable has been sent, awaiting execution result.")
-            return self.poll_until_result(
-                isolated_process,
-                established_connection,
-            )
+    def _stop_agent(self, process: subprocess.Popen) -> None:
+        # The agent exits as soon as the bridge is closed, unless
+        # it is still busy with something.
+        try:
+            process.wait(timeout=self._SHUTDOWN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.log("Agent process didn't exit in time, terminating it.")
+            process.kill()
+            process.wait()
+
+    def _run_in_agent(
+        self,
+        process: subprocess.Popen,
+        connection: Connection,
+        executable: BasicCallable,
+    ) -> tuple[Any, bool, str | None]:
+        connection.send(executable)
+        self.log("Executable has been sent, awaiting execution result.")
+        return self._receive_result(process, connection)
 
     def poll_until_result(
         self,
@@ -162,33 +291,54 @@ class IsolatedProcessConnection(EnvironmentConnection):
     ) -> CallResultType:  # type: ignore[type-var]
         """Take the given process, and poll until either it exits or returns
         a result object."""
+        return self._unpack_result(*self._receive_result(process, connection))
 
-        while not connection.poll():
-            # Normally, if we do connection.read() without having this loop
-            # it is going to block us indefinitely (even if the underlying
-            # process has crashed). We can use a combination of process.poll
-            # and connection.poll to check if the process is alive and has data
-            # to move forward.
-            if process.poll():
-                break
-
-            # For preventing busy waiting, we can sleep for a bit
-            # and let other threads run.
-            time.sleep(self._DEFER_THRESHOLD)
-            continue
-
-        if not connection.poll():
-            # If the process has exited but there is still no data, we
-            # can assume something terrible has happened.
-            raise OSError(
-                "The isolated process has exited unexpectedly with code "
-                f"'{process.poll()}' without sending any data back."
-            )
-
-        # TODO(fix): handle EOFError that might happen here (e.g. problematic
-        # serialization might cause it).
-        result, did_it_raise, stringized_traceback = connection.recv()
+    def _receive_result(
+        self,
+        process: subprocess.Popen,
+        connection: Connection,
+    ) -> tuple[Any, bool, str | None]:
+        # Normally, if we do connection.recv() without waiting for the data first
+        # it is going to block us indefinitely (even if the underlying process has
+        # crashed). So we wait until either the connection has data or the process
+        # exits, whichever comes first.
+        pidfd = _open_pidfd(process)
+        try:
+            while not connection.poll() and process.poll() is None:
+                # Without a pidfd we can't get woken up when the process exits,
+                # so we have to check it from time to time.
+                wait(
+                    [connection] if pidfd is None else [connection, pidfd],
+                    timeout=self._DEFER_THRESHOLD if pidfd is None else None,
+                )
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+
+        if connection.poll():
+            try:
+                return connection.recv()
+            except EOFError:
+                # The process has closed its end of the bridge (most probably
+                # by exiting) while we were waiting for the result.
+                try:
+                    process.wait(timeout=self._SHUTDOWN_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    pass
+
+        # If the process has exited but there is still no data, we
+        # can assume something terrible has happened.
+        raise OSError(
+            "The isolated process has exited unexpectedly with code "
+            f"'{process.poll()}' without sending any data back."
+        )
 
+    def _unpack_result(
+        self,
+        result: Any,
+        did_it_raise: bool,
+        stringized_traceback: str | None,
+    ) -> CallResultType:  # type: ignore[type-var]
         if did_it_raise:
             raise prepare_exc(result, stringized_traceback=stringized_traceback)
         else:
@@ -205,7 +355,6 @@ class PythonIPC(PythonExecutionBase[AgentListener], IsolatedProcessConnection):
         log_fd: int,
         json_logs: bool = False,
     ) -> list[str | Path]:
-        assert isinstance(connection.address, tuple)
         return [
             executable,
             agent_startup.__file__,
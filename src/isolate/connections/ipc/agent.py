@@ -6,7 +6,7 @@
 #   3. Receive a callable object from the bridge
 #   4. Execute the callable object
 #   5. Send the result back to the bridge
-#   6. Exit
+#   6. Go back to step 3 until the bridge is closed by the controller, then exit
 #
 # Up until to point 4, the agent process has no way of transmitting information
 # to the controller so it should use the stderr/stdout channels appropriately. After
@@ -49,13 +49,18 @@ else:
     from multiprocessing.connection import ConnectionWrapper
 
 
-def decode_service_address(address: str) -> tuple[str, int]:
-    host, port = base64.b64decode(address).decode("utf-8").rsplit(":", 1)
+def decode_service_address(address: str) -> tuple[str, int] | str:
+    raw_address = base64.b64decode(address).decode("utf-8")
+    if raw_address.startswith("unix:"):
+        # The path of a Unix domain socket.
+        return raw_address[len("unix:") :]
+
+    host, port = raw_address.rsplit(":", 1)
     return host, int(port)
 
 
 def child_connection(
-    serialization_method: str, address: tuple[str, int]
+    serialization_method: str, address: tuple[str, int] | str
 ) -> ContextManager[ConnectionWrapper]:
     serialization_backend = importlib.import_module(serialization_method)
     return closing(
@@ -73,7 +78,7 @@ DEBUG_TIMEOUT = 60 * 15
 
 def run_client(
     serialization_method: str,
-    address: tuple[str, int],
+    address: tuple[str, int] | str,
     *,
     with_pdb: bool = False,
     log_fd: int | None = None,
@@ -112,38 +117,47 @@ def run_client(
         _log.flush()
 
     log(f"Trying to create a connection to {address}")
-    # TODO(feat): this should probably run in a loop instead of
-    # receiving a single function and then exitting immediately.
     with child_connection(serialization_method, address) as connection:
         log(f"Created child connection to {address}")
-        callable = connection.recv()
-        log(f"Received the callable at {address}")
-
-        result = None
-        did_it_raise = False
-        stringized_tb = None
-        try:
-            result = callable()
-        except BaseException as exc:
-            result = exc
-            did_it_raise = True
-            num_frames = len(traceback.extract_stack()[:-4])
-            stringized_tb = "".join(traceback.format_exc(limit=-num_frames))
-        finally:
+        while True:
+            try:
+                callable = connection.recv()
+            except EOFError:
+                # The controller has closed the bridge, which means there
+                # won't be any more callables to run.
+                log(f"Connection to {address} has been closed")
+                break
+            log(f"Received the callable at {address}")
+
+            result = None
+            did_it_raise = False
+            stringized_tb = None
             try:
-                connection.send((result, did_it_raise, stringized_tb))
-            except BaseException:
-                if did_it_raise:
-                    # If we can't even send it through the connection
-                    # still try to dump it to the stderr as the last
-                    # resort.
-                    assert isinstance(result, BaseException)
-                    traceback.print_exception(
-                        type(result),
-                        result,
-                        result.__traceback__,
-                    )
-                raise
+                result = callable()
+            except BaseException as exc:
+                result = exc
+                did_it_raise = True
+                num_frames = len(traceback.extract_stack()[:-4])
+                stringized_tb = "".join(traceback.format_exc(limit=-num_frames))
+            finally:
+                try:
+                    connection.send((result, did_it_raise, stringized_tb))
+                except BaseException:
+                    if did_it_raise:
+                        # If we can't even send it through the connection
+                        # still try to dump it to the stderr as the last
+                        # resort.
+                        assert isinstance(result, BaseException)
+                        traceback.print_exception(
+                            type(result),
+                            result,
+                            result.__traceback__,
+                        )
+                    raise
+
+            # Don't keep the previous call's objects alive while
+            # waiting for the next one.
+            del callable, result
 
 
 def _get_shell_bootstrap() -> str:
@@ -1,10 +1,176 @@
+import atexit
 import json
 import os
+import sys
+import threading
+import time
+from collections import deque
 from datetime import datetime, timezone
-from typing import Dict
+from functools import lru_cache
+from typing import Deque, Dict, List, Optional, TextIO, Tuple
 
 from isolate.logs import LogLevel, LogSource
 
+# Number of records the logger can buffer before the overflow policy kicks in.
+# When it is 0, records are written synchronously by the thread logging them.
+LOG_BUFFER_SIZE = int(os.getenv("ISOLATE_LOG_BUFFER_SIZE", "0"))
+# What to do when the buffer is full: "block" until the writer catches up, or
+# "drop" the oldest records.
+LOG_OVERFLOW_POLICY = os.getenv("ISOLATE_LOG_OVERFLOW_POLICY", "block")
+OVERFLOW_POLICIES = ("block", "drop")
+
+# (logged_at, level, message, source, label maps)
+_Record = Tuple[float, LogLevel, str, LogSource, Tuple[Dict[str, str], ...]]
+
+
+def _format_record(record: _Record) -> str:
+    logged_at, level, message, source, label_maps = record
+    payload = {
+        "logged_at": datetime.fromtimestamp(logged_at, tz=timezone.utc).isoformat(),
+        "isolate_source": source.name,
+        "level": level.name,
+        "message": message,
+    }
+    for labels in label_maps:
+        payload.update(labels)
+    return json.dumps(payload)
+
+
+class LogWriter:
+    """Writes the log records from a dedicated thread, so that the threads
+    logging them never wait on the serialization or on the output stream
+    (unless the buffer is full and the overflow policy is "block")."""
+
+    def __init__(
+        self,
+        max_size: int,
+        overflow_policy: str = "block",
+        stream: Optional[TextIO] = None,
+    ) -> None:
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive integer.")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy: {overflow_policy!r} "
+                f"(expected one of {', '.join(OVERFLOW_POLICIES)})."
+            )
+
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        # Defaults to whatever sys.stdout is at the time of the write.
+        self.stream = stream
+        # Total number of records dropped because the buffer was full.
+        self.dropped = 0
+
+        self._buffer: Deque[_Record] = deque()
+        self._unreported_drops = 0
+        self._writing = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._thread = threading.Thread(
+            target=self._write_forever, name="isolate-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, record: _Record) -> None:
+        with self._lock:
+            if self._closed:
+                self._write([record], dropped=0)
+                return
+
+            while len(self._buffer) >= self.max_size:
+                if self.overflow_policy == "drop":
+                    self._buffer.popleft()
+                    self.dropped += 1
+                    self._unreported_drops += 1
+                    break
+                self._not_full.wait()
+
+            self._buffer.append(record)
+            self._not_empty.notify()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all the buffered records are written. Returns False
+        if they are not written in 'timeout' seconds."""
+        with self._lock:
+            return self._idle.wait_for(
+                lambda: not self._buffer and not self._writing, timeout
+            )
+
+    def close(self) -> None:
+        """Write all the buffered records and stop the writer thread. Records
+        logged after this are written synchronously."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+        self._thread.join()
+
+    def _write_forever(self) -> None:
+        while True:
+            with self._lock:
+                self._not_empty.wait_for(lambda: self._buffer or self._closed)
+                if not self._buffer:
+                    self._idle.notify_all()
+                    return
+
+                batch = list(self._buffer)
+                self._buffer.clear()
+                dropped, self._unreported_drops = self._unreported_drops, 0
+                self._writing = True
+                self._not_full.notify_all()
+
+            try:
+                self._write(batch, dropped=dropped)
+            except Exception as exc:
+                print(f"Failed to write {len(batch)} log records: {exc!r}")
+
+            with self._lock:
+                self._writing = False
+                if not self._buffer:
+                    self._idle.notify_all()
+
+    def _write(self, batch: List[_Record], *, dropped: int) -> None:
+        lines = [_format_record(record) for record in batch]
+        if dropped:
+            lines.insert(
+                0,
+                _format_record(
+                    (
+                        time.time(),
+                        LogLevel.WARNING,
+                        f"Dropped {dropped} log records since the log buffer "
+                        f"was full (total: {self.dropped}).",
+                        LogSource.BRIDGE,
+                        (),
+                    )
+                ),
+            )
+
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+
+@lru_cache(maxsize=None)
+def get_log_writer() -> Optional[LogWriter]:
+    """Return the writer shared by all the loggers of this process, or None if
+    the logs are written synchronously."""
+    if LOG_BUFFER_SIZE <= 0:
+        return None
+
+    writer = LogWriter(LOG_BUFFER_SIZE, overflow_policy=LOG_OVERFLOW_POLICY)
+    atexit.register(writer.close)
+    return writer
+
+
+if hasattr(os, "register_at_fork"):
+    # Loggers created in a forked child would otherwise buffer their records
+    # for a writer thread that only exists in the parent.
+    os.register_at_fork(after_in_child=get_log_writer.cache_clear)
+
 
 # NOTE: we probably should've created a proper `logging.getLogger` here,
 # but it handling `source` would be not trivial, so we are better off
@@ -12,8 +178,13 @@ from isolate.logs import LogLevel, LogSource
 class IsolateLogger:
     extra_labels: Dict[str, str] = {}
 
-    def __init__(self, log_labels: Dict[str, str]):
+    def __init__(
+        self,
+        log_labels: Dict[str, str],
+        writer: Optional[LogWriter] = None,
+    ):
         self.log_labels = log_labels
+        self.writer = writer if writer is not None else get_log_writer()
 
     def log(
         self,
@@ -22,18 +193,19 @@ class IsolateLogger:
         source: LogSource,
         line_labels: Dict[str, str],
     ) -> None:
-        record = {
+        record: _Record = (
             # Set the timestamp from source so we can be sure no buffering or
             # latency is affecting the timestamp.
-            "logged_at": datetime.now(tz=timezone.utc).isoformat(),
-            "isolate_source": source.name,
-            "level": level.name,
-            "message": message,
-            **self.log_labels,
-            **self.extra_labels,
-            **line_labels,
-        }
-        print(json.dumps(record))
+            time.time(),
+            level,
+            message,
+            source,
+            (self.log_labels, self.extra_labels, line_labels),
+        )
+        if self.writer is None:
+            print(_format_record(record))
+        else:
+            self.writer.put(record)
 
     @classmethod
     def with_env_expanded(cls, labels: Dict[str, str]) -> "IsolateLogger":
@@ -1,18 +1,21 @@
 from __future__ import annotations
 
 import json
+import sys
 import tempfile
+import time
 from dataclasses import dataclass, field
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from functools import total_ordering
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 if TYPE_CHECKING:
     from isolate.backends import BaseEnvironment
 
 _SYSTEM_TEMP_DIR = Path(tempfile.gettempdir())
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 class LogSource(str, Enum):
@@ -55,17 +58,91 @@ class LogLevel(Enum):
         return self.name.lower()
 
 
-@dataclass
+# Slotted dataclasses are only available on Python 3.10+.
+_DATACLASS_OPTIONS: dict[str, Any] = (
+    {"slots": True} if sys.version_info >= (3, 10) else {}
+)
+
+
+@dataclass(init=False, **_DATACLASS_OPTIONS)
 class Log:
-    """A structured log message with an option source and level."""
+    """A structured log message with an option source and level.
+
+    Since a lot of these are created (one for every line of output), the
+    timestamp is kept as nanoseconds since the epoch (timestamp_ns) and
+    only turned into a datetime when it is accessed."""
 
     message: str
     source: LogSource
     level: LogLevel = LogLevel.INFO
     bound_env: BaseEnvironment | None = field(default=None, repr=False)
-    timestamp: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
     is_json: bool = field(default=False)
-    _parsed_message: dict | None = field(default=None, init=False, repr=False)
+    timestamp_ns: int = field(default=0, repr=False)
+    _timestamp: datetime | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _parsed_message: dict | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __init__(
+        self,
+        message: str,
+        source: LogSource,
+        level: LogLevel = LogLevel.INFO,
+        bound_env: BaseEnvironment | None = None,
+        timestamp: datetime | None = None,
+        is_json: bool = False,
+        timestamp_ns: int | None = None,
+    ) -> None:
+        self.message = message
+        self.source = source
+        self.level = level
+        self.bound_env = bound_env
+        self.is_json = is_json
+        self._parsed_message = None
+
+        if timestamp is not None:
+            self.timestamp = timestamp
+        else:
+            self._timestamp = None
+            self.timestamp_ns = time.time_ns() if timestamp_ns is None else timestamp_ns
+
+    @property
+    def timestamp(self) -> datetime:
+        if self._timestamp is None:
+            self._timestamp = _EPOCH + timedelta(microseconds=self.timestamp_ns // 1000)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp: datetime) -> None:
+        self._timestamp = timestamp
+        if timestamp.tzinfo is None:
+            # Naive datetimes are assumed to be in UTC.
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        elapsed = timestamp - _EPOCH
+        self.timestamp_ns = elapsed // timedelta(microseconds=1) * 1000
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(message={self.message!r}, "
+            f"source={self.source!r}, level={self.level!r}, "
+            f"timestamp={self.timestamp!r}, is_json={self.is_json!r})"
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Log):
+            return NotImplemented
+        return (
+            self.message == other.message
+            and self.source == other.source
+            and self.level == other.level
+            and self.bound_env == other.bound_env
+            and self.timestamp == other.timestamp
+            and self.is_json == other.is_json
+        )
+
+    __hash__ = None  # type: ignore[assignment]
 
     def __str__(self) -> str:
         parts = [self.timestamp.strftime("%m/%d/%Y %H:%M:%S")]
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import asyncio
+import copy
 import functools
 import os
 import signal
@@ -8,25 +10,29 @@ import time
 import traceback
 import uuid
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import defaultdict, deque
 from concurrent import futures
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass, field, replace
+from pathlib import Path
 from queue import Empty as QueueEmpty
 from queue import Queue
-from typing import Any, Callable, Iterator, cast
+from typing import Any, AsyncIterator, Callable, Generator, Iterator, cast
 
 import grpc
 from grpc import ServicerContext, StatusCode
 from grpc.experimental import wrap_server_method_handler
 
 from isolate.backends import (
+    BaseEnvironment,
     EnvironmentCreationError,
     IsolateSettings,
 )
+from isolate.backends.cache import CacheManager, parse_size
 from isolate.backends.common import Requirements, active_python
 from isolate.backends.local import LocalPythonEnvironment
+from isolate.backends.settings import JSON_LOGS
 from isolate.backends.virtualenv import VirtualPythonEnvironment
 from isolate.connections.grpc import AgentError, LocalPythonGRPC
 from isolate.connections.grpc.configuration import get_default_options
@@ -34,7 +40,7 @@ from isolate.logger import IsolateLogger
 from isolate.logs import Log, LogLevel, LogSource
 from isolate.server import definitions, health
 from isolate.server.health_server import HealthServicer
-from isolate.server.interface import from_grpc, to_grpc
+from isolate.server.interface import from_grpc, logs_to_grpc, to_grpc
 
 EMPTY_MESSAGE_INTERVAL = float(os.getenv("ISOLATE_EMPTY_MESSAGE_INTERVAL", "600"))
 SKIP_EMPTY_LOGS = os.getenv("ISOLATE_SKIP_EMPTY_LOGS") == "1"
@@ -45,6 +51,61 @@ INHERIT_FROM_LOCAL = os.getenv("ISOLATE_INHERIT_FROM_LOCAL") == "1"
 
 # Number of threads that the gRPC server will use.
 MAX_THREADS = int(os.getenv("MAX_THREADS", "5"))
+
+# Response metadata key that carries the id of the task created for a Run call.
+TASK_ID_METADATA_KEY = "task-id"
+
+# Number of Run calls that can be processed at the same time when
+# serving through the asyncio server (see --aio).
+MAX_CONCURRENT_RUNS = int(os.getenv("ISOLATE_MAX_CONCURRENT_RUNS", "32"))
+
+# Number of environments of a single request that can be created at the same time.
+MAX_PARALLEL_ENVIRONMENT_CREATIONS = int(
+    os.getenv("ISOLATE_MAX_PARALLEL_ENVIRONMENT_CREATIONS", "4")
+)
+
+# Number of idle agents to keep warm for each environment, and the maximum
+# number of idle agents to keep around (unbounded when not set).
+AGENT_POOL_MIN_IDLE = int(os.getenv("ISOLATE_AGENT_POOL_MIN_IDLE", "0"))
+_AGENT_POOL_MAX_IDLE = os.getenv("ISOLATE_AGENT_POOL_MAX_IDLE")
+AGENT_POOL_MAX_IDLE = int(_AGENT_POOL_MAX_IDLE) if _AGENT_POOL_MAX_IDLE else None
+
+# Maximum number of idle agents to keep around across all the environments.
+_AGENT_POOL_MAX_TOTAL_IDLE = os.getenv("ISOLATE_AGENT_POOL_MAX_TOTAL_IDLE")
+AGENT_POOL_MAX_TOTAL_IDLE = (
+    int(_AGENT_POOL_MAX_TOTAL_IDLE) if _AGENT_POOL_MAX_TOTAL_IDLE else None
+)
+
+# Number of seconds an agent can stay idle before it gets terminated.
+_AGENT_IDLE_TTL = os.getenv("ISOLATE_AGENT_IDLE_TTL")
+AGENT_IDLE_TTL = float(_AGENT_IDLE_TTL) if _AGENT_IDLE_TTL else None
+
+# Quotas for the environment cache, the least recently used environments
+# are evicted every ISOLATE_CACHE_SWEEP_INTERVAL seconds when they are exceeded.
+_CACHE_MAX_SIZE = os.getenv("ISOLATE_CACHE_MAX_SIZE")
+CACHE_MAX_SIZE = parse_size(_CACHE_MAX_SIZE) if _CACHE_MAX_SIZE else None
+_CACHE_MAX_ENTRIES = os.getenv("ISOLATE_CACHE_MAX_ENTRIES")
+CACHE_MAX_ENTRIES = int(_CACHE_MAX_ENTRIES) if _CACHE_MAX_ENTRIES else None
+CACHE_SWEEP_INTERVAL = float(os.getenv("ISOLATE_CACHE_SWEEP_INTERVAL", "600"))
+
+# Logs that are produced faster than they can be streamed back are sent together
+# in a single PartialRunResult, with at most LOG_BATCH_MAX_COUNT logs and
+# (roughly) LOG_BATCH_MAX_SIZE bytes of messages in each. Setting a positive
+# LOG_BATCH_MAX_LATENCY (in seconds) lets a batch wait for more logs to show
+# up, at the cost of delaying the first one by that much.
+LOG_BATCH_MAX_COUNT = int(os.getenv("ISOLATE_LOG_BATCH_MAX_COUNT", "1000"))
+LOG_BATCH_MAX_SIZE = int(os.getenv("ISOLATE_LOG_BATCH_MAX_SIZE", str(1024 * 1024)))
+LOG_BATCH_MAX_LATENCY = float(os.getenv("ISOLATE_LOG_BATCH_MAX_LATENCY", "0"))
+
+# Upper bound on how often the idle agents are checked for expiration.
+_MAX_AGENT_REAPER_INTERVAL = 30.0
+
+# Number of threads that start the pooled agents in the background.
+AGENT_POOL_WARMUP_THREADS = int(os.getenv("ISOLATE_AGENT_POOL_WARMUP_THREADS", "2"))
+
+# Logs of a pre-warmed agent that are held until it is used for the first time.
+_MAX_PENDING_WARMUP_LOGS = 1000
+
 _AGENT_REQUIREMENTS_TXT = os.getenv("AGENT_REQUIREMENTS_TXT")
 
 if _AGENT_REQUIREMENTS_TXT is not None:
@@ -54,11 +115,6 @@ else:
     AGENT_REQUIREMENTS = []
 
 
-# Number of seconds to observe the queue before checking the termination
-# event.
-_Q_WAIT_DELAY = 0.1
-
-
 class GRPCException(Exception):
     def __init__(self, message: str, code: StatusCode = StatusCode.INVALID_ARGUMENT):
         super().__init__(message)
@@ -77,6 +133,12 @@ class RunnerAgent:
     _channel_state_history: list[grpc.ChannelConnectivity] = field(default_factory=list)
     _connection: LocalPythonGRPC | None = None
     _terminated: bool = False
+    _log_relay: _AgentLogRelay | None = None
+    _idle_since: float = field(default_factory=time.monotonic)
+    # Number of runs the agent can execute at the same time, and the number
+    # of runs that are currently using it.
+    slots: int = 1
+    _active_runs: int = 0
 
     def __post_init__(self):
         def switch_state(connectivity_update: grpc.ChannelConnectivity) -> None:
@@ -118,14 +180,133 @@ class RunnerAgent:
             self._connection.abort_agent()
         self._bound_context.close()
 
+    def drain_output(self) -> None:
+        """Forward everything the agent has written to its stdout/stderr so
+        far to the log hooks (and through them, to the message queue)."""
+        if self._connection:
+            self._connection.drain_agent_output()
+
+
+def _agent_slots(connection: LocalPythonGRPC) -> int:
+    """Return the number of runs that can share an agent started through
+    the given connection."""
+    settings = connection.environment.settings
+    if not settings.agent_log_capture:
+        # The logs of the runs would be mixed together in the pipes.
+        return 1
+    return max(settings.agent_concurrency, 1)
+
+
+def _remove_agent(agents: list[RunnerAgent], agent: RunnerAgent) -> None:
+    # Agents are compared by identity, not by their fields.
+    for index, candidate in enumerate(agents):
+        if candidate is agent:
+            del agents[index]
+            return None
+
+
+class _AgentLogRelay:
+    """Log hook for the agents that are started ahead of time. Logs emitted
+    before the agent is handed out are held back and then forwarded (with
+    everything that comes after them) to the log hook of the first run
+    that uses it."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._hook: Callable[[Log], None] | None = None
+        self._pending: deque[Log] = deque(maxlen=_MAX_PENDING_WARMUP_LOGS)
+
+    def __call__(self, log: Log) -> None:
+        with self._lock:
+            hook = self._hook
+            if hook is None:
+                self._pending.append(log)
+                return
+
+        hook(log)
+
+    def bind(self, hook: Callable[[Log], None]) -> None:
+        with self._lock:
+            self._hook = hook
+            while self._pending:
+                hook(self._pending.popleft())
+
+
+@dataclass
+class AgentCacheStats:
+    # Number of runs that were served by an idle agent.
+    hits: int = 0
+    # Number of runs that had to start a new agent.
+    misses: int = 0
+    # Number of idle agents that were terminated to stay within the limits.
+    evictions: int = 0
+
 
 @dataclass
 class BridgeManager:
+    # Number of idle agents to keep ready for each environment that was used at
+    # least once, they are started in the background whenever an agent is
+    # taken out of the pool.
+    min_idle_agents: int = AGENT_POOL_MIN_IDLE
+    # Maximum number of idle agents to keep around for each environment, and
+    # across all environments. When either is exceeded, the least recently
+    # used agents are terminated first.
+    max_idle_agents: int | None = AGENT_POOL_MAX_IDLE
+    max_total_idle_agents: int | None = AGENT_POOL_MAX_TOTAL_IDLE
+    # Number of seconds an agent can stay idle before it is terminated.
+    agent_idle_ttl: float | None = AGENT_IDLE_TTL
+
+    stats: AgentCacheStats = field(default_factory=AgentCacheStats)
+
     _agent_access_lock: threading.Lock = field(default_factory=threading.Lock)
     _agents: dict[tuple[Any, ...], list[RunnerAgent]] = field(
         default_factory=lambda: defaultdict(list)
     )
+    _pending_agents: dict[tuple[Any, ...], int] = field(
+        default_factory=lambda: defaultdict(int)
+    )
+    # Agents that are used by some runs, but can take more of them.
+    _shared_agents: dict[tuple[Any, ...], list[RunnerAgent]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    # Keys of the agents that are currently used by a run.
+    _active_keys: list[tuple[Any, ...]] = field(default_factory=list)
+    _warmup_pool: ThreadPoolExecutor = field(
+        default_factory=lambda: ThreadPoolExecutor(
+            max_workers=AGENT_POOL_WARMUP_THREADS
+        )
+    )
     _stack: ExitStack = field(default_factory=ExitStack)
+    _reaper: threading.Thread | None = None
+    _reaper_stop: threading.Event = field(default_factory=threading.Event)
+    _closed: bool = False
+
+    def __post_init__(self) -> None:
+        if self.min_idle_agents < 0:
+            raise ValueError("min_idle_agents can't be negative.")
+
+        if self.max_idle_agents is not None and (
+            self.max_idle_agents < self.min_idle_agents
+        ):
+            raise ValueError("max_idle_agents can't be less than min_idle_agents.")
+
+        if self.max_total_idle_agents is not None and (
+            self.max_total_idle_agents < self.min_idle_agents
+        ):
+            raise ValueError(
+                "max_total_idle_agents can't be less than min_idle_agents."
+            )
+
+        if self.agent_idle_ttl is not None:
+            if self.agent_idle_ttl <= 0:
+                raise ValueError("agent_idle_ttl must be positive.")
+
+            self._reaper = threading.Thread(
+                target=self._reap_idle_agents,
+                name="isolate-agent-reaper",
+                daemon=True,
+            )
+            self._reaper.start()
 
     @contextmanager
     def establish(
@@ -134,10 +315,17 @@ class BridgeManager:
         queue: Queue,
     ) -> Iterator[RunnerAgent]:
         agent = self._allocate_new_agent(connection, queue)
+        self._refill_pool(connection)
+
+        key = self._identify(connection)
+        with self._agent_access_lock:
+            self._active_keys.append(key)
 
         try:
             yield agent
         finally:
+            with self._agent_access_lock:
+                self._active_keys.remove(key)
             self._cache_agent(connection, agent)
 
     def _cache_agent(
@@ -145,28 +333,218 @@ class BridgeManager:
         connection: LocalPythonGRPC,
         agent: RunnerAgent,
     ) -> None:
+        key = self._identify(connection)
         with self._agent_access_lock:
-            self._agents[self._identify(connection)].append(agent)
+            agent._active_runs -= 1
+            if agent.slots > 1:
+                shared_agents = self._shared_agents[key]
+                _remove_agent(shared_agents, agent)
+                if agent._active_runs:
+                    # Still used by other runs, but has a free slot now.
+                    if not agent._terminated and agent.check_connectivity():
+                        shared_agents.append(agent)
+                    return None
+
+            if agent._terminated:
+                # Killed while it was in use (e.g. its run was cancelled), so
+                # it can't serve any other runs.
+                return None
+
+            evicted_agents = self._store_agent(key, agent)
+
+        for evicted_agent in evicted_agents:
+            evicted_agent.terminate()
+
+    def _store_agent(
+        self,
+        key: tuple[Any, ...],
+        agent: RunnerAgent,
+    ) -> list[RunnerAgent]:
+        # Must be called with the access lock held. Returns the agents that
+        # were evicted to stay within the limits, which should be terminated
+        # by the caller (outside of the lock).
+        agent._idle_since = time.monotonic()
+        available_agents = self._agents[key]
+        available_agents.append(agent)
+
+        evicted_agents = []
+        if self.max_idle_agents is not None:
+            while len(available_agents) > self.max_idle_agents:
+                evicted_agents.append(available_agents.pop(0))
+
+        if self.max_total_idle_agents is not None:
+            while (
+                sum(len(agents) for agents in self._agents.values())
+                > self.max_total_idle_agents
+            ):
+                lru_agents = min(
+                    (agents for agents in self._agents.values() if agents),
+                    key=lambda agents: agents[0]._idle_since,
+                )
+                evicted_agents.append(lru_agents.pop(0))
+
+        self.stats.evictions += len(evicted_agents)
+        return evicted_agents
+
+    def _reap_idle_agents(self) -> None:
+        assert self.agent_idle_ttl is not None
+        interval = min(self.agent_idle_ttl / 2, _MAX_AGENT_REAPER_INTERVAL)
+        while not self._reaper_stop.wait(interval):
+            deadline = time.monotonic() - self.agent_idle_ttl
+            with self._agent_access_lock:
+                expired_agents = []
+                for agents in self._agents.values():
+                    # Agents are kept in the order they became idle.
+                    while agents and agents[0]._idle_since < deadline:
+                        expired_agents.append(agents.pop(0))
+                self.stats.evictions += len(expired_agents)
+
+            if not expired_agents:
+                continue
+
+            print(
+                f"Terminating {len(expired_agents)} idle agent(s) "
+                f"(hits={self.stats.hits}, misses={self.stats.misses}, "
+                f"evictions={self.stats.evictions})"
+            )
+            for agent in expired_agents:
+                agent.terminate()
 
     def _allocate_new_agent(
         self,
         connection: LocalPythonGRPC,
         queue: Queue,
     ) -> RunnerAgent:
+        key = self._identify(connection)
         with self._agent_access_lock:
-            available_agents = self._agents[self._identify(connection)]
+            # Agents that are already running something but still have free
+            # slots come first, so the idle ones stay available for the
+            # environments that can't share them.
+            shared_agents = self._shared_agents[key]
+            while shared_agents:
+                agent = shared_agents[-1]
+                if not agent.check_connectivity():
+                    # It is put back to the pool (and then terminated)
+                    # once its active runs are done.
+                    shared_agents.pop()
+                    continue
+
+                self._claim_agent(key, agent)
+                self.stats.hits += 1
+                return agent
+
+            available_agents = self._agents[key]
             while available_agents:
                 agent = available_agents.pop()
-                if agent.check_connectivity():
-                    return agent
-                else:
+                if not agent.check_connectivity():
                     agent.terminate()
+                    continue
+
+                if agent._log_relay is not None:
+                    # A pre-warmed agent, route its logs to the run that
+                    # is going to use it.
+                    agent.message_queue = queue
+                    agent._log_relay.bind(connection.environment.settings.log_hook)
+                    agent._log_relay = None
+
+                self._claim_agent(key, agent)
+                self.stats.hits += 1
+                return agent
+
+            self.stats.misses += 1
+
+        agent = self._start_agent(connection, queue)
+        with self._agent_access_lock:
+            self._claim_agent(key, agent)
+        return agent
+
+    def _claim_agent(self, key: tuple[Any, ...], agent: RunnerAgent) -> None:
+        # Must be called with the access lock held.
+        agent._active_runs += 1
+        shared_agents = self._shared_agents[key]
+        if agent._active_runs >= agent.slots:
+            _remove_agent(shared_agents, agent)
+        elif agent._active_runs == 1:
+            shared_agents.append(agent)
+
+    def _start_agent(
+        self,
+        connection: LocalPythonGRPC,
+        queue: Queue,
+    ) -> RunnerAgent:
+        slots = _agent_slots(connection)
+        if slots > 1:
+            # The runs of a shared agent get their logs through their own Run
+            # streams, and whatever is written to the agent's stdout/stderr
+            # directly can't be attributed to any of them.
+            environment = copy.copy(connection.environment)
+            environment.apply_settings(replace(environment.settings, log_hook=print))
+            connection = replace(connection, environment=environment)
 
         bound_context = ExitStack()
         stub = bound_context.enter_context(
             connection._establish_bridge(max_wait_timeout=MAX_GRPC_WAIT_TIMEOUT)
         )
-        return RunnerAgent(stub, queue, bound_context, [], connection)
+        return RunnerAgent(stub, queue, bound_context, [], connection, slots=slots)
+
+    def _refill_pool(self, connection: LocalPythonGRPC) -> None:
+        if self.min_idle_agents == 0:
+            return None
+
+        key = self._identify(connection)
+        with self._agent_access_lock:
+            if self._closed:
+                return None
+
+            missing = (
+                self.min_idle_agents
+                - len(self._agents[key])
+                - self._pending_agents[key]
+            )
+            if missing <= 0:
+                return None
+
+            self._pending_agents[key] += missing
+
+        for _ in range(missing):
+            self._warmup_pool.submit(self._warm_up_agent, connection, key)
+
+    def _warm_up_agent(
+        self,
+        connection: LocalPythonGRPC,
+        key: tuple[Any, ...],
+    ) -> None:
+        # The log hook of the given connection belongs to the run that
+        # triggered the refill, so the new agent gets its own copy of the
+        # environment which buffers the logs until the agent is handed out.
+        log_relay = _AgentLogRelay()
+        environment = copy.copy(connection.environment)
+        environment.apply_settings(replace(environment.settings, log_hook=log_relay))
+
+        agent: RunnerAgent | None
+        try:
+            agent = self._start_agent(
+                replace(connection, environment=environment), Queue()
+            )
+        except BaseException as exc:
+            print(f"Failed to start an agent for the pool: {exc!r}")
+            agent = None
+        else:
+            if agent.slots == 1:
+                agent._log_relay = log_relay
+
+        with self._agent_access_lock:
+            self._pending_agents[key] -= 1
+            if agent is None:
+                return None
+
+            if self._closed:
+                evicted_agents = [agent]
+            else:
+                evicted_agents = self._store_agent(key, agent)
+
+        for evicted_agent in evicted_agents:
+            evicted_agent.terminate()
 
     def _identify(self, connection: LocalPythonGRPC) -> tuple[Any, ...]:
         return (
@@ -174,21 +552,105 @@ class BridgeManager:
             *connection.extra_inheritance_paths,
         )
 
+    def is_in_use(self, environment_path: Path) -> bool:
+        """Whether any of the agents (running or idle) depends on the
+        given environment."""
+        with self._agent_access_lock:
+            keys = set(self._active_keys)
+            keys.update(key for key, agents in self._agents.items() if agents)
+            keys.update(key for key, count in self._pending_agents.items() if count)
+
+        return any(environment_path in key for key in keys)
+
     def __enter__(self) -> BridgeManager:
         return self
 
     def __exit__(self, *exc_info: Any) -> None:
+        with self._agent_access_lock:
+            self._closed = True
+
+        self._reaper_stop.set()
+        self._warmup_pool.shutdown(wait=False)
         for agents in self._agents.values():
             for agent in agents:
                 agent.terminate()
 
     def abort_unreachable_agents(self) -> None:
-        for agents in self._agents.values():
-            for agent in agents:
-                connection = agent._connection
-                if connection is not None and not connection.is_alive():
-                    connection.abort_agent()
-                    # maybe restart the agent?
+        with self._agent_access_lock:
+            all_agents = [agent for agents in self._agents.values() for agent in agents]
+
+        for agent in all_agents:
+            connection = agent._connection
+            if connection is not None and not connection.is_alive():
+                connection.abort_agent()
+                # maybe restart the agent?
+
+
+@dataclass
+class _EnvironmentBuild:
+    future: futures.Future = field(default_factory=futures.Future)
+    _logs: list[Log] = field(default_factory=list)
+    _subscribers: list[Callable[[Log], None]] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def publish(self, log: Log) -> None:
+        with self._lock:
+            self._logs.append(log)
+            for subscriber in self._subscribers:
+                subscriber(log)
+
+    def subscribe(self, log_hook: Callable[[Log], None]) -> None:
+        # Replay everything that was logged so far, so that every subscriber
+        # sees the full build output regardless of when it joined.
+        with self._lock:
+            for log in self._logs:
+                log_hook(log)
+            self._subscribers.append(log_hook)
+
+
+@dataclass
+class EnvironmentBuilds:
+    """Deduplicate concurrent creations of the same environment. The first
+    request to create an environment builds it, while the rest wait for its
+    result and receive its logs instead of competing for the build lock."""
+
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _builds: dict[tuple[Any, ...], _EnvironmentBuild] = field(default_factory=dict)
+
+    def create(self, environment: BaseEnvironment, *, force: bool = False) -> Any:
+        if force:
+            # A forced re-build can't be satisfied by an ongoing build.
+            return environment.create(force=True)
+
+        key = (
+            environment.BACKEND_NAME,
+            environment.key,
+            environment.settings.cache_dir,
+        )
+        with self._lock:
+            build = self._builds.get(key)
+            is_leader = build is None
+            if build is None:
+                build = self._builds[key] = _EnvironmentBuild()
+
+        original_settings = environment.settings
+        build.subscribe(original_settings.log_hook)
+        if not is_leader:
+            return build.future.result()
+
+        environment.apply_settings(replace(original_settings, log_hook=build.publish))
+        try:
+            result = environment.create()
+        except BaseException as exc:
+            build.future.set_exception(exc)
+            raise
+        else:
+            build.future.set_result(result)
+            return result
+        finally:
+            environment.apply_settings(original_settings)
+            with self._lock:
+                del self._builds[key]
 
 
 @dataclass
@@ -196,16 +658,30 @@ class RunTask:
     request: definitions.BoundFunction
     future: futures.Future | None = None
     agent: RunnerAgent | None = None
+    # The Run call made to the agent.
+    call: grpc.Future | None = None
     logger: IsolateLogger = field(default_factory=IsolateLogger.from_env)
+    # Set once the task is cancelled, so that the parts of the run that haven't
+    # started yet (e.g. while the environments are being built) never do.
+    cancelled: bool = False
 
     def cancel(self):
+        # The run checks the flag after each step that sets the agent/call
+        # (and this checks them after setting the flag), so either the run
+        # sees the flag or the cancellation sees what has to be stopped.
+        self.cancelled = True
         while True:
             # Cancelling a running future is not possible, and it sometimes blocks,
             # which means we never terminate the agent. So check if it's not running
             if self.future and not self.future.running():
                 self.future.cancel()
 
-            if self.agent:
+            if self.agent and self.agent.slots > 1:
+                # The agent might be running other tasks as well, so only
+                # the call of this one is cancelled.
+                if self.call:
+                    self.call.cancel()
+            elif self.agent:
                 self.agent.terminate()
 
             try:
@@ -226,6 +702,8 @@ class IsolateServicer(definitions.IsolateServicer):
     default_settings: IsolateSettings = field(default_factory=IsolateSettings)
     background_tasks: dict[str, RunTask] = field(default_factory=dict)
     _shutting_down: bool = field(default=False)
+    _tasks_lock: threading.Lock = field(default_factory=threading.Lock)
+    _environment_builds: EnvironmentBuilds = field(default_factory=EnvironmentBuilds)
 
     _thread_pool: futures.ThreadPoolExecutor = field(
         default_factory=lambda: futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
@@ -233,7 +711,63 @@ class IsolateServicer(definitions.IsolateServicer):
 
     def _run_task(self, task: RunTask) -> Iterator[definitions.PartialRunResult]:
         messages: Queue[definitions.PartialRunResult] = Queue()
-        environments = []
+        environments, extra_inheritance_paths = self._prepare_environments(
+            task, messages
+        )
+
+        with ThreadPoolExecutor(max_workers=1) as local_pool:
+            creation_future = local_pool.submit(self._create_environments, environments)
+            yield from self.watch_queue_until_completed(messages, creation_future)
+
+            # Assuming that the iterator above only stops yielding once
+            # the future is completed, the timeout here should be redundant
+            # but it is just in case.
+            environment_paths = creation_future.result(timeout=0.1)
+            if task.cancelled:
+                return
+
+            connection = self._make_connection(
+                environments, environment_paths, extra_inheritance_paths
+            )
+
+            with self.bridge_manager.establish(connection, queue=messages) as agent:
+                task.agent = agent
+                if task.cancelled:
+                    # Cancelled while the agent was being started, so release
+                    # it without running anything.
+                    return
+
+                queue = self._select_queue(agent, messages)
+                future = local_pool.submit(
+                    _proxy_to_queue,
+                    queue=queue,
+                    bridge=agent.stub,
+                    input=self._make_function_call(task),
+                    log_hook=self._make_agent_log_hook(task, agent, queue),
+                    task=task,
+                    drain_output=agent.drain_output,
+                )
+
+                # Unlike above; we are not interested in the result value of future
+                # here, since it will be already transferred to other side without
+                # us even seeing (through the queue).
+                yield from self.watch_queue_until_completed(queue, future)
+
+                # But we still have to check whether there were any errors raised
+                # during the execution, and handle them accordingly.
+                exception = future.exception(timeout=0.1)
+                if exception is not None:
+                    yield from self._handle_agent_error(agent, exception)
+
+    def _prepare_environments(
+        self,
+        task: RunTask,
+        messages: Queue,
+    ) -> tuple[list[tuple[bool, BaseEnvironment]], list[Path]]:
+        """Materialize the environments of the given task (bound to a log handler
+        that forwards everything to 'messages') and return them alongside with the
+        paths that should be inherited regardless of the environments."""
+        environments: list[tuple[bool, BaseEnvironment]] = []
         for env in task.request.environments:
             try:
                 environments.append((env.force, from_grpc(env)))
@@ -277,88 +811,127 @@ class IsolateServicer(definitions.IsolateServicer):
             local_environment = LocalPythonEnvironment()
             extra_inheritance_paths.append(local_environment.create())
 
-        with ThreadPoolExecutor(max_workers=1) as local_pool:
-            environment_paths = []
-            for should_force_create, environment in environments:
-                future = local_pool.submit(
-                    environment.create, force=should_force_create
-                )
-                yield from self.watch_queue_until_completed(messages, future.done)
-                try:
-                    # Assuming that the iterator above only stops yielding once
-                    # the future is completed, the timeout here should be redundant
-                    # but it is just in case.
-                    environment_paths.append(future.result(timeout=0.1))
-                except EnvironmentCreationError as e:
-                    raise GRPCException(f"{e}", StatusCode.INVALID_ARGUMENT)
-
-            primary_path, *inheritance_paths = environment_paths
-            inheritance_paths.extend(extra_inheritance_paths)
-            _, primary_environment = environments[0]
-
-            connection = LocalPythonGRPC(
-                primary_environment,
-                primary_path,
-                extra_inheritance_paths=inheritance_paths,
-            )
+        return environments, extra_inheritance_paths
 
-            with self.bridge_manager.establish(connection, queue=messages) as agent:
-                task.agent = agent
-                function_call = definitions.FunctionCall(
-                    function=task.request.function,
-                    setup_func=task.request.setup_func,
+    def _create_environments(
+        self,
+        environments: list[tuple[bool, BaseEnvironment]],
+    ) -> list[Path]:
+        """Create all the given environments (blocking) and return their paths.
+        Environments are independent of each other, so they are created
+        concurrently (their logs are interleaved in the stream)."""
+        max_workers = max(1, min(MAX_PARALLEL_ENVIRONMENT_CREATIONS, len(environments)))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            creation_futures = [
+                pool.submit(
+                    self._environment_builds.create,
+                    environment,
+                    force=should_force_create,
                 )
-                if not task.request.HasField("setup_func"):
-                    function_call.ClearField("setup_func")
+                for should_force_create, environment in environments
+            ]
+            try:
+                return [future.result() for future in creation_futures]
+            except EnvironmentCreationError as e:
+                for future in creation_futures:
+                    future.cancel()
+                raise GRPCException(f"{e}", StatusCode.INVALID_ARGUMENT)
 
-                future = local_pool.submit(
-                    _proxy_to_queue,
-                    # The agent may have been cached, so use the agent's message queue
-                    queue=agent.message_queue,
-                    bridge=agent.stub,
-                    input=function_call,
-                )
+    def _make_connection(
+        self,
+        environments: list[tuple[bool, BaseEnvironment]],
+        environment_paths: list[Path],
+        extra_inheritance_paths: list[Path],
+    ) -> LocalPythonGRPC:
+        primary_path, *inheritance_paths = environment_paths
+        inheritance_paths.extend(extra_inheritance_paths)
+        _, primary_environment = environments[0]
 
-                # Unlike above; we are not interested in the result value of future
-                # here, since it will be already transferred to other side without
-                # us even seeing (through the queue).
-                yield from self.watch_queue_until_completed(
-                    agent.message_queue, future.done
-                )
+        return LocalPythonGRPC(
+            primary_environment,
+            primary_path,
+            extra_inheritance_paths=inheritance_paths,
+        )
 
-                # But we still have to check whether there were any errors raised
-                # during the execution, and handle them accordingly.
-                exception = future.exception(timeout=0.1)
-                if exception is not None:
-                    # If this is an RPC error, propagate it as is without any
-                    # further processing.
-
-                    if isinstance(exception, grpc.RpcError):
-                        # on abort, we terminate the process before we close the channel
-                        # because we need to populate SIGTERM to the agent process
-                        if (
-                            agent._terminated
-                            and exception.code() == StatusCode.UNAVAILABLE
-                        ):
-                            return
-                        raise GRPCException(
-                            str(exception),
-                            exception.code(),
-                        )
-
-                    # Otherwise this is a bug in the agent itself, so needs
-                    # to be propagated with more details.
-                    for line in traceback.format_exception(
-                        type(exception), exception, exception.__traceback__
-                    ):
-                        yield from self.log(line, level=LogLevel.ERROR)
-                    if isinstance(exception, AgentError):
-                        raise GRPCException(str(exception), StatusCode.ABORTED)
-                    else:
-                        raise GRPCException(
-                            f"An unexpected error occurred: {exception}.",
-                            StatusCode.UNKNOWN,
-                        )
+    def _select_queue(self, agent: RunnerAgent, messages: Queue) -> Queue:
+        """Return the queue that the messages of a run on the given agent
+        should go through."""
+        if agent.slots > 1:
+            # Shared agents are used by multiple runs at once, each of
+            # them has to use its own queue.
+            return messages
+
+        # The agent may have been cached, so use the agent's message queue
+        # (that's where the logs from its stdout/stderr end up).
+        return agent.message_queue
+
+    def _make_agent_log_hook(
+        self,
+        task: RunTask,
+        agent: RunnerAgent,
+        queue: Queue,
+    ) -> Callable[[definitions.Log], None]:
+        """Return the hook for the logs that the agent sends through the Run
+        stream (see IsolateSettings.agent_log_capture). They are masked, get
+        their levels inferred and are forwarded to the given message queue."""
+        connection = agent._connection
+        settings = replace(
+            self.default_settings,
+            log_hook=LogHandler(queue, task=task).handle,
+        )
+
+        def handle(raw_log: definitions.Log) -> None:
+            log = from_grpc(raw_log)
+            if connection is not None:
+                log.message = connection.mask_agent_log(log.message)
+            log.is_json = JSON_LOGS
+            settings.log(log)
+
+        return handle
+
+    def _make_function_call(self, task: RunTask) -> definitions.FunctionCall:
+        function_call = definitions.FunctionCall(
+            function=task.request.function,
+            setup_func=task.request.setup_func,
+        )
+        if not task.request.HasField("setup_func"):
+            function_call.ClearField("setup_func")
+        return function_call
+
+    def _handle_agent_error(
+        self,
+        agent: RunnerAgent,
+        exception: BaseException,
+    ) -> Iterator[definitions.PartialRunResult]:
+        # If this is an RPC error, propagate it as is without any
+        # further processing.
+        if isinstance(exception, grpc.RpcError):
+            # on abort, we terminate the process before we close the channel
+            # because we need to populate SIGTERM to the agent process
+            if agent._terminated and exception.code() == StatusCode.UNAVAILABLE:
+                return
+            # Same for the calls to shared agents, which are cancelled instead
+            # (see RunTask.cancel).
+            if agent.slots > 1 and exception.code() == StatusCode.CANCELLED:
+                return
+            raise GRPCException(
+                str(exception),
+                exception.code(),
+            )
+
+        # Otherwise this is a bug in the agent itself, so needs
+        # to be propagated with more details.
+        for line in traceback.format_exception(
+            type(exception), exception, exception.__traceback__
+        ):
+            yield from self.log(line, level=LogLevel.ERROR)
+        if isinstance(exception, AgentError):
+            raise GRPCException(str(exception), StatusCode.ABORTED)
+        else:
+            raise GRPCException(
+                f"An unexpected error occurred: {exception}.",
+                StatusCode.UNKNOWN,
+            )
 
     def _run_task_in_background(self, task: RunTask) -> None:
         for _ in self._run_task(task):
@@ -372,13 +945,13 @@ class IsolateServicer(definitions.IsolateServicer):
         task = RunTask(request=request.function)
         self.set_metadata(task, request.metadata)
 
+        # Register the task before it starts running, so that it can't
+        # finish (and unregister itself) before it is ever registered.
+        task_id = self.register_task(task)
         task.future = self._thread_pool.submit(self._run_task_in_background, task)
-        task_id = str(uuid.uuid4())
 
         print(f"Submitted a task {task_id}")
 
-        self.background_tasks[task_id] = task
-
         def _callback(future: futures.Future) -> None:
             msg = f"Task {task_id} finished with"
             if exc := future.exception():
@@ -386,7 +959,7 @@ class IsolateServicer(definitions.IsolateServicer):
             else:
                 msg += f" result: {future.result()!r}"
             print(msg)
-            self.background_tasks.pop(task_id, None)
+            self.unregister_task(task_id)
 
         task.future.add_done_callback(_callback)
 
@@ -397,31 +970,46 @@ class IsolateServicer(definitions.IsolateServicer):
         request: definitions.SetMetadataRequest,
         context: ServicerContext,
     ) -> definitions.SetMetadataResponse:
-        if request.task_id not in self.background_tasks:
+        with self._tasks_lock:
+            task = self.background_tasks.get(request.task_id)
+
+        if task is None:
             self.abort_with_msg(
                 f"Task {request.task_id} not found.",
                 context,
                 code=StatusCode.NOT_FOUND,
             )
-
-        self.set_metadata(self.background_tasks[request.task_id], request.metadata)
+        else:
+            self.set_metadata(task, request.metadata)
 
         return definitions.SetMetadataResponse()
 
     def set_metadata(self, task: RunTask, metadata: definitions.TaskMetadata) -> None:
         task.logger.extra_labels = dict(metadata.logger_labels)
 
+    def register_task(self, task: RunTask) -> str:
+        """Assign a unique id to the given task and start tracking it (so it
+        can be listed and cancelled) until it is unregistered."""
+        task_id = str(uuid.uuid4())
+        with self._tasks_lock:
+            self.background_tasks[task_id] = task
+        return task_id
+
+    def unregister_task(self, task_id: str) -> None:
+        with self._tasks_lock:
+            self.background_tasks.pop(task_id, None)
+
     def Run(
         self,
         request: definitions.BoundFunction,
         context: ServicerContext,
     ) -> Iterator[definitions.PartialRunResult]:
+        task = RunTask(request=request)
+        task_id = self.register_task(task)
         try:
-            task = RunTask(request=request)
-
-            # HACK: we can support only one task at a time
-            # TODO: move away from this when we use submit for env-aware tasks
-            self.background_tasks["RUN"] = task
+            # Let the client know which task this run is, so it can be
+            # referenced in SetMetadata/Cancel calls.
+            context.send_initial_metadata(((TASK_ID_METADATA_KEY, task_id),))
             yield from self._run_task(task)
         except GRPCException as exc:
             self.abort_with_msg(
@@ -430,18 +1018,18 @@ class IsolateServicer(definitions.IsolateServicer):
                 code=exc.code,
             )
         finally:
-            self.background_tasks.pop("RUN", None)
+            self.unregister_task(task_id)
 
     def List(
         self,
         request: definitions.ListRequest,
         context: ServicerContext,
     ) -> definitions.ListResponse:
+        with self._tasks_lock:
+            task_ids = list(self.background_tasks.keys())
+
         return definitions.ListResponse(
-            tasks=[
-                definitions.TaskInfo(task_id=task_id)
-                for task_id in self.background_tasks.keys()
-            ]
+            tasks=[definitions.TaskInfo(task_id=task_id) for task_id in task_ids]
         )
 
     def Cancel(
@@ -452,9 +1040,15 @@ class IsolateServicer(definitions.IsolateServicer):
         task_id = request.task_id
 
         print(f"Canceling task {task_id}")
-        task = self.background_tasks.get(task_id)
+        with self._tasks_lock:
+            task = self.background_tasks.get(task_id)
+
         if task is not None:
             task.cancel()
+            # The future's done callbacks (which unregister the task) might
+            # still be pending when cancel() returns, so don't leave the task
+            # listed in the meantime.
+            self.unregister_task(task_id)
 
         return definitions.CancelResponse()
 
@@ -470,35 +1064,57 @@ class IsolateServicer(definitions.IsolateServicer):
         print("All tasks canceled.")
 
     def watch_queue_until_completed(
-        self, queue: Queue, is_completed: Callable[[], bool]
-    ) -> Iterator[definitions.PartialRunResult]:
-        """Watch the given queue until the is_completed function returns True.
-        Note that even if the function is completed, this function might not
-        finish until the queue is empty.
-        """
+        self, queue: Queue, future: futures.Future
+    ) -> Generator[definitions.PartialRunResult, None, None]:
+        """Watch the given queue until the given future is completed. Note that
+        even if the future is completed, this function might not finish until
+        the queue is empty.
+
+        Instead of polling the future, a completion marker is pushed to the queue
+        once the future is done so the generator wakes up exactly when there is
+        either a new message or the work has finished."""
+
+        # Queues of cached agents outlive a single run, so each watcher uses its
+        # own marker and ignores any stale ones left by an abandoned watcher.
+        completion_marker = object()
+        future.add_done_callback(lambda _: queue.put_nowait(completion_marker))
 
         timer = time.monotonic()
-        while not is_completed():
+        while True:
+            remaining = EMPTY_MESSAGE_INTERVAL - (time.monotonic() - timer)
             try:
-                yield queue.get(timeout=_Q_WAIT_DELAY)
+                message = queue.get(timeout=max(remaining, 0))
             except QueueEmpty:
                 # Send an empty (but 'real') packet to the client, currently a hacky way
                 # to make sure the stream results are never ignored.
-                if time.monotonic() - timer > EMPTY_MESSAGE_INTERVAL:
-                    timer = time.monotonic()
-                    yield definitions.PartialRunResult(
-                        is_complete=False,
-                        logs=[],
-                        result=None,
-                    )
+                timer = time.monotonic()
+                yield definitions.PartialRunResult(
+                    is_complete=False,
+                    logs=[],
+                    result=None,
+                )
+                continue
+
+            if message is completion_marker:
+                break
+            elif isinstance(message, definitions.PartialRunResult):
+                yield message
+            elif isinstance(message, LogHandler):
+                time.sleep(message.flush_delay())
+                yield from message.flush()
 
         # Clear the final messages
         while not queue.empty():
             try:
-                yield queue.get_nowait()
+                message = queue.get_nowait()
             except QueueEmpty:
                 continue
 
+            if isinstance(message, definitions.PartialRunResult):
+                yield message
+            elif isinstance(message, LogHandler):
+                yield from message.flush()
+
     def log(
         self,
         message: str,
@@ -521,7 +1137,9 @@ class IsolateServicer(definitions.IsolateServicer):
         return None
 
     def cancel_tasks(self):
-        tasks_copy = self.background_tasks.copy()
+        with self._tasks_lock:
+            tasks_copy = self.background_tasks.copy()
+
         for task in tasks_copy.values():
             task.cancel()
 
@@ -530,16 +1148,61 @@ def _proxy_to_queue(
     queue: Queue,
     bridge: definitions.AgentStub,
     input: definitions.FunctionCall,
+    log_hook: Callable[[definitions.Log], None] | None = None,
+    task: RunTask | None = None,
+    drain_output: Callable[[], None] | None = None,
 ) -> None:
-    for message in bridge.Run(input):
-        queue.put_nowait(message)
+    call = bridge.Run(input)
+    if task is not None:
+        task.call = call
+        if task.cancelled:
+            call.cancel()
+
+    try:
+        for message in call:
+            if message.logs and log_hook is not None:
+                # Logs captured by the agent itself go through the same handling
+                # as the ones from its stdout/stderr.
+                for raw_log in message.logs:
+                    log_hook(raw_log)
+
+                if not message.is_complete and not message.HasField("result"):
+                    continue
+                del message.logs[:]
+
+            if message.is_complete and drain_output is not None:
+                # Everything the agent has written to its stdout/stderr before
+                # sending the result belongs to this run (and not to the next
+                # one that uses the same agent), so it has to be queued first.
+                drain_output()
+
+            queue.put_nowait(message)
+    except BaseException:
+        if drain_output is not None:
+            drain_output()
+        raise
 
 
 @dataclass
 class LogHandler:
+    """Forwards the logs of a run to its logger and its message queue.
+
+    Logs are not put into the queue one by one, but they are collected until
+    the consumer of the queue is ready to send them. The handler itself is put
+    into the queue when the first log of a new batch arrives, and the consumer
+    calls flush() when it gets to it, which returns all the logs collected so
+    far (including the ones that arrived in the meantime)."""
+
     messages: Queue
     # Reference to the task so we can change the logger
     task: RunTask
+    max_batch_count: int = LOG_BATCH_MAX_COUNT
+    max_batch_size: int = LOG_BATCH_MAX_SIZE
+    max_latency: float = LOG_BATCH_MAX_LATENCY
+
+    _pending_logs: list[Log] = field(default_factory=list)
+    _pending_since: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
 
     def handle(self, log: Log) -> None:
         if not SKIP_EMPTY_LOGS or log.message_str().strip():
@@ -557,13 +1220,274 @@ class LogHandler:
             # but still log them to the logger.
             return
 
-        grpc_log = cast(definitions.Log, to_grpc(log))
-        grpc_result = definitions.PartialRunResult(
-            is_complete=False,
-            logs=[grpc_log],
-            result=None,
+        with self._lock:
+            self._pending_logs.append(log)
+            if len(self._pending_logs) > 1:
+                # The consumer is already notified about this batch.
+                return None
+
+            self._pending_since = time.monotonic()
+
+        self.messages.put_nowait(self)
+
+    def flush_delay(self) -> float:
+        """Number of seconds to wait for more logs before flushing the
+        current batch."""
+        with self._lock:
+            if len(self._pending_logs) >= self.max_batch_count:
+                return 0.0
+            remaining = self._pending_since + self.max_latency - time.monotonic()
+        return max(remaining, 0.0)
+
+    def flush(self) -> list[definitions.PartialRunResult]:
+        with self._lock:
+            pending_logs, self._pending_logs = self._pending_logs, []
+
+        # Converted here (in bulk) rather than in the thread producing them.
+        batches = []
+        batch: list[definitions.Log] = []
+        batch_size = 0
+        for grpc_log in logs_to_grpc(pending_logs):
+            if batch and (
+                len(batch) >= self.max_batch_count
+                or batch_size + len(grpc_log.message) > self.max_batch_size
+            ):
+                batches.append(batch)
+                batch, batch_size = [], 0
+
+            batch.append(grpc_log)
+            batch_size += len(grpc_log.message)
+
+        if batch:
+            batches.append(batch)
+
+        return [
+            definitions.PartialRunResult(is_complete=False, logs=batch, result=None)
+            for batch in batches
+        ]
+
+
+class AsyncMessageQueue:
+    """A queue that can be fed from any thread (through put_nowait, the only
+    method the producers like LogHandler and _proxy_to_queue use) while being
+    consumed from an asyncio event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def put_nowait(self, item: Any) -> None:
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    async def get(self) -> Any:
+        return await self._queue.get()
+
+    def get_nowait(self) -> Any:
+        return self._queue.get_nowait()
+
+    def empty(self) -> bool:
+        return self._queue.empty()
+
+
+@dataclass
+class AsyncIsolateServicer(definitions.IsolateServicer):
+    """An asyncio front-end of the IsolateServicer for grpc.aio servers.
+
+    Runs are driven as coroutines on the event loop, so a long running function
+    never holds on to a server thread and List/Cancel/Submit calls are always
+    served. Blocking steps of a run (building environments, spawning agents and
+    proxying their results) are offloaded to a worker pool, and the number of
+    runs that can be active at the same time is bounded by a semaphore."""
+
+    servicer: IsolateServicer
+    max_concurrent_runs: int = MAX_CONCURRENT_RUNS
+
+    _run_semaphore: asyncio.Semaphore | None = field(default=None, init=False)
+    _executor: futures.ThreadPoolExecutor = field(init=False)
+
+    def __post_init__(self) -> None:
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent_runs
+        )
+
+    @property
+    def run_semaphore(self) -> asyncio.Semaphore:
+        # Semaphore needs to be created from within the event loop
+        # on older Python versions.
+        if self._run_semaphore is None:
+            self._run_semaphore = asyncio.Semaphore(self.max_concurrent_runs)
+        return self._run_semaphore
+
+    async def _run_task(
+        self, task: RunTask
+    ) -> AsyncIterator[definitions.PartialRunResult]:
+        loop = asyncio.get_running_loop()
+        messages = AsyncMessageQueue(loop)
+        # Materializing the local environment might mean building it.
+        environments, extra_inheritance_paths = await loop.run_in_executor(
+            self._executor,
+            self.servicer._prepare_environments,  # type: ignore[arg-type]
+            task,
+            messages,
+        )
+
+        creation_future = loop.run_in_executor(
+            self._executor, self.servicer._create_environments, environments
+        )
+        async for message in self.watch_queue_until_completed(
+            messages, creation_future
+        ):
+            yield message
+
+        environment_paths = creation_future.result()
+        if task.cancelled:
+            return
+
+        connection = self.servicer._make_connection(
+            environments, environment_paths, extra_inheritance_paths
         )
-        self.messages.put_nowait(grpc_result)
+
+        # Releasing the agent might terminate the evicted ones (and wait for
+        # them to exit), so the stack is closed outside of the event loop.
+        stack = ExitStack()
+        try:
+            agent = await loop.run_in_executor(
+                self._executor,
+                stack.enter_context,
+                self.servicer.bridge_manager.establish(
+                    connection,
+                    queue=messages,  # type: ignore[arg-type]
+                ),
+            )
+            task.agent = agent
+            if task.cancelled:
+                return
+
+            queue = self.servicer._select_queue(
+                agent,
+                messages,  # type: ignore[arg-type]
+            )
+            future = loop.run_in_executor(
+                self._executor,
+                functools.partial(
+                    _proxy_to_queue,
+                    queue=queue,
+                    bridge=agent.stub,
+                    input=self.servicer._make_function_call(task),
+                    log_hook=self.servicer._make_agent_log_hook(task, agent, queue),
+                    task=task,
+                    drain_output=agent.drain_output,
+                ),
+            )
+            async for message in self.watch_queue_until_completed(
+                queue,  # type: ignore[arg-type]
+                future,
+            ):
+                yield message
+
+            exception = future.exception()
+            if exception is not None:
+                for message in self.servicer._handle_agent_error(agent, exception):
+                    yield message
+        finally:
+            await loop.run_in_executor(self._executor, stack.close)
+
+    async def watch_queue_until_completed(
+        self, queue: AsyncMessageQueue, future: asyncio.Future
+    ) -> AsyncIterator[definitions.PartialRunResult]:
+        """Asynchronous counterpart of IsolateServicer.watch_queue_until_completed."""
+
+        completion_marker = object()
+        future.add_done_callback(lambda _: queue.put_nowait(completion_marker))
+
+        timer = time.monotonic()
+        while True:
+            remaining = EMPTY_MESSAGE_INTERVAL - (time.monotonic() - timer)
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=max(remaining, 0))
+            except asyncio.TimeoutError:
+                timer = time.monotonic()
+                yield definitions.PartialRunResult(
+                    is_complete=False,
+                    logs=[],
+                    result=None,
+                )
+                continue
+
+            if message is completion_marker:
+                break
+            elif isinstance(message, definitions.PartialRunResult):
+                yield message
+            elif isinstance(message, LogHandler):
+                await asyncio.sleep(message.flush_delay())
+                for log_batch in message.flush():
+                    yield log_batch
+
+        # Clear the final messages
+        while not queue.empty():
+            message = queue.get_nowait()
+            if isinstance(message, definitions.PartialRunResult):
+                yield message
+            elif isinstance(message, LogHandler):
+                for log_batch in message.flush():
+                    yield log_batch
+
+    async def Run(
+        self,
+        request: definitions.BoundFunction,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[definitions.PartialRunResult]:
+        task = RunTask(request=request)
+        task_id = self.servicer.register_task(task)
+        try:
+            await context.send_initial_metadata(((TASK_ID_METADATA_KEY, task_id),))
+            async with self.run_semaphore:
+                async for message in self._run_task(task):
+                    yield message
+        except GRPCException as exc:
+            self.servicer.abort_with_msg(
+                exc.message,
+                context,  # type: ignore[arg-type]
+                code=exc.code,
+            )
+        finally:
+            self.servicer.unregister_task(task_id)
+
+    async def Submit(
+        self,
+        request: definitions.SubmitRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> definitions.SubmitResponse:
+        return self.servicer.Submit(request, context)  # type: ignore[arg-type]
+
+    async def SetMetadata(
+        self,
+        request: definitions.SetMetadataRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> definitions.SetMetadataResponse:
+        return self.servicer.SetMetadata(request, context)  # type: ignore[arg-type]
+
+    async def List(
+        self,
+        request: definitions.ListRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> definitions.ListResponse:
+        return self.servicer.List(request, context)  # type: ignore[arg-type]
+
+    async def Cancel(
+        self,
+        request: definitions.CancelRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> definitions.CancelResponse:
+        # Cancellation waits for the agent to shut down, so keep it
+        # away from the event loop.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.servicer.Cancel, request, context)
+
+    async def shutdown(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.servicer.shutdown)
+        self._executor.shutdown(wait=False)
 
 
 @dataclass
@@ -686,6 +1610,13 @@ class SingleTaskInterceptor(ServerBoundInterceptor):
         return wrap_server_method_handler(wrapper, handler)
 
 
+_SKIPPED_AUTH_METHODS = [
+    # Already used in deployed apps without authentication, so open it up
+    # for now and then close it again after rolling new version for all users.
+    "/Isolate/SetMetadata",
+]
+
+
 class ControllerAuthInterceptor(ServerBoundInterceptor):
     def __init__(self, controller_auth_key: str) -> None:
         super().__init__()
@@ -697,13 +1628,7 @@ class ControllerAuthInterceptor(ServerBoundInterceptor):
         )
 
     def intercept_service(self, continuation, handler_call_details):
-        skipped_auth_methods = [
-            # Already used in deployed apps without authentication, so open it up
-            # for now and then close it again after rolling new version for all users.
-            "/Isolate/SetMetadata",
-        ]
-
-        if handler_call_details.method in skipped_auth_methods:
+        if handler_call_details.method in _SKIPPED_AUTH_METHODS:
             print(f"[debug] Skipping authentication for {handler_call_details.method}")
             # Let these requests pass through without authentication
             return continuation(handler_call_details)
@@ -716,6 +1641,116 @@ class ControllerAuthInterceptor(ServerBoundInterceptor):
         return continuation(handler_call_details)
 
 
+class AsyncControllerAuthInterceptor(grpc.aio.ServerInterceptor):
+    """Equivalent of ControllerAuthInterceptor for grpc.aio servers."""
+
+    def __init__(self, controller_auth_key: str) -> None:
+        self.controller_auth_key = controller_auth_key
+
+        async def terminate(request: Any, context: grpc.aio.ServicerContext) -> Any:
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, "Unauthorized")
+
+        self._terminator = grpc.unary_unary_rpc_method_handler(terminate)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        if handler_call_details.method in _SKIPPED_AUTH_METHODS:
+            print(f"[debug] Skipping authentication for {handler_call_details.method}")
+            return await continuation(handler_call_details)
+
+        metadata = dict(handler_call_details.invocation_metadata)
+        controller_token = metadata.get("controller-token")
+        if controller_token != self.controller_auth_key:
+            return self._terminator
+
+        return await continuation(handler_call_details)
+
+
+@contextmanager
+def run_cache_sweeper(
+    bridge_manager: BridgeManager,
+    *,
+    max_size: int | None = CACHE_MAX_SIZE,
+    max_entries: int | None = CACHE_MAX_ENTRIES,
+    interval: float = CACHE_SWEEP_INTERVAL,
+    settings: IsolateSettings | None = None,
+) -> Iterator[None]:
+    """Periodically evict the least recently used environments from the cache
+    in the background (as long as any quotas are set), skipping the ones that
+    have a live agent."""
+    if max_size is None and max_entries is None:
+        yield
+        return
+
+    cache_manager = CacheManager(
+        settings=settings or IsolateSettings(),
+        max_size=max_size,
+        max_entries=max_entries,
+        is_in_use=bridge_manager.is_in_use,
+    )
+    stop_event = threading.Event()
+    sweeper = threading.Thread(
+        target=cache_manager.sweep_periodically,
+        args=(interval, stop_event),
+        name="isolate-cache-sweeper",
+        daemon=True,
+    )
+    sweeper.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+
+
+async def serve_aio(
+    port: int,
+    *,
+    max_concurrent_runs: int = MAX_CONCURRENT_RUNS,
+    controller_auth_key: str | None = None,
+    bridge_manager: BridgeManager | None = None,
+) -> None:
+    """Serve the isolate service through an asyncio based gRPC server."""
+    interceptors: list[grpc.aio.ServerInterceptor] = []
+    if controller_auth_key:
+        interceptors.append(AsyncControllerAuthInterceptor(controller_auth_key))
+
+    server = grpc.aio.server(
+        options=get_default_options(),
+        interceptors=interceptors,
+    )
+
+    with bridge_manager or BridgeManager() as bridge_manager:
+        servicer = AsyncIsolateServicer(
+            IsolateServicer(bridge_manager),
+            max_concurrent_runs=max_concurrent_runs,
+        )
+
+        definitions.register_isolate(servicer, server)
+        health.register_health(HealthServicer(), server)
+
+        loop = asyncio.get_running_loop()
+
+        async def terminate() -> None:
+            await servicer.shutdown()
+            await server.stop(grace=0.1)
+
+        def handle_termination() -> None:
+            print("Termination signal received, shutting down...")
+            loop.create_task(terminate())
+
+        def handle_child_termination() -> None:
+            print("Child termination signal received, aborting unreachable agents...")
+            loop.run_in_executor(None, bridge_manager.abort_unreachable_agents)
+
+        loop.add_signal_handler(signal.SIGINT, handle_termination)
+        loop.add_signal_handler(signal.SIGTERM, handle_termination)
+        loop.add_signal_handler(signal.SIGCHLD, handle_child_termination)
+
+        server.add_insecure_port(f"[::]:{port}")
+        await server.start()
+        await server.wait_for_termination()
+        print("Server shut down")
+
+
 def main(argv: list[str] | None = None) -> None:
     parser = ArgumentParser()
     parser.add_argument("--host", default="0.0.0.0")
@@ -731,20 +1766,116 @@ def main(argv: list[str] | None = None) -> None:
         default=MAX_THREADS,
         help="Number of worker threads to use for the gRPC server.",
     )
+    parser.add_argument(
+        "--aio",
+        action="store_true",
+        help="Serve through an asyncio based gRPC server, where Run calls do not "
+        "occupy a worker thread each.",
+    )
+    parser.add_argument(
+        "--max-concurrent-runs",
+        type=int,
+        default=MAX_CONCURRENT_RUNS,
+        help="Maximum number of Run calls to process at the same time (only "
+        "applies to the asyncio server).",
+    )
+    parser.add_argument(
+        "--agent-pool-min-idle",
+        type=int,
+        default=AGENT_POOL_MIN_IDLE,
+        help="Number of idle agents to keep started ahead of time for each "
+        "environment that was used before.",
+    )
+    parser.add_argument(
+        "--agent-pool-max-idle",
+        type=int,
+        default=AGENT_POOL_MAX_IDLE,
+        help="Maximum number of idle agents to keep for each environment.",
+    )
+    parser.add_argument(
+        "--agent-pool-max-total-idle",
+        type=int,
+        default=AGENT_POOL_MAX_TOTAL_IDLE,
+        help="Maximum number of idle agents to keep across all environments.",
+    )
+    parser.add_argument(
+        "--agent-idle-ttl",
+        type=float,
+        default=AGENT_IDLE_TTL,
+        help="Number of seconds an agent can stay idle before it is terminated.",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=parse_size,
+        default=CACHE_MAX_SIZE,
+        help="Maximum total size of the cached environments (e.g. 50G), the "
+        "least recently used ones are evicted when it is exceeded.",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=CACHE_MAX_ENTRIES,
+        help="Maximum number of cached environments to keep.",
+    )
+    parser.add_argument(
+        "--cache-sweep-interval",
+        type=float,
+        default=CACHE_SWEEP_INTERVAL,
+        help="Number of seconds between the checks of the cache quotas.",
+    )
 
     options = parser.parse_args(argv)
     if options.num_workers is None:
         options.num_workers = 1 if options.single_use else os.cpu_count()
 
-    interceptors: list[ServerBoundInterceptor] = []
-    if options.single_use:
-        interceptors.append(SingleTaskInterceptor())
+    if options.aio and options.single_use:
+        parser.error("--single-use is not supported with --aio.")
+
+    try:
+        bridge_manager = BridgeManager(
+            min_idle_agents=options.agent_pool_min_idle,
+            max_idle_agents=options.agent_pool_max_idle,
+            max_total_idle_agents=options.agent_pool_max_total_idle,
+            agent_idle_ttl=options.agent_idle_ttl,
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    cache_sweeper = run_cache_sweeper(
+        bridge_manager,
+        max_size=options.cache_max_size,
+        max_entries=options.cache_max_entries,
+        interval=options.cache_sweep_interval,
+    )
 
     controller_auth_key = os.getenv("ISOLATE_CONTROLLER_AUTH_KEY")
     if not controller_auth_key:
         # DEPRECATED: remove this after rolling new version of controller
         controller_auth_key = os.getenv("CONTROLLER_KEY")
 
+    if options.aio:
+        if not controller_auth_key:
+            print(
+                "[WARN] ISOLATE_CONTROLLER_AUTH_KEY is not set, all requests will be "
+                "accepted without authentication."
+            )
+
+        print(f"Started listening at {options.host}:{options.port}")
+        with cache_sweeper:
+            asyncio.run(
+                serve_aio(
+                    options.port,
+                    max_concurrent_runs=options.max_concurrent_runs,
+                    controller_auth_key=controller_auth_key,
+                    bridge_manager=bridge_manager,
+                )
+            )
+        return
+
+    interceptors: list[ServerBoundInterceptor] = []
+    if options.single_use:
+        interceptors.append(SingleTaskInterceptor())
+
     if controller_auth_key:
         # Set an interceptor to only accept requests with the correct auth key
         interceptors.append(ControllerAuthInterceptor(controller_auth_key))
@@ -763,7 +1894,7 @@ def main(argv: list[str] | None = None) -> None:
     for interceptor in interceptors:
         interceptor.register_server(server)
 
-    with BridgeManager() as bridge_manager:
+    with bridge_manager, cache_sweeper:
         servicer = IsolateServicer(bridge_manager)
 
         for interceptor in interceptors:
@@ -1,3 +1,5 @@
+import contextlib
+import shutil
 import subprocess
 import sys
 import textwrap
@@ -9,7 +11,18 @@ from typing import Any, Dict, List, Optional, Type
 import isolate
 import pytest
 from isolate.backends import BaseEnvironment, EnvironmentCreationError
-from isolate.backends.common import Requirements, get_executable, sha256_digest_of
+from isolate.backends.cache import CacheManager, parse_size
+from isolate.backends.common import (
+    Requirements,
+    drain_logged_io,
+    get_executable,
+    is_locked_in_use,
+    link_into_store,
+    lock_build_path,
+    logged_io,
+    prune_store,
+    sha256_digest_of,
+)
 from isolate.backends.conda import CondaEnvironment
 from isolate.backends.local import LocalPythonEnvironment
 from isolate.backends.pyenv import PyenvEnvironment, _get_pyenv_executable
@@ -128,6 +141,20 @@ class GenericEnvironmentTests:
         ]:
             assert self.get_example_version(environment, connection_key) == version
 
+    def test_create_records_use(self, tmp_path):
+        import os
+
+        environment = self.get_project_environment(tmp_path, "new-example-project")
+        connection_key = environment.create()
+
+        last_used_marker = environment.settings.last_used_marker_for(connection_key)
+        assert last_used_marker.exists()
+
+        # Returning the environment from the cache counts as a use.
+        os.utime(last_used_marker, (0, 0))
+        assert environment.create() == connection_key
+        assert last_used_marker.stat().st_mtime > 0
+
     def test_failure_during_environment_creation_cache(self, tmp_path, monkeypatch):
         environment = self.get_project_environment(tmp_path, "new-example-project")
         with pytest.raises(EnvironmentCreationError):
@@ -445,6 +472,130 @@ class TestVirtualenv(GenericEnvironmentTests):
 
         assert installed == [["pip==23.0.1"], ["pyjokes==0.6.0"]]
 
+    def test_requirements_layers_cached(self, tmp_path, monkeypatch):
+        installed = []
+
+        def fake_install_packages(self, path, requirements):
+            installed.append(list(requirements))
+
+        class DummyVirtualenv:
+            @staticmethod
+            def cli_run(args):
+                Path(args[0]).mkdir(parents=True, exist_ok=True)
+                (Path(args[0]) / "bin").mkdir()
+                (Path(args[0]) / "pyvenv.cfg").write_text(f"command = {args[0]}")
+
+        monkeypatch.setattr(
+            "isolate.backends.virtualenv.optional_import", lambda _: DummyVirtualenv
+        )
+        monkeypatch.setattr(
+            VirtualPythonEnvironment, "_install_packages", fake_install_packages
+        )
+
+        def create(layers, force=False):
+            environment = VirtualPythonEnvironment(
+                requirements=Requirements.from_raw(layers),
+            )
+            environment.apply_settings(
+                IsolateSettings(Path(tmp_path), cache_layers=True)
+            )
+            return environment.create(force=force)
+
+        create([["pip==23.0.1"], ["pyjokes==0.6.0"], ["black==22.12.0"]])
+        assert installed == [["pip==23.0.1"], ["pyjokes==0.6.0"], ["black==22.12.0"]]
+
+        # Only the layers after the longest cached prefix are installed.
+        installed.clear()
+        path = create([["pip==23.0.1"], ["pyjokes==0.6.0"], ["pyjokes==0.5.0"]])
+        assert installed == [["pyjokes==0.5.0"]]
+        assert (path / "pyvenv.cfg").read_text() == f"command = {path}"
+
+        installed.clear()
+        path = create([["pip==23.0.1"], ["pyjokes==0.5.0"]])
+        assert installed == [["pyjokes==0.5.0"]]
+
+        # Re-creating an existing environment starts from a fresh clone.
+        (path / "leftover").touch()
+        installed.clear()
+        assert create([["pip==23.0.1"], ["pyjokes==0.5.0"]], force=True) == path
+        assert installed == [["pyjokes==0.5.0"]]
+        assert not (path / "leftover").exists()
+        assert (path / "pyvenv.cfg").read_text() == f"command = {path}"
+
+        def copytree(*args, **kwargs):
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(shutil, "copytree", copytree)
+        with pytest.raises(EnvironmentCreationError, match="No space left"):
+            create([["pip==23.0.1"], ["pyjokes==0.5.0"]], force=True)
+
+    def test_requirements_layers_cached_environment(self, tmp_path):
+        settings = IsolateSettings(Path(tmp_path), cache_layers=True)
+        base = self.get_environment(tmp_path, {"requirements": ["pyjokes==0.5.0"]})
+        base.apply_settings(settings)
+        base_path = base.create()
+
+        environment = self.get_environment(
+            tmp_path, {"requirements": [["pyjokes==0.5.0"], ["pip==23.0.1"]]}
+        )
+        environment.apply_settings(settings)
+        path = environment.create()
+        assert path != base_path
+
+        # The cloned environment is fully functional in its new location.
+        assert self.get_example_version(environment, path) == "0.5.0"
+        pip_version = self._run_cmd_in(path, "pip", "--version")
+        assert "pip 23.0.1" in pip_version
+        assert str(path) in pip_version
+        assert "pip 23.0.1" not in self._run_cmd_in(base_path, "pip", "--version")
+
+    def _run_cmd_in(self, path: Path, executable: str, *args: str) -> str:
+        return subprocess.check_output([path / "bin" / executable, *args], text=True)
+
+    def test_package_store(self, tmp_path):
+        # Same packages, but different environments.
+        environments = [
+            self.get_environment(
+                tmp_path, {"requirements": ["pyjokes==0.6.0"], "tags": [tag]}
+            )
+            for tag in ("first", "second")
+        ]
+
+        paths = []
+        for environment in environments:
+            environment.apply_settings(environment.settings.replace(package_store=True))
+            paths.append(environment.create())
+
+        first_files, second_files = (
+            {
+                file.relative_to(path): file.stat()
+                for file in path.glob("lib/*/site-packages/pyjokes/*.py")
+            }
+            for path in paths
+        )
+        assert first_files
+        assert first_files.keys() == second_files.keys()
+        for relative_path, file_stat in first_files.items():
+            assert file_stat.st_ino == second_files[relative_path].st_ino
+
+        for environment, path in zip(environments, paths):
+            assert self.get_example_version(environment, path) == "0.6.0"
+
+    def test_live_agents_keep_environments_in_use(self, tmp_path):
+        environment = self.get_project_environment(tmp_path, "empty")
+        path = environment.create()
+        in_use_marker = environment.settings.in_use_marker_for(path)
+
+        manager = CacheManager(environment.settings, max_entries=0, grace_period=0)
+        with environment.open_connection(path) as connection:
+            # The agent is kept alive until the connection is closed.
+            assert connection.run(partial(eval, "1 + 1")) == 2
+            assert is_locked_in_use(in_use_marker)
+            assert manager.collect() == []
+
+        assert not is_locked_in_use(in_use_marker)
+        assert [entry.path for entry in manager.collect()] == [path]
+
     @pytest.mark.skipif(not UV_PATH, reason="uv is not available")
     def test_try_using_uv(self, tmp_path):
         environment = self.get_environment(
@@ -999,3 +1150,508 @@ def test_virtual_env_custom_python_version_with_pyenv(tmp_path, monkeypatch):
             connection.run(partial(eval, "__import__('pyjokes').__version__"))
             == "0.6.0"
         )
+
+
+@pytest.mark.parametrize("use_flock", [True, False])
+def test_lock_build_path_is_exclusive(tmp_path, monkeypatch, use_flock):
+    import threading
+    import time
+
+    monkeypatch.setattr("isolate.backends.common._USE_FLOCK", use_flock)
+
+    events = []
+    first_acquired = threading.Event()
+
+    def hold_lock():
+        with lock_build_path(tmp_path / "env", tmp_path):
+            first_acquired.set()
+            events.append("first-acquired")
+            time.sleep(0.5)
+            events.append("first-released")
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    first_acquired.wait(timeout=5)
+
+    with lock_build_path(tmp_path / "env", tmp_path):
+        events.append("second-acquired")
+
+    thread.join()
+    assert events == ["first-acquired", "first-released", "second-acquired"]
+
+
+def test_lock_build_path_released_on_process_death(tmp_path):
+    import time
+
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            textwrap.dedent(
+                f"""
+                import time
+                from pathlib import Path
+                from isolate.backends.common import lock_build_path
+
+                path = Path({str(tmp_path)!r})
+                with lock_build_path(path / "env", path):
+                    print("locked", flush=True)
+                    time.sleep(60)
+                """
+            ),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert holder.stdout is not None
+        assert holder.stdout.readline().strip() == "locked"
+    finally:
+        holder.kill()
+        holder.wait()
+
+    # The lock is gone with the process, no need to wait until it
+    # gets stale.
+    started_at = time.monotonic()
+    with lock_build_path(tmp_path / "env", tmp_path):
+        pass
+    assert time.monotonic() - started_at < 5
+
+
+@pytest.mark.parametrize("holder_uses_flock", [True, False])
+def test_lock_build_path_mixed_modes(tmp_path, monkeypatch, holder_uses_flock):
+    import os
+    import time
+
+    # The processes that use flock() and the ones that can't (or run an older
+    # version of isolate) exclude each other.
+    monkeypatch.setattr("isolate.backends.common._USE_FLOCK", not holder_uses_flock)
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            textwrap.dedent(
+                f"""
+                import time
+                from pathlib import Path
+                from isolate.backends.common import lock_build_path
+
+                path = Path({str(tmp_path)!r})
+                with lock_build_path(path / "env", path):
+                    print("locked", flush=True)
+                    time.sleep(2)
+                    print("released", flush=True)
+                """
+            ),
+        ],
+        env={
+            **os.environ,
+            "ISOLATE_DISABLE_FLOCK": "0" if holder_uses_flock else "1",
+        },
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert holder.stdout is not None
+        assert holder.stdout.readline().strip() == "locked"
+
+        started_at = time.monotonic()
+        with lock_build_path(tmp_path / "env", tmp_path):
+            # Acquired once the holder is done, not when its lock got stale.
+            assert 1 < time.monotonic() - started_at < 10
+            assert holder.stdout.readline().strip() == "released"
+    finally:
+        holder.kill()
+        holder.wait()
+
+
+@pytest.mark.parametrize("legacy_lock_compat", [True, False])
+def test_lock_build_path_keep_alive_threads(tmp_path, monkeypatch, legacy_lock_compat):
+    import threading
+
+    monkeypatch.setattr("isolate.backends.common._USE_FLOCK", True)
+    monkeypatch.setattr(
+        "isolate.backends.common._LEGACY_LOCK_COMPAT", legacy_lock_compat
+    )
+
+    lock_file = tmp_path / "env.lock"
+    threads = threading.active_count()
+    with lock_build_path(tmp_path / "env", tmp_path):
+        # The lock file is still created for the processes without flock, but
+        # it is only kept alive (by a thread) for the older versions of isolate.
+        assert lock_file.read_bytes() == b"flock"
+        assert threading.active_count() == threads + legacy_lock_compat
+
+    assert not lock_file.exists()
+
+
+def test_lock_build_path_checks_the_flock_of_lock_files(tmp_path):
+    import os
+
+    from isolate.backends.common import _acquire_flock, _release_flock, _try_acquire
+
+    # A lock file created by a flock holder, which doesn't keep it alive.
+    lock_file = tmp_path / "env.lock"
+    lock_file.write_bytes(b"flock")
+    os.utime(lock_file, (0, 0))
+
+    # The processes without flock don't revoke it while the flock is held.
+    lock_fd = _acquire_flock(tmp_path / "env.flock")
+    try:
+        assert not _try_acquire(lock_file)
+        assert lock_file.exists()
+    finally:
+        _release_flock(lock_fd)
+
+    # But they revoke it right away once the flock is released (e.g. the
+    # holder has died).
+    os.utime(lock_file)
+    assert _try_acquire(lock_file)
+    assert lock_file.read_bytes() == b""
+
+
+def test_lock_build_path_falls_back_without_flock_support(tmp_path, monkeypatch):
+    import errno
+
+    def flock(*args: Any) -> None:
+        raise OSError(errno.ENOLCK, "No locks available")
+
+    monkeypatch.setattr("fcntl.flock", flock)
+    monkeypatch.setattr(
+        "isolate.backends.common._supports_flock",
+        isolate.backends.common._supports_flock.__wrapped__,
+    )
+    lock_file = tmp_path / "env.lock"
+    with lock_build_path(tmp_path / "env", tmp_path):
+        # The fallback mode holds the lock through the file's existence.
+        assert lock_file.exists()
+
+    assert not lock_file.exists()
+
+
+def test_link_into_store(tmp_path):
+    import os
+
+    store_dir = tmp_path / "store"
+    first, second = tmp_path / "first", tmp_path / "second"
+    for path in (first, second):
+        (path / "pkg").mkdir(parents=True)
+        (path / "pkg" / "module.py").write_text("print('hello')")
+        (path / "pkg" / "empty.py").touch()
+        (path / "python").symlink_to(sys.executable)
+
+    (first / "pkg" / "unique.py").write_text("print('first')")
+    (second / "pkg" / "unique.py").write_text("print('second')")
+    (second / "pkg" / "script.py").write_text("print('hello')")
+    os.chmod(second / "pkg" / "script.py", 0o755)
+
+    # Nothing to link for the first environment, it only populates the store.
+    assert link_into_store(first, store_dir).file_count == 0
+
+    stats = link_into_store(second, store_dir)
+    assert stats.file_count == 1
+    assert stats.total_size == len("print('hello')")
+
+    def inode(path):
+        return path.stat().st_ino
+
+    assert inode(first / "pkg" / "module.py") == inode(second / "pkg" / "module.py")
+    assert inode(first / "pkg" / "unique.py") != inode(second / "pkg" / "unique.py")
+    # Different permissions, so they are stored separately.
+    assert inode(second / "pkg" / "script.py") != inode(second / "pkg" / "module.py")
+    assert (second / "pkg" / "unique.py").read_text() == "print('second')"
+    assert (second / "python").is_symlink()
+
+    # Linking again is a no-op.
+    assert link_into_store(second, store_dir).file_count == 0
+
+    # Files stay in the store as long as some environment uses them.
+    shutil.rmtree(first)
+    assert prune_store(store_dir).file_count == 1
+    shutil.rmtree(second)
+    assert prune_store(store_dir).file_count == 3
+    assert not list(store_dir.glob("*/*"))
+
+
+def make_cached_environment(settings, name, size, last_used):
+    import os
+
+    path = settings.cache_dir / "virtualenv" / name
+    path.mkdir(parents=True)
+    (path / "data").write_bytes(b"x" * size)
+    settings.record_use(path)
+    os.utime(settings.last_used_marker_for(path), (last_used, last_used))
+    return path
+
+
+def test_cache_manager_evicts_least_recently_used(tmp_path):
+    import time
+
+    settings = IsolateSettings(cache_dir=tmp_path)
+    now = time.time()
+    oldest = make_cached_environment(settings, "oldest", 4096, now - 300)
+    old = make_cached_environment(settings, "old", 4096, now - 200)
+    new = make_cached_environment(settings, "new", 4096, now - 100)
+    recent = make_cached_environment(settings, "recent", 4096, now)
+
+    # The most recent one is within the grace period, so it is kept
+    # even though it would be the only one left.
+    manager = CacheManager(settings, max_entries=0, grace_period=60)
+    dry_run = manager.collect(dry_run=True)
+    assert [entry.path for entry in dry_run] == [oldest, old, new]
+    assert all(path.exists() for path in (oldest, old, new, recent))
+
+    manager = CacheManager(settings, max_entries=2, grace_period=60)
+    evicted = manager.collect()
+    assert [entry.path for entry in evicted] == [oldest, old]
+    assert not oldest.exists()
+    assert not old.exists()
+    assert new.exists()
+    assert recent.exists()
+
+    # Environments that are in use are never evicted.
+    manager = CacheManager(
+        settings,
+        max_entries=0,
+        grace_period=0,
+        is_in_use=lambda path: path == new,
+    )
+    assert [entry.path for entry in manager.collect()] == [recent]
+    assert new.exists()
+
+
+def test_cache_cli_skips_environments_in_use_by_other_processes(tmp_path):
+    import time
+
+    from isolate.backends.cache import main
+
+    settings = IsolateSettings(cache_dir=tmp_path)
+    path = make_cached_environment(settings, "env", 4096, time.time() - 300)
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            textwrap.dedent(
+                f"""
+                import time
+                from pathlib import Path
+                from isolate.backends.common import lock_in_use
+
+                lock_in_use(Path({str(settings.in_use_marker_for(path))!r}))
+                print("locked", flush=True)
+                time.sleep(60)
+                """
+            ),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert holder.stdout is not None
+        assert holder.stdout.readline().strip() == "locked"
+
+        cli_args = ["--cache-dir", str(tmp_path), "--max-entries", "0"]
+        main(cli_args)
+        assert path.exists()
+    finally:
+        holder.kill()
+        holder.wait()
+
+    # The lock is gone with the process.
+    main(cli_args)
+    assert not path.exists()
+
+
+def test_cache_manager_max_size(tmp_path):
+    import time
+
+    settings = IsolateSettings(cache_dir=tmp_path)
+    now = time.time()
+    old = make_cached_environment(settings, "old", 64 * 1024, now - 200)
+    new = make_cached_environment(settings, "new", 64 * 1024, now - 100)
+
+    manager = CacheManager(settings, max_size=100 * 1024, grace_period=0)
+    assert [entry.path for entry in manager.collect()] == [old]
+    assert new.exists()
+    assert manager.collect() == []
+
+
+@pytest.mark.parametrize(
+    "raw_size, expected_size",
+    [
+        ("1024", 1024),
+        ("2K", 2048),
+        ("1.5M", 3 * 512 * 1024),
+        ("50G", 50 * 1024**3),
+        ("1gb", 1024**3),
+    ],
+)
+def test_parse_size(raw_size, expected_size):
+    assert parse_size(raw_size) == expected_size
+
+
+def test_drain_logged_io():
+    import os
+
+    lines: List[str] = []
+    with logged_io(lines.append) as (stdout, stderr, _):
+        os.write(stdout, b"first\nsecond\n")
+        os.write(stderr, b"incomplete")
+
+        # Everything that is written so far is forwarded by the time it
+        # returns (without waiting for the observer), including the lines
+        # that are not complete yet.
+        drain_logged_io(stdout, stderr)
+        assert sorted(lines) == ["first", "incomplete", "second"]
+
+        os.write(stdout, b"third\n")
+        drain_logged_io(stdout)
+        assert lines[-1] == "third"
+
+    # Streams that are not (or no longer) followed are ignored.
+    drain_logged_io(stdout)
+    assert len(lines) == 4
+
+
+def test_logged_io_shares_a_single_observer():
+    import os
+    import threading
+
+    outputs: Dict[str, List[str]] = {}
+    with contextlib.ExitStack() as stack:
+        fds = []
+        for name in ("first", "second", "third"):
+            lines = outputs.setdefault(name, [])
+            fds.append(stack.enter_context(logged_io(lines.append)))
+
+        for index, (stdout, stderr, _) in enumerate(fds):
+            subprocess.check_call(
+                [sys.executable, "-c", f"print('out {index}'); print('more {index}')"],
+                stdout=stdout,
+            )
+            subprocess.check_call(
+                [sys.executable, "-c", f"import sys; sys.stderr.write('err {index}')"],
+                stderr=stderr,
+            )
+
+        observers = [
+            thread
+            for thread in threading.enumerate()
+            if thread.name == "isolate-io-observer"
+        ]
+        assert len(observers) == 1
+
+    # Everything that was written before exiting the context is forwarded.
+    for index, name in enumerate(("first", "second", "third")):
+        assert sorted(outputs[name]) == sorted(
+            [f"out {index}", f"more {index}", f"err {index}"]
+        )
+
+    # All the pipes are closed.
+    for stdout, stderr, log_fd in fds:
+        for fd in (stdout, stderr, log_fd):
+            with pytest.raises(OSError):
+                os.fstat(fd)
+
+
+def test_followed_stream_line_framing():
+    import os
+
+    from isolate.backends.common import _FollowedStream, _unblocked_pipe
+
+    reader_fd, writer_fd = _unblocked_pipe()
+    lines: List[str] = []
+    stream = _FollowedStream(lines.append, max_line_length=8)
+
+    def feed(data: bytes) -> bool:
+        os.write(writer_fd, data)
+        return stream.forward_lines(reader_fd)
+
+    # Incomplete lines are held until their line break arrives.
+    assert feed(b"hello")
+    assert lines == []
+    assert feed(b" wo")
+    assert feed(b"rld\nsecond\r")
+    assert lines == ["hello wo", "rld"]
+
+    # A '\r\n' that is split between two reads is a single line break.
+    assert feed(b"\nthird\r\n\n")
+    assert lines == ["hello wo", "rld", "second", "third", ""]
+
+    # Long lines are split, even in the middle of a multi-byte character.
+    lines.clear()
+    assert feed("1234567ü89\n".encode())
+    assert lines == ["1234567", "ü89"]
+
+    lines.clear()
+    assert feed(b"\xff\xfebroken\n")
+    assert lines == ["\\xff\\xfebroken"]
+
+    # The incomplete line is forwarded at the EOF.
+    lines.clear()
+    os.write(writer_fd, b"last")
+    os.close(writer_fd)
+    assert not stream.forward_lines(reader_fd)
+    assert lines == ["last"]
+    os.close(reader_fd)
+
+
+def test_followed_stream_hook_errors():
+    import os
+
+    from isolate.backends.common import _FollowedStream, _unblocked_pipe
+
+    reader_fd, writer_fd = _unblocked_pipe()
+    lines: List[str] = []
+
+    def hook(line: str) -> None:
+        if line == "bad":
+            raise ValueError(line)
+        lines.append(line)
+
+    stream = _FollowedStream(hook)
+
+    # The lines after the failing one are still forwarded, and none of them
+    # are forwarded again on the next read.
+    os.write(writer_fd, b"first\nbad\nsecond\n")
+    assert stream.forward_lines(reader_fd)
+    os.write(writer_fd, b"third\n")
+    assert stream.forward_lines(reader_fd)
+    assert lines == ["first", "second", "third"]
+
+    os.close(writer_fd)
+    os.close(reader_fd)
+
+
+def test_logged_io_slow_hooks_dont_block_other_streams():
+    import threading
+    import time
+
+    hook_called = threading.Event()
+    release_hook = threading.Event()
+
+    def slow_hook(line: str) -> None:
+        hook_called.set()
+        release_hook.wait(timeout=30)
+
+    def failing_hook(line: str) -> None:
+        raise ValueError(line)
+
+    try:
+        with logged_io(slow_hook) as (stdout, _, _):
+            subprocess.check_call(
+                [sys.executable, "-c", "print('slow')"], stdout=stdout
+            )
+            assert hook_called.wait(timeout=5)
+
+            # Other streams can still be followed and unfollowed while
+            # the hook is busy, and their errors are not raised.
+            started_at = time.monotonic()
+            with logged_io(failing_hook) as (other_stdout, _, _):
+                subprocess.check_call(
+                    [sys.executable, "-c", "print('fail')"], stdout=other_stdout
+                )
+            assert time.monotonic() - started_at < 5
+            release_hook.set()
+    finally:
+        release_hook.set()
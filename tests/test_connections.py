@@ -1,7 +1,12 @@
+import glob
 import operator
+import os
+import subprocess
+import time
 import traceback
 from dataclasses import replace
 from functools import partial
+from multiprocessing.connection import wait
 from pathlib import Path
 from typing import Any, List
 
@@ -12,7 +17,10 @@ from isolate.backends.local import LocalPythonEnvironment
 from isolate.backends.settings import IsolateSettings
 from isolate.backends.virtualenv import VirtualPythonEnvironment
 from isolate.connections import LocalPythonGRPC, PythonIPC
+from isolate.connections._local import agent_socket_path
 from isolate.connections.common import is_agent
+from isolate.connections.ipc._base import _open_pidfd, encode_service_address
+from isolate.connections.ipc.agent import decode_service_address
 
 REPO_DIR = Path(__file__).parent.parent
 assert (
@@ -145,6 +153,20 @@ class GenericPythonConnectionTests:
             assert not is_agent()
         assert not is_agent()
 
+    def test_unix_sockets(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+        local_env = LocalPythonEnvironment()
+        local_env.apply_settings(local_env.settings.replace(agent_unix_sockets=True))
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            # The agent's socket lives in a private runtime directory.
+            [socket_path] = conn.run(partial(glob.glob, f"{tmp_path}/*/*"))
+            assert Path(socket_path).parent.name.startswith("isolate-")
+            assert Path(socket_path).name == "agent.sock"
+
+        # The runtime directory is removed with the agent.
+        assert not list(tmp_path.iterdir())
+
     def test_tracebacks(self):
         local_env = LocalPythonEnvironment()
         local_env.apply_settings(
@@ -183,6 +205,24 @@ class GenericPythonConnectionTests:
             assert "conn.run(long_function_chain)" in exception
 
 
+def test_agent_socket_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    with agent_socket_path() as socket_path:
+        assert socket_path.parent.parent == tmp_path
+        assert socket_path.parent.stat().st_mode & 0o777 == 0o700
+    assert not socket_path.parent.exists()
+
+    # Falls back to the temporary directory.
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "missing"))
+    with agent_socket_path() as socket_path:
+        assert socket_path.parent.exists()
+
+
+@pytest.mark.parametrize("address", [("127.0.0.1", 4321), "/tmp/isolate-x/a:b.sock"])
+def test_service_address_encoding(address):
+    assert decode_service_address(encode_service_address(address)) == address
+
+
 class TestPythonIPC(GenericPythonConnectionTests):
     def open_connection(
         self,
@@ -192,6 +232,91 @@ class TestPythonIPC(GenericPythonConnectionTests):
     ) -> EnvironmentConnection:
         return PythonIPC(environment, environment_path, **kwargs)
 
+    def test_agent_is_kept_alive_in_context(self):
+        local_env = LocalPythonEnvironment()
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            agent_pid = conn.run(os.getpid)
+            assert conn.run(os.getpid) == agent_pid
+
+            # Exceptions are sent back without affecting the agent.
+            with pytest.raises(ZeroDivisionError):
+                conn.run(partial(operator.truediv, 1, 0))
+            assert conn.run(os.getpid) == agent_pid
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            assert conn.run(os.getpid) != agent_pid
+
+    def test_agent_is_not_kept_alive_outside_context(self):
+        local_env = LocalPythonEnvironment()
+
+        conn = self.open_connection(local_env, local_env.create())
+        assert conn.run(os.getpid) != conn.run(os.getpid)
+
+    def test_agent_is_restarted_after_exit(self):
+        local_env = LocalPythonEnvironment()
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            agent_pid = conn.run(os.getpid)
+            with pytest.raises(OSError, match="exited unexpectedly"):
+                conn.run(partial(os._exit, 1))
+
+            assert conn.run(os.getpid) != agent_pid
+
+    def test_result_wakes_up_the_controller(self, monkeypatch):
+        local_env = LocalPythonEnvironment()
+        monkeypatch.setattr(PythonIPC, "_DEFER_THRESHOLD", 30)
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            started_at = time.monotonic()
+            assert conn.run(partial(time.sleep, 0.1)) is None
+            assert time.monotonic() - started_at < 10
+
+    @pytest.mark.skipif(not hasattr(os, "pidfd_open"), reason="Requires pidfd support.")
+    def test_pidfd(self):
+        process = subprocess.Popen(["sleep", "0.1"])
+        pidfd = _open_pidfd(process)
+        assert pidfd is not None
+        try:
+            assert wait([pidfd], timeout=10) == [pidfd]
+        finally:
+            os.close(pidfd)
+
+        # Once the process is reaped, its PID might belong to
+        # someone else.
+        assert process.wait() == 0
+        assert _open_pidfd(process) is None
+
+    def test_close(self):
+        local_env = LocalPythonEnvironment()
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            conn.run(os.getpid)
+            _, process, _ = conn._agent
+            conn.close()
+            assert conn._agent is None
+            assert process.poll() == 0
+
+            # The next call starts a new agent.
+            assert conn.run(partial(operator.add, 1, 2)) == 3
+
+    def test_concurrent_runs_share_the_agent(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        local_env = LocalPythonEnvironment()
+
+        with self.open_connection(local_env, local_env.create()) as conn:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(
+                    executor.map(
+                        lambda n: conn.run(partial(operator.add, n, 1)), range(32)
+                    )
+                )
+                pids = set(executor.map(lambda _: conn.run(os.getpid), range(8)))
+
+        assert results == list(range(1, 33))
+        assert len(pids) == 1
+
 
 class TestPythonGRPC(GenericPythonConnectionTests):
     def open_connection(
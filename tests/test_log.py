@@ -1,7 +1,10 @@
 from datetime import datetime, timezone
 
+import pytest
+from isolate.backends.settings import IsolateSettings
 from isolate.common import timestamp
 from isolate.connections.grpc import definitions
+from isolate.connections.grpc.interface import from_grpc, logs_to_grpc, to_grpc
 from isolate.logs import Log, LogLevel, LogSource
 
 
@@ -11,12 +14,97 @@ def test_log_default_timestamp():
     assert log.timestamp <= datetime.now(timezone.utc)
 
 
+def test_log_lazy_timestamp():
+    log = Log(
+        message="message", source=LogSource.USER, timestamp_ns=1_700_000_000_123_456_789
+    )
+    assert log.timestamp_ns == 1_700_000_000_123_456_789
+    assert log.timestamp == datetime(
+        2023, 11, 14, 22, 13, 20, 123456, tzinfo=timezone.utc
+    )
+
+    log.timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert log.timestamp_ns == 1_704_067_200_000_000_000
+
+    # Naive datetimes are assumed to be in UTC.
+    log = Log(message="message", source=LogSource.USER, timestamp=datetime(2024, 1, 1))
+    assert log.timestamp_ns == 1_704_067_200_000_000_000
+
+
+def test_log_compatibility():
+    import dataclasses
+    import sys
+
+    log = Log("message", LogSource.USER, LogLevel.DEBUG)
+    if sys.version_info >= (3, 10):
+        assert not hasattr(log, "__dict__")
+
+    # It is still a dataclass.
+    copied_log = dataclasses.replace(log, level=LogLevel.ERROR)
+    assert copied_log.level == LogLevel.ERROR
+    assert copied_log.timestamp == log.timestamp
+    assert dataclasses.asdict(log)["timestamp_ns"] == log.timestamp_ns
+    assert "message" in [field.name for field in dataclasses.fields(log)]
+
+    assert log == Log(
+        "message", LogSource.USER, LogLevel.DEBUG, timestamp=log.timestamp
+    )
+    assert log != Log("other", LogSource.USER, LogLevel.DEBUG, timestamp=log.timestamp)
+    assert "message='message'" in repr(log)
+    assert str(log).endswith("[debug]   message")
+
+    log.level = LogLevel.INFO
+    assert log.level == LogLevel.INFO
+
+
 def test_timestamp_conversion():
     now = datetime.now(timezone.utc)
     now_timestamp = timestamp.from_datetime(now)
     assert now_timestamp.ToMilliseconds() == int(now.timestamp() * 1000.0)
 
 
+def test_timestamp_epoch_ns_conversion():
+    epoch_ns = 1_700_000_000_123_456_789
+    now_timestamp = timestamp.from_epoch_ns(epoch_ns)
+    assert now_timestamp.seconds == 1_700_000_000
+    assert now_timestamp.nanos == 123_456_789
+    assert timestamp.to_epoch_ns(now_timestamp) == epoch_ns
+    assert timestamp.to_datetime(now_timestamp) == datetime(
+        2023, 11, 14, 22, 13, 20, 123456, tzinfo=timezone.utc
+    )
+
+
+@pytest.mark.parametrize("source", list(LogSource))
+@pytest.mark.parametrize("level", list(LogLevel))
+def test_log_grpc_conversion(source, level):
+    log = Log("message", source=source, level=level)
+    grpc_log = to_grpc(log)
+    assert definitions.LogSource.Name(grpc_log.source) == source.name.upper()
+    assert definitions.LogLevel.Name(grpc_log.level) == level.name.upper()
+    assert timestamp.to_epoch_ns(grpc_log.timestamp) == log.timestamp_ns
+
+    converted_log = from_grpc(grpc_log)
+    assert converted_log == log
+    assert converted_log.timestamp_ns == log.timestamp_ns
+
+
+def test_logs_to_grpc():
+    logs = [
+        Log("message", source=LogSource.USER, level=LogLevel.STDOUT),
+        Log(
+            '{"line": "json message", "key": "value"}',
+            source=LogSource.BRIDGE,
+            level=LogLevel.ERROR,
+            is_json=True,
+        ),
+        Log("", source=LogSource.BUILDER, level=LogLevel.TRACE),
+    ]
+    grpc_logs = logs_to_grpc(logs)
+    assert grpc_logs == [to_grpc(log) for log in logs]
+    assert grpc_logs[1].message == "json message"
+    assert logs_to_grpc([]) == []
+
+
 def test_level_gt_comparison():
     assert LogLevel.INFO > LogLevel.DEBUG
 
@@ -74,3 +162,45 @@ def test_json_logs():
     )
     meta = malformed_json_log.message_meta()
     assert meta == {}
+
+
+@pytest.mark.parametrize(
+    "message, source, level, expected_level",
+    [
+        ("hello", LogSource.USER, LogLevel.STDOUT, LogLevel.INFO),
+        ("hello", LogSource.USER, LogLevel.STDERR, LogLevel.INFO),
+        ("hello", LogSource.BRIDGE, LogLevel.STDERR, LogLevel.TRACE),
+        ("hello", LogSource.BUILDER, LogLevel.STDOUT, LogLevel.TRACE),
+        ("error: hello", LogSource.USER, LogLevel.INFO, LogLevel.INFO),
+        ("Error: boom", LogSource.USER, LogLevel.STDERR, LogLevel.ERROR),
+        ("errors happen", LogSource.USER, LogLevel.STDOUT, LogLevel.ERROR),
+        ("WARNING: careful", LogSource.USER, LogLevel.STDERR, LogLevel.WARNING),
+        ("warn: careful", LogSource.USER, LogLevel.STDERR, LogLevel.WARNING),
+        ("12:00 [Warning] careful", LogSource.USER, LogLevel.STDOUT, LogLevel.WARNING),
+        ("12:00 [DEBUG] details", LogSource.USER, LogLevel.STDOUT, LogLevel.DEBUG),
+        ("12:00 [trace] details", LogSource.USER, LogLevel.STDOUT, LogLevel.TRACE),
+        ("info: but [error]", LogSource.USER, LogLevel.STDOUT, LogLevel.ERROR),
+        ("[debug] then [info]", LogSource.USER, LogLevel.STDOUT, LogLevel.INFO),
+        ("no [errors] here", LogSource.USER, LogLevel.STDERR, LogLevel.INFO),
+        ("x" * 1000 + "[error]", LogSource.USER, LogLevel.STDOUT, LogLevel.INFO),
+    ],
+)
+def test_infer_log_level(message, source, level, expected_level):
+    log = Log(message=message, source=source, level=level)
+    settings = IsolateSettings(log_hook=lambda log: None)
+    assert settings._infer_log_level(log).level == expected_level
+
+
+def test_infer_log_level_disabled():
+    logs = []
+    settings = IsolateSettings(log_hook=logs.append, infer_log_level=False)
+    settings.log(
+        Log(message="[error] boom", source=LogSource.USER, level=LogLevel.STDERR)
+    )
+    assert [log.level for log in logs] == [LogLevel.STDERR]
+
+    settings = settings.replace(infer_log_level=True)
+    settings.log(
+        Log(message="[error] boom", source=LogSource.USER, level=LogLevel.STDERR)
+    )
+    assert [log.level for log in logs] == [LogLevel.STDERR, LogLevel.ERROR]
@@ -2,6 +2,7 @@ import re
 from pathlib import Path
 from typing import List, Tuple
 
+import pytest
 from isolate.backends.local import LocalPythonEnvironment
 from isolate.connections._local._base import PythonExecutionBase
 from isolate.logs import LogLevel, LogSource
@@ -93,6 +94,106 @@ class TestMkPatterns:
         assert len(patterns) == 2
 
 
+class TestMkCombinedPattern:
+    """Tests for _mk_combined_pattern method."""
+
+    def setup_method(self):
+        self.executor = MockPythonExecution()
+
+    def mask(self, env, line):
+        return self.executor._mask(
+            line,
+            self.executor._mk_patterns(env),
+            self.executor._mk_combined_pattern(env),
+        )
+
+    def test_empty_env(self):
+        """No secrets should return no pattern."""
+        assert self.executor._mk_combined_pattern({}) is None
+        assert self.executor._mk_combined_pattern({"SHORT": "abc"}) is None
+
+    def test_matches_any_secret(self):
+        """All the secrets should be matched by a single pattern."""
+        env = {
+            "PATH": "/usr/local/bin:/usr/bin:/bin",
+            "SECRET1": "123456789",
+            "SECRET2": "abcdefghijk",
+        }
+        pattern = self.executor._mk_combined_pattern(env)
+        assert pattern is not None
+        assert pattern.search("123456789")
+        assert pattern.search("abcdefghijk")
+        assert not pattern.search("/usr/local/bin")
+
+    @pytest.mark.parametrize(
+        "env, line, expected",
+        [
+            # Secrets that share a prefix.
+            (
+                {"TOKEN": "abcdefghij", "LONG_TOKEN": "abcdefghij_and_more"},
+                "key=abcdefghij_and_more;",
+                "key=********_and_more;",
+            ),
+            (
+                {"LONG_TOKEN": "abcdefghij_and_more", "TOKEN": "abcdefghij"},
+                "key=abcdefghij_and_more;",
+                "key=********;",
+            ),
+            # Overlapping secrets, the first one in the env is masked.
+            (
+                {"B": "ghijklmnop", "A": "abcdefghij"},
+                "abcdefghijklmnop",
+                "abcdef********",
+            ),
+            (
+                {"A": "abcdefghij", "B": "ghijklmnop"},
+                "abcdefghijklmnop",
+                "********klmnop",
+            ),
+            # A secret inside another one.
+            (
+                {"A": "1234567890", "B": "xx1234567890yy"},
+                "xx1234567890yy",
+                "xx********yy",
+            ),
+            (
+                {"B": "xx1234567890yy", "A": "1234567890"},
+                "xx1234567890yy",
+                "********",
+            ),
+        ],
+    )
+    def test_overlapping_secrets(self, env, line, expected):
+        """Secrets are masked in the order of the env, like the separate
+        patterns would do."""
+        assert self.mask(env, line) == expected
+        assert self.executor._mask(line, self.executor._mk_patterns(env)) == expected
+
+    def test_same_output_as_separate_patterns(self):
+        """Masking should be the same as applying each pattern in turn."""
+        env = {
+            "API_KEY": "sk-1234567890abcdef",
+            "DB_PASSWORD": "super_secret_password",
+            "REGEX_VAL": "secret.value+test*",
+            "SHARED_PREFIX": "super_secret_token",
+        }
+        lines = [
+            "nothing to see here",
+            f"Connecting to DB with {env['DB_PASSWORD']} and {env['API_KEY']}",
+            f"{env['SHARED_PREFIX']}{env['REGEX_VAL']}{env['SHARED_PREFIX']}",
+            "super_secret_passwor and secretXvalueXtestXXX",
+        ]
+        separate_patterns = self.executor._mk_patterns(env)
+        for line in lines:
+            assert self.mask(env, line) == self.executor._mask(line, separate_patterns)
+
+    def test_long_values(self):
+        """Very long values should not hit the recursion limit."""
+        env = {"CERTIFICATE": "x" * 10_000, "OTHER": "x" * 5_000 + "y" * 10}
+        assert self.mask(env, "x" * 10_000) == "********"
+        assert self.mask(env, "x" * 5_000 + "y" * 10) == "********"
+
+
 class TestMaskAgentLog:
     """Tests for _mask_agent_log method."""
 
@@ -1,7 +1,10 @@
+import io
 import json
+import threading
 
 import pytest
-from isolate.logger import IsolateLogger
+from isolate.logger import IsolateLogger, LogWriter
+from isolate.logs import LogLevel, LogSource
 
 
 @pytest.fixture
@@ -43,3 +46,119 @@ def test_logger_direct(log_labels):
     logger = IsolateLogger(log_labels=log_labels)
     # should not do env expansion
     assert logger.log_labels == log_labels
+
+
+class BlockingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.unblocked = threading.Event()
+        self.writing = threading.Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.unblocked.wait()
+        return super().write(data)
+
+
+def written_records(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_logger_sync_by_default(log_labels, capsys):
+    logger = IsolateLogger(log_labels=log_labels)
+    assert logger.writer is None
+
+    logger.log(LogLevel.INFO, "hello", LogSource.USER, {"baz": "overridden"})
+    [record] = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert record["message"] == "hello"
+    assert record["level"] == "INFO"
+    assert record["isolate_source"] == "USER"
+    assert record["baz"] == "overridden"
+    assert record["foo"] == "$MYENVVAR1"
+
+
+def test_logger_buffered_writer(log_labels):
+    stream = io.StringIO()
+    writer = LogWriter(max_size=100, stream=stream)
+    logger = IsolateLogger(log_labels=log_labels, writer=writer)
+    logger.extra_labels = {"extra": "label"}
+
+    for index in range(250):
+        logger.log(LogLevel.DEBUG, f"message {index}", LogSource.BRIDGE, {})
+
+    assert writer.flush(timeout=5)
+    records = written_records(stream)
+    assert [record["message"] for record in records] == [
+        f"message {index}" for index in range(250)
+    ]
+    assert all(record["extra"] == "label" for record in records)
+    assert all(record["baz"] == "baz" for record in records)
+    assert writer.dropped == 0
+
+    writer.close()
+    logger.log(LogLevel.DEBUG, "after close", LogSource.BRIDGE, {})
+    assert written_records(stream)[-1]["message"] == "after close"
+
+
+def test_logger_buffered_writer_drops_oldest():
+    stream = BlockingStream()
+    writer = LogWriter(max_size=3, overflow_policy="drop", stream=stream)
+    logger = IsolateLogger(log_labels={}, writer=writer)
+
+    # The first record is taken by the writer, which then blocks on the stream.
+    logger.log(LogLevel.INFO, "first", LogSource.USER, {})
+    assert stream.writing.wait(timeout=5)
+
+    for index in range(10):
+        logger.log(LogLevel.INFO, f"message {index}", LogSource.USER, {})
+    assert writer.dropped == 7
+
+    stream.unblocked.set()
+    assert writer.flush(timeout=5)
+    records = written_records(stream)
+    assert records[0]["message"] == "first"
+    assert records[1]["level"] == "WARNING"
+    assert "Dropped 7 log records" in records[1]["message"]
+    assert [record["message"] for record in records[2:]] == [
+        "message 7",
+        "message 8",
+        "message 9",
+    ]
+    writer.close()
+
+
+def test_logger_buffered_writer_blocks():
+    stream = BlockingStream()
+    writer = LogWriter(max_size=2, overflow_policy="block", stream=stream)
+    logger = IsolateLogger(log_labels={}, writer=writer)
+
+    logger.log(LogLevel.INFO, "first", LogSource.USER, {})
+    assert stream.writing.wait(timeout=5)
+
+    def log_many():
+        for index in range(5):
+            logger.log(LogLevel.INFO, f"message {index}", LogSource.USER, {})
+
+    thread = threading.Thread(target=log_many)
+    thread.start()
+    thread.join(timeout=0.2)
+    # Waiting for the writer to make room in the buffer.
+    assert thread.is_alive()
+
+    stream.unblocked.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert writer.flush(timeout=5)
+    assert writer.dropped == 0
+    assert [record["message"] for record in written_records(stream)] == [
+        "first",
+        *(f"message {index}" for index in range(5)),
+    ]
+    writer.close()
+
+
+def test_log_writer_invalid_options():
+    with pytest.raises(ValueError):
+        LogWriter(max_size=0)
+    with pytest.raises(ValueError):
+        LogWriter(max_size=10, overflow_policy="explode")
@@ -2,16 +2,22 @@ import asyncio
 import copy
 import textwrap
 import threading
+import time
 from concurrent import futures
 from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
-from typing import Any, Iterator, List, Optional, cast
+from queue import Empty as QueueEmpty
+from queue import Queue
+from typing import Any, Callable, Iterator, List, Optional, cast
 
 import grpc
 import pytest
+from isolate.backends import EnvironmentCreationError
+from isolate.backends.local import LocalPythonEnvironment
 from isolate.backends.settings import IsolateSettings
+from isolate.connections.grpc.agent import SetupCache
 from isolate.connections.grpc.configuration import get_default_options
 from isolate.logs import Log, LogLevel, LogSource
 from isolate.server import definitions, health
@@ -20,7 +26,10 @@ from isolate.server.interface import from_grpc, to_serialized_object
 from isolate.server.server import (
     BridgeManager,
     ControllerAuthInterceptor,
+    EnvironmentBuilds,
     IsolateServicer,
+    LogHandler,
+    RunTask,
     ServerBoundInterceptor,
     SingleTaskInterceptor,
 )
@@ -49,11 +58,16 @@ def interceptors():
 
 @contextmanager
 def make_server(
-    tmp_path: Path, interceptors: Optional[List[ServerBoundInterceptor]] = None
+    tmp_path: Path,
+    interceptors: Optional[List[ServerBoundInterceptor]] = None,
+    bridge_manager: Optional[BridgeManager] = None,
+    max_workers: int = 1,
+    agent_log_capture: bool = False,
+    agent_concurrency: int = 1,
 ) -> Iterator[Stubs]:
     interceptors = interceptors or []
     server = grpc.server(
-        futures.ThreadPoolExecutor(max_workers=1),
+        futures.ThreadPoolExecutor(max_workers=max_workers),
         options=get_default_options(),
         interceptors=interceptors,  # type: ignore
     )
@@ -61,8 +75,12 @@ def make_server(
     for interceptor in interceptors:
         interceptor.register_server(server)
 
-    test_settings = IsolateSettings(cache_dir=tmp_path / "cache")
-    with BridgeManager() as bridge:
+    test_settings = IsolateSettings(
+        cache_dir=tmp_path / "cache",
+        agent_log_capture=agent_log_capture,
+        agent_concurrency=agent_concurrency,
+    )
+    with bridge_manager or BridgeManager() as bridge:
         servicer = IsolateServicer(bridge, test_settings)
 
         for interceptor in interceptors:
@@ -551,6 +569,105 @@ def test_bridge_connection_reuse_logs(
     ]
 
 
+def test_setup_cache_eviction(stub: definitions.IsolateStub, monkeypatch: Any) -> None:
+    inherit_from_local(monkeypatch)
+    monkeypatch.setenv("ISOLATE_AGENT_SETUP_CACHE_MAX_ENTRIES", "1")
+
+    def make_setup(name: str) -> Any:
+        class Model:
+            def _isolate_teardown(self) -> None:
+                print(f"teardown {name}")
+
+        def setup() -> Any:
+            print(f"setup {name}")
+            return Model()
+
+        return setup
+
+    env = define_environment("virtualenv", requirements=["pyjokes==0.6.0"])
+    requests = {
+        name: definitions.BoundFunction(
+            setup_func=to_serialized_object(make_setup(name), method="cloudpickle"),
+            function=to_serialized_object(lambda _: print("run"), method="cloudpickle"),
+            environments=[env],
+        )
+        for name in ("first", "second")
+    }
+
+    user_logs: List[Log] = []
+    bridge_logs: List[Log] = []
+    for name in ("first", "first", "second", "first"):
+        run_request(stub, requests[name], user_logs=user_logs, bridge_logs=bridge_logs)
+
+    assert [log.message for log in user_logs if log.message.strip()] == [
+        "setup first",
+        "run",
+        "run",
+        "setup second",
+        "teardown first",
+        "run",
+        "setup first",
+        "teardown second",
+        "run",
+    ]
+
+    bridge_messages = [log.message for log in bridge_logs]
+    assert any(
+        "Using the cached setup result (1/1 entries, 1 hits, 1 misses" in message
+        for message in bridge_messages
+    )
+    assert any(
+        "Evicted 1 setup result(s) from the cache (1/1 entries, 1 hits, 3 misses, "
+        "2 evictions)" in message
+        for message in bridge_messages
+    )
+
+
+def test_setup_cache_keeps_results_in_use() -> None:
+    cache = SetupCache(max_entries=1)
+    assert cache.lookup("a") == (False, None)
+    assert cache.add("a", 1) == (1, [])
+
+    # "a" is still in use, so it can't be evicted yet.
+    assert cache.add("b", 2) == (2, [])
+    assert "a" in cache and "b" in cache
+
+    assert cache.release("a") == [1]
+    assert "a" not in cache
+    assert cache.release("b") == []
+
+    assert cache.lookup("b") == (True, 2)
+    assert cache.release("b") == []
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+
+def test_setup_cache_discards_duplicate_results() -> None:
+    cache = SetupCache(max_entries=1)
+
+    # Two concurrent runs both miss and run the setup for the same key.
+    assert cache.lookup("a") == (False, None)
+    assert cache.lookup("a") == (False, None)
+    first, second = object(), object()
+    assert cache.add("a", first) == (first, [])
+
+    # The stored result is kept (and the second one is left to the caller
+    # to tear down).
+    assert cache.add("a", second) == (first, [])
+    assert cache.release("a") == []
+    assert cache.release("a") == []
+    assert cache.lookup("a") == (True, first)
+
+
+def test_setup_cache_unlimited() -> None:
+    cache = SetupCache()
+    for key in range(100):
+        cache.add(str(key), key)
+        assert cache.release(str(key)) == []
+
+    assert len(cache) == 100
+    assert cache.describe() == ("100/unlimited entries, 0 hits, 0 misses, 0 evictions")
+
+
 def print_logs_no_delay(num_lines, should_flush):
     for i in range(num_lines):
         print(i, flush=should_flush)
@@ -573,6 +690,47 @@ def test_receive_complete_logs(
     assert logs == [str(i) for i in range(num_lines)]
 
 
+def print_secret_and_logs(num_lines):
+    import os
+    import sys
+
+    print("secret:", os.environ["ISOLATE_TEST_SECRET"])
+    print("error: boom", file=sys.stderr)
+    for i in range(num_lines):
+        print(i)
+    return num_lines
+
+
+@pytest.mark.parametrize("num_lines", [0, 10, 1000])
+def test_agent_log_capture(tmp_path: Path, monkeypatch: Any, num_lines: int) -> None:
+    inherit_from_local(monkeypatch)
+    monkeypatch.setenv("ISOLATE_TEST_SECRET", "very-secret-value")
+
+    with make_server(tmp_path, agent_log_capture=True) as stubs:
+        # Logs are sent before the result through the same stream, so
+        # none of them are missed.
+        user_logs: List[Log] = []
+        bridge_logs: List[Log] = []
+        result = run_request(
+            stubs.isolate_stub,
+            prepare_request(print_secret_and_logs, num_lines),
+            user_logs=user_logs,
+            bridge_logs=bridge_logs,
+        )
+
+    assert from_grpc(result) == num_lines
+    assert [log.message for log in user_logs] == [
+        "secret: ********",
+        "error: boom",
+        *map(str, range(num_lines)),
+    ]
+    # Levels are inferred the same way as for the logs from the pipes.
+    assert [log.level for log in user_logs[:2]] == [LogLevel.INFO, LogLevel.ERROR]
+    assert any(
+        "Starting the execution of the function" in log.message for log in bridge_logs
+    )
+
+
 def take_buffer(buffer):
     return buffer
 
@@ -976,3 +1134,772 @@ def test_server_asyncio_run_function(
     setattr(asyncio_run_function, "_run_on_main_thread", True)
     with pytest.raises(RuntimeError):
         from_grpc(run_request(stub, prepare_request(asyncio_run_function)))
+
+
+def test_watch_queue_until_completed_wakes_up_on_completion() -> None:
+    servicer = IsolateServicer(BridgeManager())
+    future: futures.Future = futures.Future()
+    completer = threading.Thread(target=future.set_result, args=(None,))
+    get_calls: List[str] = []
+
+    class RecordingQueue(Queue):
+        def get(self, *args: Any, **kwargs: Any) -> Any:
+            if len(get_calls) == 1:
+                # Complete the future while the watcher is waiting on the
+                # (now empty) queue, without putting anything else to it.
+                completer.start()
+
+            try:
+                item = super().get(*args, **kwargs)
+            except QueueEmpty:
+                get_calls.append("timed out")
+                raise
+
+            get_calls.append("woken up")
+            return item
+
+    queue: Queue = RecordingQueue()
+    queue.put(definitions.PartialRunResult(is_complete=False))
+    results = list(servicer.watch_queue_until_completed(queue, future))
+    completer.join()
+
+    assert [result.is_complete for result in results] == [False]
+    # The wait on the empty queue is woken up by the completion itself, rather
+    # than timing out to poll the future.
+    assert get_calls == ["woken up", "woken up"]
+
+
+def test_watch_queue_until_completed_ignores_stale_markers() -> None:
+    servicer = IsolateServicer(BridgeManager())
+    queue: Queue = Queue()
+
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        # An abandoned watcher (e.g. the client went away) still leaves
+        # its completion marker on the shared queue.
+        release = threading.Event()
+        abandoned = servicer.watch_queue_until_completed(
+            queue, pool.submit(release.wait)
+        )
+        queue.put(definitions.PartialRunResult(is_complete=False))
+        assert not next(abandoned).is_complete
+        abandoned.close()
+        release.set()
+
+        future = pool.submit(queue.put, definitions.PartialRunResult(is_complete=True))
+        results = list(servicer.watch_queue_until_completed(queue, future))
+
+    assert [result.is_complete for result in results] == [True]
+
+
+def test_logs_are_batched() -> None:
+    servicer = IsolateServicer(BridgeManager())
+    queue: Queue = Queue()
+    log_handler = LogHandler(
+        queue,
+        task=RunTask(request=definitions.BoundFunction(stream_logs=True)),
+        max_batch_count=3,
+        max_batch_size=10,
+    )
+
+    for index in range(5):
+        log_handler.handle(Log(str(index), source=LogSource.USER))
+    log_handler.handle(Log("x" * 8, source=LogSource.USER))
+    log_handler.handle(Log("y" * 20, source=LogSource.USER))
+
+    # The consumer is only notified once for all the pending logs.
+    assert queue.qsize() == 1
+
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(queue.put, definitions.PartialRunResult(is_complete=True))
+        results = list(servicer.watch_queue_until_completed(queue, future))
+
+    assert [[log.message for log in result.logs] for result in results] == [
+        ["0", "1", "2"],
+        ["3", "4", "x" * 8],
+        ["y" * 20],
+        [],
+    ]
+    assert results[-1].is_complete
+
+    # The next log starts a new batch.
+    log_handler.handle(Log("next", source=LogSource.USER))
+    assert queue.qsize() == 1
+
+
+@contextmanager
+def make_aio_server(tmp_path: Path, max_concurrent_runs: int) -> Iterator[Stubs]:
+    from isolate.server.server import AsyncIsolateServicer
+
+    loop = asyncio.new_event_loop()
+    server_ready = threading.Event()
+    state: dict[str, Any] = {}
+
+    async def serve() -> None:
+        stop_event = state["stop_event"] = asyncio.Event()
+        server = grpc.aio.server(options=get_default_options())
+        test_settings = IsolateSettings(cache_dir=tmp_path / "cache")
+        with BridgeManager() as bridge:
+            servicer = AsyncIsolateServicer(
+                IsolateServicer(bridge, test_settings),
+                max_concurrent_runs=max_concurrent_runs,
+            )
+            definitions.register_isolate(servicer, server)
+            health.register_health(HealthServicer(), server)
+            state["port"] = server.add_insecure_port("[::]:0")
+            await server.start()
+            server_ready.set()
+
+            await stop_event.wait()
+            await servicer.shutdown()
+            await server.stop(None)
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),))
+    thread.start()
+    server_ready.wait(timeout=10)
+
+    try:
+        channel = grpc.insecure_channel(
+            f"localhost:{state['port']}", options=get_default_options()
+        )
+        yield Stubs(
+            isolate_stub=definitions.IsolateStub(channel),
+            health_stub=health.HealthStub(channel),
+        )
+    finally:
+        loop.call_soon_threadsafe(state["stop_event"].set)
+        thread.join(timeout=30)
+        loop.close()
+
+
+def prepare_local_request(function: Callable[..., Any]) -> definitions.BoundFunction:
+    return definitions.BoundFunction(
+        function=to_serialized_object(function, method="cloudpickle"),
+        environments=[definitions.EnvironmentDefinition(kind="local")],
+        stream_logs=True,
+    )
+
+
+def test_aio_server_run(tmp_path: Path) -> None:
+    with make_aio_server(tmp_path, max_concurrent_runs=2) as stubs:
+        user_logs: List[Log] = []
+        result = run_request(
+            stubs.isolate_stub,
+            prepare_local_request(lambda: print("hello") or 42),
+            user_logs=user_logs,
+        )
+        assert from_grpc(result) == 42
+        assert "hello" in [log.message for log in user_logs]
+
+        resp = stubs.health_stub.Check(health.HealthCheckRequest(service=""))
+        assert resp.status == health.HealthCheckResponse.SERVING
+
+
+def test_aio_server_concurrent_runs(tmp_path: Path) -> None:
+    def slow_function():
+        import time
+
+        time.sleep(2)
+        return "done"
+
+    with make_aio_server(tmp_path, max_concurrent_runs=4) as stubs:
+        with futures.ThreadPoolExecutor(max_workers=4) as pool:
+            started_at = time.monotonic()
+            results = [
+                pool.submit(
+                    run_request,
+                    stubs.isolate_stub,
+                    prepare_local_request(slow_function),
+                )
+                for _ in range(4)
+            ]
+
+            # Even when all the runs are in progress, other calls are
+            # served immediately.
+            time.sleep(0.5)
+            list_started_at = time.monotonic()
+            stubs.isolate_stub.List(definitions.ListRequest())
+            assert time.monotonic() - list_started_at < 1
+
+            assert [from_grpc(future.result()) for future in results] == ["done"] * 4
+
+        # All four runs progressed concurrently (each on its own agent)
+        # rather than one after the other.
+        assert time.monotonic() - started_at < 2 * 4
+
+
+def test_aio_server_releases_agents_off_the_loop(
+    tmp_path: Path, monkeypatch: Any
+) -> None:
+    cache_agent = BridgeManager._cache_agent
+    releasing = threading.Event()
+    listed = threading.Event()
+    events = []
+
+    def slow_cache_agent(*args: Any, **kwargs: Any) -> None:
+        # E.g. waiting for the evicted agents to exit, until the other
+        # calls are served (or for long enough to tell that they can't be).
+        releasing.set()
+        listed.wait(timeout=10)
+        events.append("released")
+        cache_agent(*args, **kwargs)
+
+    monkeypatch.setattr(BridgeManager, "_cache_agent", slow_cache_agent)
+    with make_aio_server(tmp_path, max_concurrent_runs=2) as stubs:
+        responses = stubs.isolate_stub.Run(prepare_local_request(lambda: 42))
+        results = []
+        for response in responses:
+            if response.HasField("result"):
+                results.append(from_grpc(response.result))
+            if response.is_complete:
+                break
+
+        # The agent is being released, but the other calls are still served.
+        assert releasing.wait(timeout=30)
+        stubs.isolate_stub.List(definitions.ListRequest())
+        events.append("listed")
+        listed.set()
+
+        # Only logs might follow the result.
+        results.extend(
+            from_grpc(response.result)
+            for response in responses
+            if response.HasField("result")
+        )
+
+    assert results == [42]
+    assert events == ["listed", "released"]
+
+
+def test_run_task_id_metadata(
+    stub: definitions.IsolateStub,
+    monkeypatch: Any,
+) -> None:
+    inherit_from_local(monkeypatch)
+
+    responses = stub.Run(prepare_request(check_machine))
+    task_id = dict(responses.initial_metadata())["task-id"]
+    assert task_id
+
+    results = [response for response in responses if response.is_complete]
+    assert len(results) == 1
+    assert task_id not in [
+        task.task_id for task in stub.List(definitions.ListRequest()).tasks
+    ]
+
+
+def test_concurrent_runs_are_tracked_separately(tmp_path: Path) -> None:
+    def sleep_forever():
+        import time
+
+        print("started", flush=True)
+        time.sleep(120)
+
+    def sleep_briefly():
+        import time
+
+        time.sleep(3)
+        return "done"
+
+    with make_aio_server(tmp_path, max_concurrent_runs=2) as stubs:
+        stub = stubs.isolate_stub
+        long_run = stub.Run(prepare_local_request(sleep_forever))
+        short_run = stub.Run(prepare_local_request(sleep_briefly))
+
+        long_task_id = dict(long_run.initial_metadata())["task-id"]
+        short_task_id = dict(short_run.initial_metadata())["task-id"]
+        assert long_task_id != short_task_id
+
+        tasks = [task.task_id for task in stub.List(definitions.ListRequest()).tasks]
+        assert sorted(tasks) == sorted([long_task_id, short_task_id])
+
+        # Wait until the agent is actually running the function, then cancel
+        # only the long running one.
+        for response in long_run:
+            if "started" in [log.message for log in response.logs]:
+                break
+
+        started_at = time.monotonic()
+        stub.Cancel(definitions.CancelRequest(task_id=long_task_id))
+        assert not any(response.is_complete for response in long_run)
+        assert time.monotonic() - started_at < 60
+
+        [result] = [response for response in short_run if response.is_complete]
+        assert from_grpc(result.result) == "done"
+        assert not list(stub.List(definitions.ListRequest()).tasks)
+
+
+@pytest.mark.parametrize("use_aio", [False, True])
+def test_cancel_before_the_agent_is_started(
+    tmp_path: Path, monkeypatch: Any, use_aio: bool
+) -> None:
+    build_started = threading.Event()
+    release_build = threading.Event()
+    create_environments = IsolateServicer._create_environments
+
+    def slow_create_environments(*args: Any, **kwargs: Any) -> Any:
+        build_started.set()
+        release_build.wait(timeout=30)
+        return create_environments(*args, **kwargs)
+
+    monkeypatch.setattr(
+        IsolateServicer, "_create_environments", slow_create_environments
+    )
+
+    ran_path = tmp_path / "ran"
+
+    def touch():
+        open(ran_path, "w").close()
+
+    if use_aio:
+        server = make_aio_server(tmp_path, max_concurrent_runs=2)
+    else:
+        server = make_server(tmp_path, max_workers=2)
+
+    with server as stubs:
+        stub = stubs.isolate_stub
+        responses = stub.Run(prepare_local_request(touch))
+        task_id = dict(responses.initial_metadata())["task-id"]
+        assert build_started.wait(timeout=30)
+
+        stub.Cancel(definitions.CancelRequest(task_id=task_id))
+        release_build.set()
+
+        assert not any(response.is_complete for response in responses)
+        assert not list(stub.List(definitions.ListRequest()).tasks)
+
+    assert not ran_path.exists()
+
+
+def prepare_blocking_request(release_path: Path) -> definitions.BoundFunction:
+    # Blocks the agent until the given path is created.
+    def wait_for_release():
+        import os
+        import time
+
+        while not os.path.exists(release_path):
+            time.sleep(0.05)
+        return os.getpid()
+
+    return prepare_local_request(wait_for_release)
+
+
+def prepare_pid_request() -> definitions.BoundFunction:
+    def get_pid():
+        import os
+
+        print("hello from the pool")
+        return os.getpid()
+
+    return prepare_local_request(get_pid)
+
+
+def wait_until(condition: Any, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+def idle_agents(bridge: BridgeManager) -> List[Any]:
+    return [agent for agents in bridge._agents.values() for agent in agents]
+
+
+def test_agent_pool_prewarms_agents(tmp_path: Path) -> None:
+    release_path = tmp_path / "release"
+    bridge = BridgeManager(min_idle_agents=1)
+    with make_server(tmp_path, bridge_manager=bridge, max_workers=2) as stubs:
+        with futures.ThreadPoolExecutor(max_workers=1) as pool:
+            first_run = pool.submit(
+                run_request,
+                stubs.isolate_stub,
+                prepare_blocking_request(release_path),
+            )
+
+            # While the first agent is busy, another one gets started in the
+            # background for the same environment.
+            wait_until(lambda: idle_agents(bridge))
+
+            # Which is then used by the next run (and the logs of the run
+            # are delivered to it).
+            user_logs: List[Log] = []
+            second_pid = from_grpc(
+                run_request(
+                    stubs.isolate_stub,
+                    prepare_pid_request(),
+                    user_logs=user_logs,
+                )
+            )
+            assert "hello from the pool" in [log.message for log in user_logs]
+
+            release_path.touch()
+            first_pid = from_grpc(first_run.result())
+
+        assert first_pid != second_pid
+        assert bridge.stats.misses == 1
+        assert bridge.stats.hits == 1
+
+
+@pytest.mark.parametrize(
+    "make_bridge",
+    [
+        lambda: BridgeManager(max_idle_agents=1),
+        lambda: BridgeManager(max_total_idle_agents=1),
+    ],
+    ids=["max_idle_agents", "max_total_idle_agents"],
+)
+def test_agent_pool_evicts_least_recently_used(
+    tmp_path: Path, make_bridge: Callable[[], BridgeManager]
+) -> None:
+    release_path = tmp_path / "release"
+    bridge = make_bridge()
+    with make_server(tmp_path, bridge_manager=bridge, max_workers=2) as stubs:
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            runs = [
+                pool.submit(
+                    run_request,
+                    stubs.isolate_stub,
+                    prepare_blocking_request(release_path),
+                )
+                for _ in range(2)
+            ]
+
+            # Both runs get an agent of their own, and only one of them
+            # can be kept once they are done.
+            wait_until(lambda: bridge.stats.misses == 2)
+            release_path.touch()
+            pids = {from_grpc(run.result()) for run in runs}
+            assert len(pids) == 2
+
+        wait_until(lambda: bridge.stats.evictions == 1)
+        [agent] = idle_agents(bridge)
+
+        pid = from_grpc(run_request(stubs.isolate_stub, prepare_pid_request()))
+        assert pid in pids
+        assert bridge.stats.hits == 1
+
+
+def test_agent_pool_skips_cancelled_agents(tmp_path: Path) -> None:
+    started_path = tmp_path / "started"
+    release_path = tmp_path / "release"
+
+    def wait_for_release():
+        import os
+        import time
+
+        open(started_path, "w").close()
+        while not os.path.exists(release_path):
+            time.sleep(0.05)
+
+    bridge = BridgeManager()
+    with make_server(tmp_path, bridge_manager=bridge) as stubs:
+        task_id = stubs.isolate_stub.Submit(
+            definitions.SubmitRequest(function=prepare_local_request(wait_for_release))
+        ).task_id
+        wait_until(started_path.exists)
+
+        # The agent is killed by the cancellation, so it is not put back
+        # to the pool.
+        stubs.isolate_stub.Cancel(definitions.CancelRequest(task_id=task_id))
+        assert not idle_agents(bridge)
+
+        pid = from_grpc(run_request(stubs.isolate_stub, prepare_pid_request()))
+        assert isinstance(pid, int)
+        assert bridge.stats.misses == 2
+        assert bridge.stats.hits == 0
+
+
+def test_agent_pool_idle_ttl(tmp_path: Path) -> None:
+    bridge = BridgeManager(agent_idle_ttl=0.5)
+    with make_server(tmp_path, bridge_manager=bridge) as stubs:
+        run_request(stubs.isolate_stub, prepare_pid_request())
+        [agent] = idle_agents(bridge)
+
+        wait_until(lambda: not idle_agents(bridge), timeout=10)
+        assert agent._terminated
+        assert bridge.stats.evictions == 1
+
+        # The next run starts a fresh agent.
+        run_request(stubs.isolate_stub, prepare_pid_request())
+        assert bridge.stats.misses == 2
+
+
+def prepare_tagged_blocking_request(
+    release_path: Path, tag: str
+) -> definitions.BoundFunction:
+    # Like prepare_blocking_request, but logs the given tag before and
+    # after blocking.
+    def wait_for_release():
+        import os
+        import time
+
+        print(f"started {tag}")
+        while not os.path.exists(release_path):
+            time.sleep(0.05)
+        print(f"finished {tag}")
+        return os.getpid()
+
+    return prepare_local_request(wait_for_release)
+
+
+@pytest.mark.parametrize("agent_log_capture", [True, False])
+def test_agent_concurrency(tmp_path: Path, agent_log_capture: bool) -> None:
+    release_path = tmp_path / "release"
+    bridge = BridgeManager()
+    with make_server(
+        tmp_path,
+        bridge_manager=bridge,
+        max_workers=2,
+        agent_log_capture=agent_log_capture,
+        agent_concurrency=2,
+    ) as stubs:
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            user_logs: List[List[Log]] = [[], []]
+            runs = []
+            for tag, logs in zip(["first", "second"], user_logs):
+                runs.append(
+                    pool.submit(
+                        run_request,
+                        stubs.isolate_stub,
+                        prepare_tagged_blocking_request(release_path, tag),
+                        user_logs=logs,
+                    )
+                )
+                # Wait until the run has started (with its agent).
+                wait_until(lambda: logs)
+
+            release_path.touch()
+            pids = {from_grpc(run.result()) for run in runs}
+
+    if agent_log_capture:
+        # Both runs are executed by the same agent at the same time, and
+        # each of them only receives its own logs.
+        assert len(pids) == 1
+        assert bridge.stats.misses == 1
+        for tag, logs in zip(["first", "second"], user_logs):
+            assert [log.message for log in logs] == [
+                f"started {tag}",
+                f"finished {tag}",
+            ]
+    else:
+        # Otherwise the logs can't be told apart, so the agents
+        # aren't shared.
+        assert len(pids) == 2
+        assert bridge.stats.misses == 2
+
+
+def test_agent_concurrency_discards_duplicate_setup_results(tmp_path: Path) -> None:
+    setups_path = tmp_path / "setups"
+    setups_path.mkdir()
+
+    def setup():
+        import os
+        import time
+        import uuid
+
+        class Model:
+            def _isolate_teardown(self) -> None:
+                print("teardown")
+
+        # Wait until both runs are running the setup, so neither of them
+        # finds the other's result in the cache.
+        (setups_path / str(uuid.uuid4())).touch()
+        deadline = time.monotonic() + 30
+        while len(os.listdir(setups_path)) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        print("setup")
+        return Model()
+
+    request = definitions.BoundFunction(
+        setup_func=to_serialized_object(setup, method="cloudpickle"),
+        function=to_serialized_object(lambda model: id(model), method="cloudpickle"),
+        environments=[definitions.EnvironmentDefinition(kind="local")],
+        stream_logs=True,
+    )
+
+    bridge = BridgeManager()
+    with make_server(
+        tmp_path,
+        bridge_manager=bridge,
+        max_workers=2,
+        agent_log_capture=True,
+        agent_concurrency=2,
+    ) as stubs:
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            user_logs: List[List[Log]] = [[], []]
+            bridge_logs: List[List[Log]] = [[], []]
+            runs = []
+            for index in range(2):
+                runs.append(
+                    pool.submit(
+                        run_request,
+                        stubs.isolate_stub,
+                        request,
+                        user_logs=user_logs[index],
+                        bridge_logs=bridge_logs[index],
+                    )
+                )
+                # Wait until the run has started (with its agent).
+                wait_until(lambda: len(list(setups_path.iterdir())) > index)
+
+            model_ids = {from_grpc(run.result()) for run in runs}
+
+    assert bridge.stats.misses == 1
+    # Both setups have run, but only one of the results is kept (and used by
+    # both runs), the other one is torn down right away.
+    assert len(model_ids) == 1
+    messages = [log.message for logs in user_logs for log in logs]
+    assert sorted(messages) == ["setup", "setup", "teardown"]
+
+    bridge_messages = [log.message for logs in bridge_logs for log in logs]
+    assert any(
+        "Discarded 1 duplicate setup result(s)" in message
+        for message in bridge_messages
+    )
+    assert not any("Evicted" in message for message in bridge_messages)
+
+
+def test_agent_concurrency_isolates_log_context(tmp_path: Path) -> None:
+    def set_log_context():
+        import os
+
+        from isolate.connections.grpc.agent import isolate_log_context
+
+        isolate_log_context.set({"request_id": "first"})
+        return os.getpid()
+
+    def get_log_context():
+        import os
+
+        from isolate.connections.grpc.agent import get_log_context
+
+        return os.getpid(), get_log_context()
+
+    bridge = BridgeManager()
+    with make_server(
+        tmp_path,
+        bridge_manager=bridge,
+        agent_log_capture=True,
+        agent_concurrency=2,
+    ) as stubs:
+        pid = from_grpc(
+            run_request(stubs.isolate_stub, prepare_local_request(set_log_context))
+        )
+        # The context set by a run doesn't leak into the next one, even
+        # though it is executed by the same agent.
+        assert from_grpc(
+            run_request(stubs.isolate_stub, prepare_local_request(get_log_context))
+        ) == (pid, {})
+
+
+def test_agent_pool_invalid_sizes() -> None:
+    with pytest.raises(ValueError):
+        BridgeManager(min_idle_agents=-1)
+
+    with pytest.raises(ValueError):
+        BridgeManager(min_idle_agents=2, max_idle_agents=1)
+
+    with pytest.raises(ValueError):
+        BridgeManager(min_idle_agents=2, max_total_idle_agents=1)
+
+    with pytest.raises(ValueError):
+        BridgeManager(agent_idle_ttl=0)
+
+
+def test_environment_builds_are_shared(tmp_path: Path) -> None:
+    release = threading.Event()
+    created = []
+
+    class SlowEnvironment(LocalPythonEnvironment):
+        def create(self, *, force: bool = False) -> Path:
+            created.append(self)
+            self.log("building")
+            release.wait(timeout=30)
+            self.log("built")
+            return tmp_path
+
+    def make_environment(logs: List[Log]) -> SlowEnvironment:
+        environment = SlowEnvironment()
+        environment.apply_settings(
+            IsolateSettings(cache_dir=tmp_path, log_hook=logs.append)
+        )
+        return environment
+
+    builds = EnvironmentBuilds()
+    leader_logs: List[Log] = []
+    follower_logs: List[Log] = []
+    leader = make_environment(leader_logs)
+    follower = make_environment(follower_logs)
+
+    def subscribers() -> int:
+        return sum(len(build._subscribers) for build in builds._builds.values())
+
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        leader_future = pool.submit(builds.create, leader)
+        wait_until(lambda: created)
+
+        follower_future = pool.submit(builds.create, follower)
+        wait_until(lambda: subscribers() == 2)
+        release.set()
+        assert leader_future.result() == follower_future.result() == tmp_path
+
+    # Only the leader actually built the environment, but everyone
+    # received its logs.
+    assert created == [leader]
+    for logs in (leader_logs, follower_logs):
+        assert [log.message for log in logs] == ["building", "built"]
+
+    # The leader gets its original settings back once the build is done.
+    assert leader.settings.log_hook == leader_logs.append
+
+    # Once finished, builds are not shared anymore.
+    assert builds.create(follower) == tmp_path
+    assert created == [leader, follower]
+
+
+def test_environment_builds_share_errors(tmp_path: Path) -> None:
+    release = threading.Event()
+
+    class BrokenEnvironment(LocalPythonEnvironment):
+        def create(self, *, force: bool = False) -> Path:
+            release.wait(timeout=30)
+            raise EnvironmentCreationError("broken")
+
+    builds = EnvironmentBuilds()
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        results = [pool.submit(builds.create, BrokenEnvironment()) for _ in range(2)]
+        wait_until(
+            lambda: sum(len(build._subscribers) for build in builds._builds.values())
+            == 2
+        )
+        release.set()
+        for result in results:
+            with pytest.raises(EnvironmentCreationError):
+                result.result()
+
+
+def test_environments_are_created_concurrently(tmp_path: Path) -> None:
+    # Only passes if both of the environments are being created at the
+    # same time.
+    barrier = threading.Barrier(2, timeout=10)
+
+    class SlowEnvironment(LocalPythonEnvironment):
+        def __init__(self, name: str) -> None:
+            self.name = name
+
+        @property
+        def key(self) -> str:
+            return self.name
+
+        def create(self, *, force: bool = False) -> Path:
+            barrier.wait()
+            return tmp_path / self.name
+
+    servicer = IsolateServicer(BridgeManager())
+    environments: List[Any] = [
+        (False, SlowEnvironment("first")),
+        (False, SlowEnvironment("second")),
+    ]
+    assert servicer._create_environments(environments) == [
+        tmp_path / "first",
+        tmp_path / "second",
+    ]
@@ -0,0 +1,132 @@
+"""Measure the cost of inferring the level of the stdout/stderr logs.
+
+Runs IsolateSettings.log over a corpus of typical user output (plain prints,
+logging module output, tracebacks, progress bars) and compares it with the
+previous implementation (lowercasing the line and checking each level in
+turn, then copying the log with dataclasses.replace), making sure both agree
+on the inferred levels.
+
+$ python tools/benchmark_log_level_inference.py --lines 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from dataclasses import replace
+from typing import Callable
+
+from isolate.backends.settings import IsolateSettings
+from isolate.logs import Log, LogLevel, LogSource
+
+TEMPLATES = [
+    "Epoch {n}/100 - loss: 0.{n:04d} - accuracy: 0.9{n:03d}",
+    "{n:3d}%|█████▌    | {n}/1000 [00:{n:02d}<00:12, 73.45it/s]",
+    "2024-05-01 12:00:{n:02d},123 - root - INFO - Processed batch {n}",
+    "2024-05-01 12:00:{n:02d} [INFO] Loaded {n} records from the database",
+    "2024-05-01 12:00:{n:02d} [WARNING] Retrying the request ({n} attempts left)",
+    "2024-05-01 12:00:{n:02d} [DEBUG] Cache hit for key item-{n}",
+    "[error] Could not connect to the server (attempt {n})",
+    "Traceback (most recent call last):",
+    '  File "/app/main.py", line {n}, in <module>',
+    "ValueError: invalid literal for int() with base 10: 'x{n}'",
+    "Error: process exited with status {n}",
+    "Warning: the {n}th argument is deprecated",
+    "debug: {n} objects in the queue",
+    "Downloading model weights ({n} MB)...",
+    "",
+    "{{'step': {n}, 'lr': 0.001, 'grad_norm': 1.{n}}}",
+    "x" * 2000,
+]
+
+
+def legacy_infer_log_level(log: Log) -> Log:
+    if log.level not in (LogLevel.STDOUT, LogLevel.STDERR):
+        return log
+
+    if log.source in (LogSource.BUILDER, LogSource.BRIDGE):
+        return replace(log, level=LogLevel.TRACE)
+
+    line = log.message_str().lower()
+
+    if line.startswith("error") or "[error]" in line:
+        return replace(log, level=LogLevel.ERROR)
+    if line.startswith("warning") or "[warning]" in line:
+        return replace(log, level=LogLevel.WARNING)
+    if line.startswith("warn") or "[warn]" in line:
+        return replace(log, level=LogLevel.WARNING)
+    if line.startswith("info") or "[info]" in line:
+        return replace(log, level=LogLevel.INFO)
+    if line.startswith("debug") or "[debug]" in line:
+        return replace(log, level=LogLevel.DEBUG)
+    if line.startswith("trace") or "[trace]" in line:
+        return replace(log, level=LogLevel.TRACE)
+
+    return replace(log, level=LogLevel.INFO)
+
+
+def make_corpus(count: int) -> list[tuple[str, LogLevel]]:
+    return [
+        (
+            random.choice(TEMPLATES).format(n=index % 100),
+            random.choice([LogLevel.STDOUT, LogLevel.STDERR]),
+        )
+        for index in range(count)
+    ]
+
+
+def make_logs(corpus: list[tuple[str, LogLevel]]) -> list[Log]:
+    return [Log(line, source=LogSource.USER, level=level) for line, level in corpus]
+
+
+def measure(function: Callable[[list[Log]], None], logs: list[Log]) -> float:
+    started_at = time.perf_counter()
+    function(logs)
+    return time.perf_counter() - started_at
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    corpus = make_corpus(options.lines)
+
+    expected: list[LogLevel] = []
+    legacy_settings = IsolateSettings(log_hook=lambda log: expected.append(log.level))
+    inferred: list[LogLevel] = []
+    settings = IsolateSettings(log_hook=lambda log: inferred.append(log.level))
+
+    def run_legacy(logs: list[Log]) -> None:
+        for log in logs:
+            legacy_settings.log_hook(legacy_infer_log_level(log))
+
+    def run_current(logs: list[Log]) -> None:
+        for log in logs:
+            settings.log(log)
+
+    legacy = current = float("inf")
+    for _ in range(options.repeat):
+        expected.clear()
+        inferred.clear()
+        legacy = min(legacy, measure(run_legacy, make_logs(corpus)))
+        current = min(current, measure(run_current, make_logs(corpus)))
+
+    # Only the beginning of the lines are scanned now, which doesn't make a
+    # difference for this corpus.
+    assert inferred == expected, "the levels were inferred differently"
+
+    print(f"lines: {len(corpus)}")
+    for label, elapsed in [("legacy", legacy), ("current", current)]:
+        print(
+            f"{label:>8}: {elapsed * 1000:8.2f} ms "
+            f"({elapsed / len(corpus) * 1e9:.0f} ns/line)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Measure the cost of masking the secrets in the agent logs.
+
+Generates random log lines (every tenth one leaking a secret) and masks them
+both with a regex per secret (the old way) and the way the local connections
+do it, where the single combined regex skips the lines without any secrets,
+making sure the output is the same.
+
+$ python tools/benchmark_log_masking.py --lines 10000 --secrets 300
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import string
+import time
+from pathlib import Path
+from typing import Any
+
+from isolate.backends.local import LocalPythonEnvironment
+from isolate.connections._local._base import PythonExecutionBase
+
+
+def make_secrets(count: int) -> dict[str, str]:
+    alphabet = string.ascii_letters + string.digits + "-_"
+    return {
+        f"SECRET_{index}": "".join(random.choices(alphabet, k=random.randint(9, 64)))
+        for index in range(count)
+    }
+
+
+def make_lines(count: int, secrets: list[str]) -> list[str]:
+    lines = []
+    for index in range(count):
+        words = [
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 10)))
+            for _ in range(15)
+        ]
+        if index % 10 == 0:
+            words.insert(5, random.choice(secrets))
+        lines.append(" ".join(words))
+    return lines
+
+
+def mask_all(
+    connection: PythonExecutionBase,
+    lines: list[str],
+    patterns: list[re.Pattern],
+    detector: re.Pattern | None = None,
+) -> tuple[list[str], float]:
+    started_at = time.perf_counter()
+    masked = [connection._mask(line, patterns, detector) for line in lines]
+    return masked, time.perf_counter() - started_at
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=10_000)
+    parser.add_argument("--secrets", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    env = make_secrets(options.secrets)
+    lines = make_lines(options.lines, list(env.values()))
+
+    connection: PythonExecutionBase[Any] = PythonExecutionBase(
+        LocalPythonEnvironment(), environment_path=Path("/"), extra_inheritance_paths=[]
+    )
+    started_at = time.perf_counter()
+    per_secret_patterns = connection._mk_patterns(env)
+    per_secret_build = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    detector = connection._mk_combined_pattern(env)
+    combined_build = time.perf_counter() - started_at
+
+    expected, per_secret = mask_all(connection, lines, per_secret_patterns)
+    masked, combined = mask_all(connection, lines, per_secret_patterns, detector)
+    assert masked == expected, "the combined regex masked the lines differently"
+
+    print(f"lines: {len(lines)}, secrets: {len(env)}")
+    for label, build, elapsed in [
+        ("per secret", per_secret_build, per_secret),
+        ("combined", combined_build, combined),
+    ]:
+        print(
+            f"{label:>10}: {elapsed * 1000:8.2f} ms "
+            f"({elapsed / len(lines) * 1e6:.2f} us/line, "
+            f"build {build * 1000:.2f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
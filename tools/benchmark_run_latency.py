@@ -0,0 +1,107 @@
+"""Measure the end-to-end latency of Run calls for a no-op function.
+
+Spins up an in-process isolate server, warms up a single agent for the local
+environment and then times each subsequent Run call. Since the agent is reused
+between the calls, the numbers mostly reflect the overhead of the server itself
+(queue watching, log streaming, gRPC framing).
+
+Each call is timed until the result arrives and until the stream is closed by
+the server, the difference between the two (the tail) is the time the server
+spends noticing that the run is done.
+
+$ python tools/benchmark_run_latency.py --iterations 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import tempfile
+import time
+from concurrent import futures
+from pathlib import Path
+
+import grpc
+from isolate.backends.settings import IsolateSettings
+from isolate.server import BridgeManager, IsolateServicer, definitions
+from isolate.server.interface import to_serialized_object
+
+
+def noop() -> None:
+    return None
+
+
+def make_request() -> definitions.BoundFunction:
+    return definitions.BoundFunction(
+        function=to_serialized_object(noop, method="cloudpickle"),
+        environments=[definitions.EnvironmentDefinition(kind="local")],
+        stream_logs=True,
+    )
+
+
+def run_once(
+    stub: definitions.IsolateStub, request: definitions.BoundFunction
+) -> tuple[float, float]:
+    """Return the time it took to receive the result and to consume the
+    whole stream."""
+    started_at = time.perf_counter()
+    result_at = None
+    for result in stub.Run(request):
+        if result.is_complete:
+            result_at = time.perf_counter()
+
+    finished_at = time.perf_counter()
+    assert result_at is not None, "The stream has ended without a result."
+    return result_at - started_at, finished_at - started_at
+
+
+def percentile(samples: list[float], ratio: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=3)
+    options = parser.parse_args()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    with tempfile.TemporaryDirectory() as cache_dir, BridgeManager() as bridge:
+        servicer = IsolateServicer(bridge, IsolateSettings(cache_dir=Path(cache_dir)))
+        definitions.register_isolate(servicer, server)
+        port = server.add_insecure_port("[::]:0")
+        server.start()
+
+        try:
+            stub = definitions.IsolateStub(grpc.insecure_channel(f"localhost:{port}"))
+            request = make_request()
+            for _ in range(options.warmup):
+                run_once(stub, request)
+
+            samples = [run_once(stub, request) for _ in range(options.iterations)]
+        finally:
+            server.stop(None)
+            servicer.cancel_tasks()
+
+    print(f"iterations: {len(samples)}")
+    report("time to result", [result for result, _ in samples])
+    report("time to end of stream", [finished for _, finished in samples])
+    report("tail", [finished - result for result, finished in samples])
+
+
+def report(title: str, samples: list[float]) -> None:
+    print(f"{title}:")
+    for label, value in [
+        ("mean", statistics.mean(samples)),
+        ("p50", percentile(samples, 0.50)),
+        ("p90", percentile(samples, 0.90)),
+        ("p99", percentile(samples, 0.99)),
+        ("max", max(samples)),
+    ]:
+        print(f"{label:>5}: {value * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()